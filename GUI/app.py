@@ -1,33 +1,31 @@
+import timings  # First, it notes when the process started
 import sys
-import requests
-from PyQt5.QtCore import Qt, QRect, QPoint, pyqtSignal, QObject, QByteArray, QBuffer, QThread, QTimer
-from PyQt5.QtGui import QPixmap, QPainter, QPen, QIcon, QGuiApplication, QImage, QKeySequence, QBrush, QColor
+from PyQt5.QtCore import Qt, QRect, QPoint, pyqtSignal, QTimer, QSettings
+from PyQt5.QtGui import QPixmap, QPainter, QPen, QIcon, QGuiApplication, QKeySequence, QBrush, QColor, QCursor
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QPushButton, QTextEdit, QDialog, QVBoxLayout,
-                             QLabel, QWidget, QHBoxLayout, QLineEdit, QScrollArea, QShortcut)
-import base64
-import platform
-import markdown
+                             QLabel, QWidget, QHBoxLayout, QScrollArea, QShortcut, QCheckBox,
+                             QSystemTrayIcon, QMenu, QStyle)
+import argparse
+import logging
+import time
+import uuid
 
 import sys
 import threading
-import keyboard
-
-def pixmap_to_base64(pixmap):
-    byte_array = QByteArray()
-    buffer = QBuffer(byte_array)
-    buffer.open(QBuffer.WriteOnly)
-    pixmap.save(buffer, "JPEG")
-    base64_data = base64.b64encode(byte_array.data()).decode("utf-8")
-    return f"data:image/jpeg;base64, {base64_data}"
-
-class WorkerSignals(QObject):
-    finished = pyqtSignal(object) # The parameter will be the response from the server
+from image_pipeline import ImagePreprocessor
+from transcript import TranscriptView
+from markdown_renderer import MarkdownRenderer
+from network import NetworkWorker, HistoryLoader
+from screen_watch import ScreenWatcher
 
 # Constants for image sizes and spacing
 IMAGE_WIDTH = 160
 IMAGE_HEIGHT = 120
 IMAGE_SPACING = 10  # Space between images
 
+API_URL = 'http://localhost:8000'
+UPLOAD_IMAGES = True  # Send screenshots as binary multipart uploads instead of base64 in JSON
+
 class ImageThumbnail(QWidget):
     def __init__(self, pixmap, original_pixmap, delete_callback, parent=None):
         super().__init__(parent)
@@ -51,56 +49,65 @@ class ImageThumbnail(QWidget):
         self.setParent(None)
         self.deleteLater()
 
-class APICaller(QThread):
-    response_received = pyqtSignal(object)
-     
-    def __init__(self, url, data):
-        super().__init__()
-        self.url = url
-        self.data = data
-
-    def run(self):
-        response = requests.post(self.url, json = self.data)
-        self.response_received.emit(response)
-
 class ScreenshotDialog(QDialog):
 
     screenshotTaken = pyqtSignal(QPixmap)
     finished = pyqtSignal()
     screenshotProcessFinished = pyqtSignal()  # New signal
+    shown = pyqtSignal()  # First frame of a capture painted
+    regionSelected = pyqtSignal(QRect)  # Selection on the whole desktop, in device pixels
     
     def __init__(self):
         super().__init__()
-        if platform.system() == "Windows":
-            self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint)
-            self.setAttribute(Qt.WA_TranslucentBackground)
-            self.setStyleSheet("background:transparent;")
-        else:
-            self.setWindowFlags(Qt.WindowStaysOnTopHint)
-            self.setAttribute(Qt.WA_TranslucentBackground)
-        self.setWindowState(self.windowState() | Qt.WindowFullScreen)
+        # The overlay paints a frozen copy of the screen, no translucency needed
+        self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint)
+        self.setCursor(Qt.CrossCursor)
+        # Hidden between captures, closing it never quits the app
+        self.setAttribute(Qt.WA_QuitOnClose, False)
+        self.frozen_frame = QPixmap()
         self.begin = QPoint()
         self.end = QPoint()
         self.is_selecting = False
-
-    def showEvent(self, event):
-        super().showEvent(event)
+        self.notify_shown = False
+
+    def prepare(self):
+        # Creates the native window and styles ahead of the first capture, the
+        # hotkey then only has to grab the screen and show it
+        self.ensurePolished()
+        self.winId()
+
+    def start(self):
+        # Grab the screen under the cursor once, the selection is drawn over that frame
+        current_screen = QGuiApplication.screenAt(QCursor.pos()) or QGuiApplication.primaryScreen()
+        self.frozen_frame = current_screen.grabWindow(0)
+        self.begin = QPoint()
+        self.end = QPoint()
+        self.is_selecting = False
+        self.notify_shown = True
+        self.setGeometry(current_screen.geometry())
+        self.showFullScreen()
         self.activateWindow()
         self.raise_()
-        current_screen = QApplication.screenAt(self.geometry().center())
-        print(f"Dialog shown on screen: {current_screen.name()}")
-        self.setGeometry(current_screen.geometry())
-
 
     def paintEvent(self, event):
         painter = QPainter(self)
-        painter.setRenderHint(QPainter.Antialiasing)
-        painter.fillRect(event.rect(), QBrush(QColor(0, 0, 0, 128)))  # Semi-transparent background
+        painter.drawPixmap(self.rect(), self.frozen_frame)
+        painter.fillRect(event.rect(), QBrush(QColor(0, 0, 0, 128)))  # Dim everything but the selection
         if self.is_selecting:
+            rect = QRect(self.begin, self.end).normalized()
+            painter.drawPixmap(rect, self.frozen_frame, self.toFrameRect(rect))
             pen = QPen(Qt.red, 2)
             painter.setPen(pen)
-            rect = QRect(self.begin, self.end).normalized()
             painter.drawRect(rect)
+        if self.notify_shown:
+            self.notify_shown = False
+            self.shown.emit()
+
+    def toFrameRect(self, rect):
+        # Widget coordinates are logical pixels, the frame is in device pixels
+        ratio = self.frozen_frame.devicePixelRatio()
+        return QRect(round(rect.x() * ratio), round(rect.y() * ratio),
+                     round(rect.width() * ratio), round(rect.height() * ratio))
 
     def mousePressEvent(self, event):
         self.begin = event.pos()
@@ -119,31 +126,28 @@ class ScreenshotDialog(QDialog):
         self.takeScreenshot()
         self.close()  # Exit the screenshot mode
 
-    def takeScreenshot(self):
-        self.hide()  # Hide the screenshot dialog
-        QGuiApplication.processEvents()  # Process any pending events to ensure the dialog is hidden
-
-        # Get the current screen based on the application's window
-        current_screen = QGuiApplication.screenAt(self.pos())
-
-        # Now we take the screenshot of the current screen
-        screenshot = current_screen.grabWindow(0)
-        
-        # Translate the selection points to global coordinates
-        global_begin = QApplication.desktop().mapToGlobal(self.begin)
-        global_end = QApplication.desktop().mapToGlobal(self.end)
-
-        # Make a QRect from the two global points and normalize it
-        selection_rect = QRect(global_begin, global_end).normalized()
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.frozen_frame = QPixmap()  # Release the full screen copy
+            self.close()
+            self.finished.emit()
+        else:
+            super().keyPressEvent(event)
 
-        # Crop the screenshot to the selection_rect
-        cropped = screenshot.copy(selection_rect)
-        self.screenshotTaken.emit(cropped)  # Emit the signal with the cropped screenshot
+    def takeScreenshot(self):
+        # Crop the selected region out of the frozen frame, no new grab
+        selection_rect = QRect(self.begin, self.end).normalized()
+        if selection_rect.width() > 1 and selection_rect.height() > 1:
+            frame_rect = self.toFrameRect(selection_rect)
+            ratio = self.frozen_frame.devicePixelRatio()
+            origin = self.geometry().topLeft()
+            self.regionSelected.emit(frame_rect.translated(round(origin.x() * ratio), round(origin.y() * ratio)))
+            cropped = self.frozen_frame.copy(frame_rect)
+            cropped.setDevicePixelRatio(1.0)
+            self.screenshotTaken.emit(cropped)  # Emit the signal with the cropped screenshot
+        self.frozen_frame = QPixmap()  # Release the full screen copy
         self.finished.emit()  # Emit the finished signal
         self.screenshotProcessFinished.emit()  # Emit the signal after taking the screenshot
-        self.show()  # Show the screenshot dialog again if needed
-
-        
 
 class MultiLineTextEdit(QTextEdit):
     def __init__(self, parent=None):
@@ -157,29 +161,113 @@ class MultiLineTextEdit(QTextEdit):
             
 class ChatApp(QMainWindow):
     
-    CHAT_DISPLAY_IMAGE_WIDTH = 200  # Width you want for the chat history images
-    CHAT_DISPLAY_IMAGE_HEIGHT = 150  # Height you want for the chat history images
-    takeScreenshotSignal = pyqtSignal()
+    STREAM_RENDER_INTERVAL = 100  # Minimum delay in ms between two markdown renders of a streamed reply
+    HIDE_SETTLE_DELAY = 150  # Delay in ms between hiding the window and freezing the screen
+    takeScreenshotSignal = pyqtSignal(float)  # perf_counter time of the hotkey press
     
-    def __init__(self):
+    def __init__(self, resident = False):
         super().__init__()
+        # Resident: lives in the system tray, closing the window only hides it
+        self.resident = resident and QSystemTrayIcon.isSystemTrayAvailable()
         self.setWindowTitle('Chat with GPT')
         self.setGeometry(100, 100, 480, 600)
         self.initUI()
         self.queued_images = []   # This will hold the QPixmap of the screenshot
-        self.api_thread = None  # Initialize an attribute to hold the thread
+        self.encoded_images = {}  # PreparedImage of each queued screenshot, keyed by pixmap cacheKey
+        self.pending_dispatches = []  # Messages waiting for their screenshots to be encoded, in order
+        self.preprocessor = ImagePreprocessor()
+        self.preprocessor.imageReady.connect(self.onImageReady)
+        self.preprocessor.imageFailed.connect(self.onImageFailed)
+        # Conversation id, known before the first reply so follow-ups can be queued. It is kept
+        # across restarts, the server stores the conversation and the transcript is reloaded.
+        self.settings = QSettings("ScreenGPT-Vision", "client")
+        self.session_id = self.settings.value("session_id") or uuid.uuid4().hex
+        self.settings.setValue("session_id", self.session_id)
+        self.network = NetworkWorker()  # Single long-lived thread sending the queued requests
+        self.network.request_started.connect(self.handleRequestStarted)
+        self.network.delta_received.connect(self.handleDelta)
+        self.network.event_received.connect(self.handleEvent)
+        self.network.request_finished.connect(self.handleRequestFinished)
+        self.outstanding_requests = 0
         self.loading_animation_timer = QTimer()  # Timer for loading animation
         self.loading_animation_timer.timeout.connect(self.updateLoadingAnimation)
         self.current_loading_text = ""  # Current text of the loading animation
+        self.loading_label = "thinking"  # Animated with dots, the queue position while waiting for the upstream
+        self.loading_message = None  # Transcript entry showing the loading animation
+        self.stream_text = None  # Reply received so far while streaming
+        self.stream_message = None  # Transcript entry of the reply being streamed
+        self.renderer = MarkdownRenderer()  # Cached markdown rendering, code highlighted in the background
+        self.renderer.highlighted.connect(self.onHighlighted)
+        self.pending_renders = {}  # Messages waiting for code highlighting, with their markdown
+        self.stream_render_timer = QTimer()  # Throttles re-rendering of the streamed reply
+        self.stream_render_timer.setSingleShot(True)
+        self.stream_render_timer.timeout.connect(self.renderStreamingReply)
+        self.history = HistoryLoader(API_URL)  # Earlier messages, loaded a page at a time when scrolling up
+        self.history.loaded.connect(self.onHistoryLoaded)
+        self.history_before = None  # Cursor of the next older page
+        self.history_complete = False
+        self.history_loading = False
+        self.chat_display.reachedTop.connect(self.loadOlderMessages)
+        # One overlay for every capture, built now rather than on the hotkey
+        self.screenshot_dialog = ScreenshotDialog()
+        self.screenshot_dialog.screenshotTaken.connect(self.queueScreenshot)
+        self.screenshot_dialog.finished.connect(self.onOverlayFinished)
+        self.screenshot_dialog.screenshotProcessFinished.connect(self.bringToFront)
+        self.screenshot_dialog.shown.connect(self.onOverlayShown)
+        self.screenshot_dialog.regionSelected.connect(self.onRegionSelected)
+        self.screenshot_dialog.prepare()
+        self.capture_requested_at = None
+        self.capture_pending = False
+        self.window_was_visible = False
+        self.hotkey_latency = timings.LatencyTracker("hotkey to overlay")
+        self.selecting_watch_region = False  # The overlay is open to pick the watched region, not a screenshot
+        self.watcher = None
+        self.watch_question = None
+        self.tray = None
+        if self.resident:
+            self.initTray()
+
+    def onStarted(self):
+        # Runs once the event loop is up and the window or tray icon is shown. The
+        # network thread, the first history page and the markdown warm-up start
+        # only now, they import the HTTP and markdown stacks off the startup path.
+        timings.record("startup", timings.since_start_ms())
+        self.network.start()
+        self.loadOlderMessages()
+        self.renderer.warmUp()
+
+    def initTray(self):
+        self.tray = QSystemTrayIcon(self.style().standardIcon(QStyle.SP_ComputerIcon), self)
+        menu = QMenu(self)
+        menu.addAction("Open chat", self.bringToFront)
+        menu.addAction("Take screenshot", self.openScreenshotDialog)
+        menu.addSeparator()
+        menu.addAction("Quit", QApplication.instance().quit)
+        self.tray.setContextMenu(menu)
+        self.tray.setToolTip("ScreenGPT-Vision")
+        self.tray.activated.connect(self.onTrayActivated)
+        self.tray.show()
+
+    def onTrayActivated(self, reason):
+        if reason == QSystemTrayIcon.Trigger:
+            if self.isVisible():
+                self.hide()
+            else:
+                self.bringToFront()
+
+    def closeEvent(self, event):
+        if self.resident:
+            event.ignore()
+            self.hide()
+        else:
+            super().closeEvent(event)
 
     def initUI(self):
         # Main layout container
         main_layout = QVBoxLayout()
         
-        # Chat display area
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
-        self.chat_display.setStyleSheet("QTextEdit { border: none; padding: 5px; background-color: #FFFFFF; }")
+        # Chat display area, only the visible messages are laid out and painted
+        self.chat_display = TranscriptView()
         main_layout.addWidget(self.chat_display)
 
         # Horizontal layout for image previews
@@ -220,6 +308,13 @@ class ChatApp(QMainWindow):
         self.send_button.clicked.connect(self.sendMessage)
         self.send_button.setStyleSheet("QPushButton { background-color: #A3C1DA; border: none; padding: 6px; border-radius: 3px; }"
                                    "QPushButton:disabled { background-color: #D3D3D3; }")
+
+        # Stop button, cancels the reply in progress and the queued messages
+        self.stop_button = QPushButton('Stop')
+        self.stop_button.clicked.connect(self.cancelRequests)
+        self.stop_button.setEnabled(False)
+        self.stop_button.setStyleSheet("QPushButton { background-color: #A3C1DA; border: none; padding: 6px; border-radius: 3px; }"
+                                   "QPushButton:disabled { background-color: #D3D3D3; }")
         
         # Set the shortcut for sending messages with Ctrl+Enter
         send_shortcut = QShortcut(QKeySequence("Ctrl+W"), self.text_input)
@@ -230,10 +325,29 @@ class ChatApp(QMainWindow):
         self.screenshot_button.clicked.connect(self.openScreenshotDialog)
         self.screenshot_button.setStyleSheet("QPushButton { background-color: #A3C1DA; border: none; padding: 6px; border-radius: 3px; }")
         
+        # New chat button, starts a fresh conversation
+        self.new_chat_button = QPushButton('New chat')
+        self.new_chat_button.clicked.connect(self.newChat)
+        self.new_chat_button.setStyleSheet("QPushButton { background-color: #A3C1DA; border: none; padding: 6px; border-radius: 3px; }")
+
+        # Watch button, asks the typed question again each time a screen region changes
+        self.watch_button = QPushButton('Watch')
+        self.watch_button.setCheckable(True)
+        self.watch_button.toggled.connect(self.toggleWatch)
+        self.watch_button.setStyleSheet("QPushButton { background-color: #A3C1DA; border: none; padding: 6px; border-radius: 3px; }"
+                                   "QPushButton:checked { background-color: #E8A3A3; }")
+
+        # Ask the question about each queued screenshot separately, answered concurrently
+        self.separate_checkbox = QCheckBox('Each screenshot separately')
+
         # Layout for buttons
         button_layout = QHBoxLayout()
         button_layout.addWidget(self.send_button)
+        button_layout.addWidget(self.stop_button)
         button_layout.addWidget(self.screenshot_button)
+        button_layout.addWidget(self.new_chat_button)
+        button_layout.addWidget(self.watch_button)
+        button_layout.addWidget(self.separate_checkbox)
         main_layout.addLayout(button_layout)
 
         # Central widget setup
@@ -247,63 +361,184 @@ class ChatApp(QMainWindow):
         
         self.takeScreenshotSignal.connect(self.openScreenshotDialog)
         self.startBackgroundListener()
-        
-    #     self.initScreenshotListener()
     
     def startBackgroundListener(self):
-        # Start the background listener in a new thread
+        # The only global hotkey listener, in a new thread
         listener_thread = threading.Thread(target=self.backgroundListener, daemon=True)
         listener_thread.start()
 
     def backgroundListener(self):
-        def take_screenshot():
-            # Emit the custom signal
-            self.takeScreenshotSignal.emit()
+        import keyboard  # Imported by the listener thread, off the startup path
 
-        keyboard.add_hotkey('ctrl+shift+q', take_screenshot)
+        def take_screenshot():
+            # Emit the custom signal with the press time, to measure the latency
+            self.takeScreenshotSignal.emit(time.perf_counter())
+
+        try:
+            keyboard.add_hotkey('ctrl+shift+q', take_screenshot)
+        except Exception as e:
+            # e.g. no access to the input devices, the in-app shortcut still works
+            logging.warning("Global hotkey unavailable: %s", e)
+            return
         keyboard.wait()  # This will block the thread, waiting for keyboard events
         
-    # def initScreenshotListener(self):
-    #     self.screenshot_timer = QTimer(self)
-    #     self.screenshot_timer.timeout.connect(self.checkForScreenshotSignal)
-    #     self.screenshot_timer.start(1000)  # Check every second
-
-    # def checkForScreenshotSignal(self):
-    #     if os.path.exists("screenshot_flag.txt"):
-    #         self.openScreenshotDialog()
-    #         os.remove("screenshot_flag.txt")  # Clean up the flag file
-        
-    def style_message(self, sender, message):
-        # Define bold style for the sender's name
-        sender_style = "font-weight: bold;"
-
-        # Construct the HTML for the styled message
-        styled_message = f"<div><span style='{sender_style}'>{sender}</span> {message}</div>"
-
-        return styled_message
-
-
-    
-    def markdown_to_html(self, markdown_text):
-        # Note that 'fenced_code' is part of the 'extra' extension in Python-Markdown
-        html = markdown.markdown(markdown_text, extensions=['extra', 'codehilite', 'nl2br'])
-        return html
-
-    def openScreenshotDialog(self):
+    def loadOlderMessages(self):
+        if not self.history_loading and not self.history_complete:
+            self.history_loading = True
+            self.history.load(self.session_id, self.history_before)
+
+    def onHistoryLoaded(self, page):
+        if page["session_id"] != self.session_id:
+            return  # Page of a conversation left with New chat
+        self.history_loading = False
+        if "error" in page:
+            # Retrying the latest page later would duplicate the messages sent meanwhile
+            self.history_complete = page["before"] is None
+            self.statusBar().showMessage(page["error"])
+            return
+
+        entries, highlighting = [], []
+        for message in reversed(page["messages"]):
+            images = []
+            for data in message["thumbnails"]:
+                pixmap = QPixmap()
+                if pixmap.loadFromData(data):
+                    images.append(pixmap)
+            # Rendered before insertion so the rows above the viewport keep their height
+            html, pending = self.renderer.render(message["text"])
+            entries.append(("You:" if message["role"] == "user" else "GPT:", html, images))
+            highlighting.append(message["text"] if pending else None)
+        for chat_message, text in zip(self.chat_display.prependMessages(entries), highlighting):
+            if text is not None:
+                self.pending_renders[chat_message] = text  # Code still being highlighted
+
+        self.history_before = page["next_before"]
+        self.history_complete = page["next_before"] is None
+
+    def newChat(self):
+        self.cancelRequests()
+        self.session_id = uuid.uuid4().hex
+        self.settings.setValue("session_id", self.session_id)
+        self.clearLoadingText()
+        self.stream_render_timer.stop()
+        self.chat_display.clear()
+        self.pending_renders = {}
+        self.stream_message = None
+        self.stream_text = None
+        self.history_before = None
+        self.history_complete = True  # Nothing stored yet for the new conversation
+        self.history_loading = False
+
+    def renderMarkdown(self, message, markdown_text, final = True):
+        html, pending = self.renderer.render(markdown_text, final)
+        if pending:
+            self.pending_renders[message] = markdown_text
+        else:
+            self.pending_renders.pop(message, None)
+        self.chat_display.updateMessage(message, html)
+
+    def onHighlighted(self):
+        # Some code block is highlighted, refresh the messages that were waiting for it
+        for message, markdown_text in list(self.pending_renders.items()):
+            self.renderMarkdown(message, markdown_text)
+
+    def openScreenshotDialog(self, requested_at = None):
+        # The frame is grabbed when the overlay opens, give the window manager
+        # a moment to actually hide the chat window first
+        if self.capture_pending or self.screenshot_dialog.isVisible():
+            return  # Hotkey pressed again during a capture
+        # Buttons and menu actions pass their checked state
+        self.capture_requested_at = requested_at or time.perf_counter()
+        self.capture_pending = True
+        self.window_was_visible = self.isVisible()
         self.hide()  # Hide the main chat window
-        self.screenshot_dialog = ScreenshotDialog()
-        self.screenshot_dialog.screenshotTaken.connect(self.queueScreenshot)
-        self.screenshot_dialog.finished.connect(self.show)  # Re-show the main chat window after the screenshot dialog is finished
-        self.screenshot_dialog.screenshotProcessFinished.connect(self.bringToFront)
-        self.screenshot_dialog.show()
+        QTimer.singleShot(self.HIDE_SETTLE_DELAY if self.window_was_visible else 0, self.startCapture)
+
+    def startCapture(self):
+        self.capture_pending = False
+        self.screenshot_dialog.start()
+
+    def onOverlayShown(self):
+        # Includes the settle delay when the chat window had to be hidden first
+        self.hotkey_latency.add((time.perf_counter() - self.capture_requested_at) * 1000)
+        if self.tray is not None:
+            self.tray.setToolTip("ScreenGPT-Vision\n" + self.hotkey_latency.summary())
+
+    def onOverlayFinished(self):
+        # Cancelled captures return to where the user was, hidden in the tray or not
+        if self.window_was_visible:
+            self.show()
+        if self.selecting_watch_region:
+            self.selecting_watch_region = False
+            if self.watcher is None:
+                self.setWatchButton(False)  # Cancelled, no region
+
+    def toggleWatch(self, checked):
+        if not checked:
+            self.stopWatch()
+            return
+        question = self.text_input.toPlainText().strip()
+        if not question:
+            self.setWatchButton(False)
+            self.statusBar().showMessage("Type the question to ask each time the region changes, then Watch.")
+            return
+        self.watch_question = question
+        self.text_input.clear()
+        self.selecting_watch_region = True
+        self.openScreenshotDialog()
+
+    def setWatchButton(self, checked):
+        self.watch_button.blockSignals(True)
+        self.watch_button.setChecked(checked)
+        self.watch_button.blockSignals(False)
+
+    def onRegionSelected(self, rect):
+        if not self.selecting_watch_region:
+            return
+        # Captured and compared on its own thread, only changed frames come back
+        self.watcher = ScreenWatcher((rect.x(), rect.y(), rect.width(), rect.height()))
+        self.watcher.changed.connect(self.onWatchedRegionChanged)
+        self.watcher.stats_updated.connect(self.showWatchStats)
+        self.watcher.failed.connect(self.onWatchFailed)
+        self.watcher.start()
+        self.appendMessage("Watching:", f"{rect.width()}x{rect.height()} region, asking \"{self.watch_question}\" when it changes.")
+
+    def stopWatch(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+            self.statusBar().showMessage("Stopped watching.")
+        self.setWatchButton(False)
+
+    def onWatchedRegionChanged(self, image, prepared, change):
+        # The frame is already encoded, it goes straight to the send queue
+        pixmap = QPixmap.fromImage(image)
+        self.appendMessage("You (watch):", self.watch_question, [pixmap])
+        self.outstanding_requests += 1
+        self.stop_button.setEnabled(True)
+        self.encoded_images[pixmap.cacheKey()] = prepared
+        # Asked after what the user is waiting for when the upstream is busy
+        self.dispatchMessage(self.watch_question, [pixmap.cacheKey()], priority = "watch")
+
+    def showWatchStats(self, stats):
+        self.statusBar().showMessage(f"Watching: {stats['change']:.1%} changed · {stats['cpu_percent']}% CPU · "
+                                     f"every {stats['interval']} s · {stats['sent']} sent of {stats['captures']}")
+
+    def onWatchFailed(self, error):
+        self.appendMessage("Error:", error)
+        self.stopWatch()
 
     def bringToFront(self):
         self.showNormal()  # Show and bring the window to the front
         self.activateWindow()  # Make the window the active window
         
     def queueScreenshot(self, pixmap):
+        if self.selecting_watch_region:
+            return  # The selection was the watched region
     # Store the original pixmap in the queue, not the scaled version
         self.queued_images.append(pixmap)
+        # Start encoding right away in the worker pool so sending has nothing left to do
+        self.preprocessor.submit(pixmap.cacheKey(), pixmap)
 
         # Scale the pixmap for displaying as a thumbnail in the UI
         thumbnail_pixmap = pixmap.scaled(IMAGE_WIDTH, IMAGE_HEIGHT, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
@@ -321,83 +556,173 @@ class ChatApp(QMainWindow):
             # Remove the pixmap from the queued_images list
             if thumbnail_widget.original_pixmap in self.queued_images:
                 self.queued_images.remove(thumbnail_widget.original_pixmap)
+            self.encoded_images.pop(thumbnail_widget.original_pixmap.cacheKey(), None)
 
             # Now remove the thumbnail widget from the layout and delete it
             self.image_preview_layout.takeAt(index)
             thumbnail_widget.deleteLater()
 
+    def onImageReady(self, key, prepared):
+        pending_keys = [key for _, image_keys, _, _ in self.pending_dispatches for key in image_keys]
+        if key not in pending_keys and all(pixmap.cacheKey() != key for pixmap in self.queued_images):
+            return  # The screenshot was deleted in the meantime
+        self.encoded_images[key] = prepared
+        self.flushDispatches()
+
+    def onImageFailed(self, key, error):
+        pending_keys = [key for _, image_keys, _, _ in self.pending_dispatches for key in image_keys]
+        if key not in pending_keys and all(pixmap.cacheKey() != key for pixmap in self.queued_images):
+            return
+        # The message goes without this screenshot rather than waiting for it forever
+        self.appendMessage("Error:", f"A screenshot could not be encoded and was left out ({error}).")
+        self.encoded_images[key] = None
+        self.flushDispatches()
+
     def sendMessage(self):
         message = self.text_input.toPlainText().strip()  
         if message or self.queued_images:
             # Display the user's message and images in the chat
             self.appendMessage("You:", message, self.queued_images)
-            
-            # Convert queued images to base64 strings
-            base64_images = [pixmap_to_base64(pixmap) for pixmap in self.queued_images]
 
+            # The send button stays enabled, follow-ups are queued behind the current reply
+            self.outstanding_requests += 1
+            self.stop_button.setEnabled(True)
 
-            # Prepare the data for the POST request
-            data = {"text": message, "images": base64_images}
-
-            self.send_button.setEnabled(False)  # Disable the send button
-            self.startLoadingAnimation()  # Start the loading animation
-
-             # Instead of creating a local variable, assign the APICaller to the class attribute
-            self.api_thread = APICaller('http://localhost:8000/chatGPT', data)
-            self.api_thread.response_received.connect(self.handleResponse)
-            self.api_thread.finished.connect(self.api_thread.deleteLater)  # Ensure proper cleanup
-            self.api_thread.start()
+            separately = self.separate_checkbox.isChecked() and len(self.queued_images) > 1
+            self.dispatchMessage(message, [pixmap.cacheKey() for pixmap in self.queued_images], separately)
 
             self.text_input.clear()
             self.clearImagePreviews()
             self.queued_images = []  # Clear the image queue
 
+    def dispatchMessage(self, message, image_keys, separately = False, priority = "interactive"):
+        self.pending_dispatches.append((message, image_keys, separately, priority))
+        self.flushDispatches()
+
+    def flushDispatches(self):
+        # Images are encoded in the background, messages are sent in order once
+        # all their screenshots are ready
+        while self.pending_dispatches:
+            message, image_keys, separately, priority = self.pending_dispatches[0]
+            if any(key not in self.encoded_images for key in image_keys):
+                return
+            self.pending_dispatches.pop(0)
+            images = [image for image in map(self.encoded_images.pop, image_keys) if image is not None]
+            if not message and not images:
+                # Every screenshot failed to encode, there is nothing left to ask
+                self.outstanding_requests -= 1
+                self.stop_button.setEnabled(self.outstanding_requests > 0)
+                continue
+
+            if separately and images:
+                # One batch request, the server answers every screenshot concurrently. The
+                # user is waiting for it, it is not scheduled as background batch work.
+                items = [{"text": message, "images": [image.data_url()]} for image in images]
+                self.network.submit(f'{API_URL}/chatGPT/batch',
+                                    {"session_id": self.session_id, "items": items, "stream": True,
+                                     "priority": priority})
+                continue
+
+            # Prepare the data for the POST request
+            data = {"session_id": self.session_id, "text": message, "priority": priority}
+
+            if UPLOAD_IMAGES:
+                self.network.submit(f'{API_URL}/chatGPT/upload/stream', data, images)
+            else:
+                data["images"] = [image.data_url() for image in images]
+                self.network.submit(f'{API_URL}/chatGPT/stream', data)
+
+    def cancelRequests(self):
+        if self.pending_dispatches:
+            # Not sent yet, still waiting for their screenshots
+            self.outstanding_requests -= len(self.pending_dispatches)
+            self.pending_dispatches = []
+            self.appendMessage("Error:", "Cancelled.")
+        self.network.cancel()
+        self.stop_button.setEnabled(self.outstanding_requests > 0)
+
+    def handleRequestStarted(self, request_id):
+        self.stream_text = None
+        self.startLoadingAnimation()  # Start the loading animation
+
     def startLoadingAnimation(self):
-        self.current_loading_text = "GPT: thinking"
+        self.loading_label = "thinking"
+        self.current_loading_text = self.loading_label
+        self.loading_message = self.chat_display.appendMessage("GPT:", self.current_loading_text)
         self.loading_animation_timer.start(500)  # Update the animation every 500ms
 
     def updateLoadingAnimation(self):
         # Simply update the number of dots for the loading animation
-        num_dots = (len(self.current_loading_text) - len("GPT: thinking")) % 3 + 1
-        self.current_loading_text = "GPT: thinking" + "." * num_dots
-        self.updateChatDisplayWithLoadingText()
-
-    def updateChatDisplayWithLoadingText(self):
-        cursor = self.chat_display.textCursor()
-        cursor.beginEditBlock()
-        cursor.movePosition(cursor.End)
-        # Move the cursor to the start of the line where "GPT: thinking" starts
-        cursor.movePosition(cursor.StartOfLine, cursor.KeepAnchor)
-        # Check if the current line contains "GPT: thinking"
-        if "GPT: thinking" in cursor.selectedText():
-            # If so, remove only the "GPT: thinking..." part
-            cursor.removeSelectedText()
-            cursor.insertText(self.current_loading_text)
+        num_dots = (len(self.current_loading_text) - len(self.current_loading_text.rstrip("."))) % 3 + 1
+        self.current_loading_text = self.loading_label + "." * num_dots
+        if self.loading_message is not None:
+            self.chat_display.updateMessage(self.loading_message, self.current_loading_text)
+
+    def clearLoadingText(self):
+        self.loading_animation_timer.stop()
+        if self.loading_message is not None:
+            self.chat_display.removeMessage(self.loading_message)
+            self.loading_message = None
+
+    def handleDelta(self, request_id, delta):
+        if self.stream_text is None:
+            # First token: the loading entry becomes the reply
+            self.loading_animation_timer.stop()
+            self.stream_message = self.loading_message or self.chat_display.appendMessage("GPT:")
+            self.loading_message = None
+            self.stream_text = ""
+
+        self.stream_text += delta
+        # Re-render at most every STREAM_RENDER_INTERVAL ms, not on every token
+        if not self.stream_render_timer.isActive():
+            self.stream_render_timer.start(self.STREAM_RENDER_INTERVAL)
+
+    def handleEvent(self, request_id, event):
+        if "queued" in event:
+            # Waiting for the shared upstream, shown instead of "thinking"
+            position = event["queued"].get("position")
+            self.loading_label = f"queued, {'#' + str(position) + ', ' if position else ''}about {event['queued']['eta']:.0f} s"
+            return
+        # Batch answers arrive one by one in completion order, the loading
+        # entry stays below them until the last one
+        if "index" not in event:
+            return
+        self.clearLoadingText()
+        if "error" in event:
+            self.appendMessage("Error:", f"Screenshot {event['index'] + 1}: {event['error']}")
         else:
-            # If not, it means this is the first frame of the animation
-            # Insert the initial loading text without a newline
-            cursor.insertText(self.current_loading_text)
-        cursor.endEditBlock()
-        self.chat_display.ensureCursorVisible()
-
-    def handleResponse(self, response):
-        self.send_button.setEnabled(True)  # Re-enable the send button
-        self.loading_animation_timer.stop()  # Stop the loading animation
-
-        # Clear the loading text before displaying the response
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(cursor.End)
-        cursor.select(cursor.LineUnderCursor)
-        cursor.removeSelectedText()
-
-        if response.status_code == 200:
-            # Append response to chat display
-            self.appendMessage("GPT:", response.json()["response"])
+            self.appendMessage(f"GPT (screenshot {event['index'] + 1}):", event["response"])
+        self.startLoadingAnimation()
+
+    def renderStreamingReply(self):
+        if self.stream_text is None:
+            return
+        self.renderMarkdown(self.stream_message, self.stream_text, final = False)
+
+    def handleRequestFinished(self, request_id, result):
+        self.outstanding_requests -= 1
+        self.stop_button.setEnabled(self.outstanding_requests > 0)
+        self.stream_render_timer.stop()
+
+        if self.stream_text is None:
+            self.clearLoadingText()
         else:
-            # Handle error
-            self.appendMessage("Error:", "Failed to get response from the server.")
+            self.renderMarkdown(self.stream_message, self.stream_text)  # Final render with the complete reply
 
-        self.api_thread = None 
+        if result.get("cancelled"):
+            self.appendMessage("Error:", "Cancelled.")
+        elif "error" in result:
+            self.appendMessage("Error:", result["error"])
+        else:
+            self.showTimings(result.get("timings"))
+
+        self.stream_text = None
+        self.stream_message = None
+
+    def showTimings(self, timings):
+        # Where the server spent its time on the last reply, e.g. "upstream 820 ms"
+        if timings:
+            self.statusBar().showMessage("Server: " + " · ".join(f"{stage} {ms:.0f} ms" for stage, ms in timings.items()))
 
     def clearImagePreviews(self):
         # Clear the preview area
@@ -408,54 +733,34 @@ class ChatApp(QMainWindow):
                 widget_to_remove.setParent(None)
 
 
-    def pixmap_to_html(self, pixmap):
-        """
-        Converts a QPixmap object into an HTML img tag string with a base64-encoded source.
-        """
-        byte_array = QByteArray()
-        buffer = QBuffer(byte_array)
-        buffer.open(QBuffer.WriteOnly)
-        pixmap.save(buffer, "PNG")  # Save the pixmap into the buffer as PNG
-        base64_data = base64.b64encode(byte_array.data()).decode("utf-8")
-        return f'<img src="data:image/png;base64,{base64_data}"/>'
-    
-            
     def appendMessage(self, prefix, message, images=None):
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(cursor.End)
-        self.chat_display.setTextCursor(cursor)
-        
-        # Insert the sender's label
-        if prefix:
-            styled_prefix = self.style_message(prefix, "")  # Style the prefix
-            self.chat_display.insertHtml(styled_prefix)  # Insert the styled prefix
-            
-        # Insert images if available, right after the sender's label
-        if images:
-            self.chat_display.insertPlainText("\n")  # Add a newline after the last image
-            for pixmap in images:
-                # Scale the pixmap for displaying in the chat history
-                scaled_pixmap = pixmap.scaled(self.CHAT_DISPLAY_IMAGE_WIDTH, self.CHAT_DISPLAY_IMAGE_HEIGHT, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
-                # Convert pixmap to HTML and insert
-                image_html = self.pixmap_to_html(scaled_pixmap)
-                cursor.insertHtml(image_html)
-                cursor.insertText(" ")  # Add space after each image
-            self.chat_display.insertPlainText("\n")  # Add a newline after the last image
-            
-        # Insert text message if available, after the images
+        # The transcript lays the message out lazily when it is visible
+        chat_message = self.chat_display.appendMessage(prefix, "", images)
         if message:
-            message_html = self.markdown_to_html(message)
-            styled_message = self.style_message("", message_html)  # Style the message
-            self.chat_display.insertHtml(styled_message)  # Insert the styled message
-            self.chat_display.insertPlainText("\n")  # Add a newline after the last image
-        
-        self.chat_display.insertHtml("<br>")  # Ensure separation after the message block
-        self.chat_display.ensureCursorVisible()
+            self.renderMarkdown(chat_message, message)
             
 def main():
-    app = QApplication(sys.argv)
-    chat_app = ChatApp()
-    chat_app.show()
+    parser = argparse.ArgumentParser(description = "ScreenGPT-Vision desktop client")
+    parser.add_argument("--resident", action = "store_true",
+                        help = "Start in the system tray and keep running when the window is closed")
+    parser.add_argument("--exit-after-startup", action = "store_true",
+                        help = "Quit as soon as the app is up, to track the startup time")
+    args, qt_args = parser.parse_known_args()
+    # Startup and hotkey latencies are logged, e.g. "screengpt.timings startup: 420 ms"
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(name)s %(message)s")
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    chat_app = ChatApp(resident = args.resident)
+    app.aboutToQuit.connect(chat_app.network.stop)
+    app.aboutToQuit.connect(chat_app.history.stop)
+    app.aboutToQuit.connect(chat_app.stopWatch)
+    if chat_app.resident:
+        app.setQuitOnLastWindowClosed(False)
+    else:
+        chat_app.show()
+    QTimer.singleShot(0, chat_app.onStarted)
+    if args.exit_after_startup:
+        QTimer.singleShot(0, app.quit)
     sys.exit(app.exec_())
 
 if __name__ == '__main__':
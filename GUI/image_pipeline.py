@@ -0,0 +1,106 @@
+import base64
+from collections import Counter
+
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QByteArray, QBuffer, pyqtSignal
+
+# The model fits images in 2048x2048 then scales the short side down to 768,
+# anything above that is uploaded for nothing
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+PHOTO_JPEG_QUALITY = 80
+TEXT_JPEG_QUALITY = 90
+SAMPLE_SIZE = 64  # Side of the thumbnail used to classify the content
+
+
+class PreparedImage:
+    # Encoded screenshot ready to be sent
+    def __init__(self, data, mime, width, height):
+        self.data = data
+        self.mime = mime
+        self.width = width
+        self.height = height
+
+    def data_url(self):
+        return f"data:{self.mime};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+
+def fit_to_tiles(image):
+    width, height = image.width(), image.height()
+    scale = min(1.0, MAX_LONG_SIDE / max(width, height))
+    scale *= min(1.0, MAX_SHORT_SIDE / max(1, min(width, height) * scale))
+    if scale >= 1.0:
+        return image
+    return image.scaled(max(1, round(width * scale)), max(1, round(height * scale)),
+                        Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+
+def is_text_heavy(image):
+    # Text and UI screenshots have few distinct colours and large flat areas,
+    # photos and gradients have neither
+    sample = image.scaled(SAMPLE_SIZE, SAMPLE_SIZE, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+    colors = Counter(sample.pixel(x, y) for y in range(sample.height()) for x in range(sample.width()))
+    dominant = colors.most_common(1)[0][1] / (sample.width() * sample.height())
+    return len(colors) < SAMPLE_SIZE * SAMPLE_SIZE // 4 or dominant > 0.35
+
+
+def encode(image, fmt, quality = -1):
+    byte_array = QByteArray()
+    buffer = QBuffer(byte_array)
+    buffer.open(QBuffer.WriteOnly)
+    image.save(buffer, fmt, quality)
+    return byte_array.data()
+
+
+def prepare_image(image):
+    image = fit_to_tiles(image)
+    if is_text_heavy(image):
+        # PNG keeps text sharp, unless it is bigger than a high quality JPEG
+        png = encode(image, "PNG")
+        jpeg = encode(image, "JPEG", TEXT_JPEG_QUALITY)
+        if len(png) <= len(jpeg):
+            return PreparedImage(png, "image/png", image.width(), image.height())
+        return PreparedImage(jpeg, "image/jpeg", image.width(), image.height())
+    jpeg = encode(image, "JPEG", PHOTO_JPEG_QUALITY)
+    return PreparedImage(jpeg, "image/jpeg", image.width(), image.height())
+
+
+class PreprocessSignals(QObject):
+    finished = pyqtSignal(object, object)  # key, PreparedImage
+    failed = pyqtSignal(object, str)  # key, error
+
+
+class PreprocessTask(QRunnable):
+    def __init__(self, key, image, signals):
+        super().__init__()
+        self.key = key
+        self.image = image
+        self.signals = signals
+
+    def run(self):
+        # A corrupt or empty clipboard image must still be answered, the send
+        # waiting for it would never go otherwise
+        try:
+            prepared = prepare_image(self.image)
+            if not prepared.data:
+                raise ValueError("Nothing was encoded")
+        except Exception as e:
+            self.signals.failed.emit(self.key, f"{e.__class__.__name__}: {e}")
+            return
+        self.signals.finished.emit(self.key, prepared)
+
+
+class ImagePreprocessor(QObject):
+    imageReady = pyqtSignal(object, object)  # key, PreparedImage
+    imageFailed = pyqtSignal(object, str)  # key, error
+
+    def __init__(self, max_workers = 2, parent = None):
+        super().__init__(parent)
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_workers)
+        self.signals = PreprocessSignals()
+        self.signals.finished.connect(self.imageReady)
+        self.signals.failed.connect(self.imageFailed)
+
+    def submit(self, key, pixmap):
+        # QPixmap only lives on the UI thread, the workers get a QImage copy
+        self.pool.start(PreprocessTask(key, pixmap.toImage(), self.signals))
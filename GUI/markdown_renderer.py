@@ -0,0 +1,167 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+FAST_EXTENSIONS = ['extra', 'nl2br']  # Note that 'fenced_code' is part of 'extra'
+FULL_EXTENSIONS = ['extra', 'codehilite', 'nl2br']
+HIGHLIGHT_BUDGET_MS = 250  # Code blocks taking longer than this to highlight stay plain
+MAX_HIGHLIGHT_CHARS = 20000  # Bigger texts with code are not even tried
+CACHE_SIZE = 512  # Rendered blocks kept in memory
+
+FENCE = re.compile(r"^\s*(```|~~~)")
+
+_local = threading.local()
+
+
+def split_blocks(text):
+    # Top level blocks separated by blank lines, fenced code is never split
+    blocks, current, fence = [], [], None
+    for line in text.split("\n"):
+        match = FENCE.match(line)
+        if fence is not None:
+            current.append(line)
+            if match and match.group(1) == fence:
+                fence = None
+            continue
+        if match:
+            fence = match.group(1)
+            current.append(line)
+        elif line.strip():
+            current.append(line)
+        elif current:
+            blocks.append("\n".join(current))
+            current = []
+    if current:
+        blocks.append("\n".join(current))
+    return blocks
+
+
+def has_code(text):
+    return any(FENCE.match(line) for line in text.split("\n"))
+
+
+def convert(block, extensions):
+    # Markdown instances are not thread safe, each thread keeps its own
+    converters = getattr(_local, "converters", None)
+    if converters is None:
+        converters = _local.converters = {}
+    key = tuple(extensions)
+    if key not in converters:
+        import markdown  # Deferred, see MarkdownRenderer.warmUp
+        converters[key] = markdown.Markdown(extensions = extensions)
+    converter = converters[key]
+    try:
+        return converter.convert(block)
+    finally:
+        converter.reset()
+
+
+class HighlightSignals(QObject):
+    finished = pyqtSignal(str, object)  # block key, html or None when over budget
+
+
+class HighlightTask(QRunnable):
+    def __init__(self, key, block, budget_ms, signals):
+        super().__init__()
+        self.key = key
+        self.block = block
+        self.budget_ms = budget_ms
+        self.signals = signals
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            result = convert(self.block, FULL_EXTENSIONS)
+        except Exception:
+            result = None
+        if (time.perf_counter() - start) * 1000 > self.budget_ms:
+            result = None
+        self.signals.finished.emit(self.key, result)
+
+
+class WarmUpTask(QRunnable):
+    def run(self):
+        convert("```python\npass\n```", FULL_EXTENSIONS)
+
+
+class MarkdownRenderer(QObject):
+    # While a reply streams in, renders it block by block with the results cached
+    # by content hash, so appending text only renders the trailing block again.
+    # The final render converts the whole text at once. Code is first shown
+    # without highlighting, pygments runs in a background worker and highlighted
+    # emits once it is done.
+    highlighted = pyqtSignal()
+
+    def __init__(self, budget_ms = HIGHLIGHT_BUDGET_MS, parent = None):
+        super().__init__(parent)
+        self.budget_ms = budget_ms
+        self.cache = OrderedDict()
+        # Code blocks being highlighted, with their unhighlighted html as fallback
+        self.pending = {}
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.signals = HighlightSignals()
+        self.signals.finished.connect(self.onHighlighted)
+
+    def render(self, text, final = True):
+        # Returns (html, pending), pending is True while some code of text still
+        # waits for its highlighting. Markdown spanning blank lines (loose lists,
+        # indented continuations, reference links) needs the whole text, the
+        # block by block preview is only for text still being written, whose
+        # trailing block is not worth highlighting yet.
+        if final:
+            return self.render_part(text, highlight = True)
+        blocks = split_blocks(text)
+        parts = []
+        pending = False
+        for i, block in enumerate(blocks):
+            block_html, block_pending = self.render_part(block, highlight = i < len(blocks) - 1)
+            parts.append(block_html)
+            pending = pending or block_pending
+        return "".join(parts), pending
+
+    def render_part(self, text, highlight):
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        part_html = self.cached(key)
+        if part_html is not None:
+            return part_html, False
+        part_html = convert(text, FAST_EXTENSIONS)
+        if not has_code(text) or len(text) > MAX_HIGHLIGHT_CHARS:
+            self.store(key, part_html)
+        elif highlight:
+            self.highlight(key, text, part_html)
+            return part_html, True
+        return part_html, False
+
+    def cached(self, key):
+        block_html = self.cache.get(key)
+        if block_html is not None:
+            self.cache.move_to_end(key)
+        return block_html
+
+    def store(self, key, block_html):
+        self.cache[key] = block_html
+        self.cache.move_to_end(key)
+        while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last = False)
+
+    def highlight(self, key, block, fallback_html):
+        if key in self.pending:
+            return
+        self.pending[key] = fallback_html
+        self.pool.start(HighlightTask(key, block, self.budget_ms, self.signals))
+
+    def onHighlighted(self, key, block_html):
+        fallback_html = self.pending.pop(key, None)
+        # Over budget: the code block stays as plain preformatted text
+        self.store(key, block_html if block_html is not None else fallback_html)
+        self.highlighted.emit()
+
+    def warmUp(self):
+        # markdown and pygments are imported by the highlighting thread once the
+        # window is up, instead of delaying startup or the first reply
+        self.pool.start(WarmUpTask())
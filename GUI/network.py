@@ -0,0 +1,280 @@
+import itertools
+import json
+import queue
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThread, QThreadPool, pyqtSignal
+
+CONNECT_TIMEOUT = 5  # Seconds to establish the connection
+READ_TIMEOUT = 120  # Seconds without receiving a byte before giving up
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5  # Seconds, doubled after each attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}  # 429: the shared upstream is busy, retried after its Retry-After
+HISTORY_PAGE_SIZE = 30  # Stored messages fetched each time the transcript is scrolled to the top
+THUMBNAIL_SIZE = 200
+
+
+def new_session(pool_maxsize = 4):
+    # requests is imported here, from the worker threads, so that its import is
+    # not part of the startup of the window
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections = 1, pool_maxsize = pool_maxsize))
+    session.mount("https://", HTTPAdapter(pool_connections = 1, pool_maxsize = pool_maxsize))
+    return session
+
+
+def post_chat(session, url, data, images = None, timeout = None):
+    # images is a list of PreparedImage sent as binary multipart parts,
+    # without it data is posted as JSON
+    if images is None:
+        return session.post(url, json = data, stream = True, timeout = timeout)
+    form = {key: value for key, value in data.items() if value is not None}
+    files = [("images", (f"screenshot_{i}.{image.mime.split('/')[-1]}", image.data, image.mime))
+             for i, image in enumerate(images)]
+    return session.post(url, data = form, files = files, stream = True, timeout = timeout)
+
+
+def parse_server_timing(header):
+    # "stage;dur=12.3, other;dur=4" -> {"stage": 12.3, "other": 4.0}, in ms
+    timings = {}
+    for entry in (header or "").split(","):
+        name, *params = [part.strip() for part in entry.split(";")]
+        for param in params:
+            if name and param.startswith("dur="):
+                try:
+                    timings[name] = float(param[len("dur="):])
+                except ValueError:
+                    pass
+    return timings
+
+
+class Cancelled(Exception):
+    pass
+
+
+class ChatRequest:
+    def __init__(self, request_id, url, data, images = None, timeout = None):
+        self.id = request_id
+        self.url = url
+        self.data = data
+        self.images = images
+        self.timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.cancelled = threading.Event()
+        self.response = None
+
+
+class NetworkWorker(QThread):
+    # One long-lived thread owning a keep-alive session. Requests are queued and
+    # sent one after the other so follow-ups keep the conversation order.
+    request_started = pyqtSignal(int)
+    delta_received = pyqtSignal(int, str)
+    event_received = pyqtSignal(int, object)  # Any other server-sent event
+    request_finished = pyqtSignal(int, object)  # dict: the final event or JSON body, or an error
+
+    def __init__(self, max_retries = MAX_RETRIES, parent = None):
+        super().__init__(parent)
+        self.max_retries = max_retries
+        self.session = None  # Created by the thread itself
+        self.queue = queue.Queue()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.current = None
+        self.waiting = {}
+
+    def submit(self, url, data, images = None, timeout = None):
+        request = ChatRequest(next(self.ids), url, data, images, timeout)
+        with self.lock:
+            self.waiting[request.id] = request
+        self.queue.put(request)
+        return request.id
+
+    def cancel(self, request_id = None):
+        # Cancel one request, or everything queued and in flight when no id is given
+        with self.lock:
+            requests_to_cancel = list(self.waiting.values())
+            if self.current is not None:
+                requests_to_cancel.append(self.current)
+        for request in requests_to_cancel:
+            if request_id is None or request.id == request_id:
+                request.cancelled.set()
+                # Read once, the worker drops it when the request ends
+                with self.lock:
+                    response = request.response
+                if response is not None:
+                    # Unblocks a read waiting on the socket
+                    response.close()
+
+    def stop(self):
+        self.cancel()
+        self.queue.put(None)
+        self.wait()
+        if self.session is not None:
+            self.session.close()
+
+    def run(self):
+        self.session = new_session()
+        while True:
+            request = self.queue.get()
+            if request is None:
+                break
+            with self.lock:
+                self.waiting.pop(request.id, None)
+                self.current = request
+            if request.cancelled.is_set():
+                result = {"cancelled": True}
+            else:
+                self.request_started.emit(request.id)
+                result = self.send(request)
+            with self.lock:
+                self.current = None
+            self.request_finished.emit(request.id, result)
+
+    def send(self, request):
+        # Retries connection errors and 5xx with backoff, as long as nothing has
+        # been streamed back yet
+        import requests
+        attempt = 0
+        while True:
+            received = False
+            try:
+                if request.cancelled.is_set():
+                    raise Cancelled()
+                response = post_chat(self.session, request.url, request.data, request.images, request.timeout)
+                with self.lock:
+                    request.response = response
+                if request.cancelled.is_set():
+                    # Cancelled while connecting, before cancel could see the response
+                    response.close()
+                    raise Cancelled()
+                with response:
+                    if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                        delay = self.retryDelay(response, attempt)
+                        if response.status_code == 429:
+                            self.event_received.emit(request.id, {"queued": {"eta": delay}})
+                    elif response.status_code != 200:
+                        return {"error": f"Server answered {response.status_code}", "status": response.status_code}
+                    elif response.headers.get("content-type", "").startswith("text/event-stream"):
+                        for event in self.events(request, response):
+                            received = True
+                            if "delta" in event:
+                                self.delta_received.emit(request.id, event["delta"])
+                            elif "error" in event:
+                                return event
+                            elif event.get("done"):
+                                # The header was sent before most stages ran, the event has them all
+                                event.setdefault("timings", parse_server_timing(response.headers.get("Server-Timing")))
+                                return event
+                            else:
+                                self.event_received.emit(request.id, event)
+                        if request.cancelled.is_set():
+                            raise Cancelled()
+                        raise requests.ConnectionError("Stream ended early")
+                    else:
+                        result = response.json()
+                        result.setdefault("timings", parse_server_timing(response.headers.get("Server-Timing")))
+                        return result
+            except Exception as e:
+                # Closing the response to cancel it makes the read fail in various ways
+                if isinstance(e, Cancelled) or request.cancelled.is_set():
+                    return {"cancelled": True}
+                if not isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    return {"error": "Invalid response from the server."}
+                if received or attempt >= self.max_retries:
+                    return {"error": f"Failed to get response from the server: {e.__class__.__name__}"}
+                delay = RETRY_BACKOFF * 2 ** attempt
+            finally:
+                with self.lock:
+                    request.response = None
+
+            attempt += 1
+            # Waiting on the event lets a cancellation interrupt the backoff
+            if request.cancelled.wait(delay):
+                return {"cancelled": True}
+
+    def retryDelay(self, response, attempt):
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return RETRY_BACKOFF * 2 ** attempt
+
+    def events(self, request, response):
+        # Server-sent events, one JSON payload per "data:" line
+        for line in response.iter_lines(decode_unicode = True):
+            if request.cancelled.is_set():
+                raise Cancelled()
+            if line and line.startswith("data:"):
+                yield json.loads(line[len("data:"):])
+
+
+class HistorySignals(QObject):
+    loaded = pyqtSignal(object)
+
+
+class HistoryPageTask(QRunnable):
+    def __init__(self, loader, api_url, session_id, before, signals):
+        super().__init__()
+        self.loader = loader
+        self.api_url = api_url
+        self.session_id = session_id
+        self.before = before
+        self.signals = signals
+
+    def run(self):
+        # One page of stored messages, newest first, with the thumbnails of their images as bytes
+        import requests
+        self.session = self.loader.httpSession()
+        params = {"limit": HISTORY_PAGE_SIZE}
+        if self.before is not None:
+            params["before"] = self.before
+        try:
+            response = self.session.get(f"{self.api_url}/sessions/{self.session_id}/messages", params = params,
+                                        timeout = (CONNECT_TIMEOUT, 30))
+            response.raise_for_status()
+            page = response.json()
+            for message in page["messages"]:
+                message["thumbnails"] = [data for data in map(self.thumbnail, message["images"]) if data]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            page = {"error": f"Could not load the earlier messages: {e.__class__.__name__}"}
+        page["session_id"] = self.session_id
+        page["before"] = self.before
+        self.signals.loaded.emit(page)
+
+    def thumbnail(self, digest):
+        import requests
+        try:
+            response = self.session.get(f"{self.api_url}/images/{digest}", params = {"max_size": THUMBNAIL_SIZE},
+                                        timeout = (CONNECT_TIMEOUT, 30))
+        except requests.RequestException:
+            return None
+        return response.content if response.status_code == 200 else None
+
+
+class HistoryLoader(QObject):
+    # Fetches stored conversation pages on its own connection, so scrolling up
+    # never waits behind a reply being streamed by the NetworkWorker
+    loaded = pyqtSignal(object)  # dict: messages, next_before, session_id, before, or error
+
+    def __init__(self, api_url, parent = None):
+        super().__init__(parent)
+        self.api_url = api_url
+        self.session = None  # Created by the first task, off the UI thread
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)  # Pages arrive in the order they were asked for
+        self.signals = HistorySignals()
+        self.signals.loaded.connect(self.loaded)
+
+    def load(self, session_id, before = None):
+        self.pool.start(HistoryPageTask(self, self.api_url, session_id, before, self.signals))
+
+    def httpSession(self):
+        # Only called from the pool, which has a single thread
+        if self.session is None:
+            self.session = new_session(pool_maxsize = 1)
+        return self.session
+
+    def stop(self):
+        self.pool.waitForDone()
+        if self.session is not None:
+            self.session.close()
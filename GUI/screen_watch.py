@@ -0,0 +1,112 @@
+import threading
+import time
+
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtGui import QImage
+
+from image_pipeline import prepare_image
+
+WATCH_INTERVAL = 2.0  # Seconds between two captures, at best
+CHANGE_THRESHOLD = 0.02  # Share of the pixels that must differ from the last frame sent
+PIXEL_TOLERANCE = 24  # Grey level difference ignored, compression noise and antialiasing
+MIN_QUERY_INTERVAL = 15.0  # Seconds between two questions, however much the region changes
+MAX_SETTLE_TICKS = 3  # Captures a change may keep moving before it is sent anyway
+CPU_BUDGET = 0.05  # Share of one core the watcher may use, the interval grows to stay under it
+SIGNATURE_WIDTH = 256  # Frames are compared on a greyscale copy this wide
+
+CHANGED_LUT = [0] * (PIXEL_TOLERANCE + 1) + [255] * (255 - PIXEL_TOLERANCE)
+
+
+def grab_region(region):
+    # PIL grabs the screen from any thread (Windows, X11), unlike QScreen
+    from PIL import ImageGrab
+    x, y, width, height = region
+    return ImageGrab.grab(bbox = (x, y, x + width, y + height), all_screens = True).convert("RGB")
+
+
+def signature(frame):
+    from PIL import Image
+    width = min(SIGNATURE_WIDTH, frame.width)
+    height = max(1, round(frame.height * width / frame.width))
+    return frame.convert("L").resize((width, height), Image.BOX)
+
+
+def changed_share(a, b):
+    # Share of the pixels that differ by more than PIXEL_TOLERANCE, computed by
+    # PIL in C on the small greyscale signatures
+    from PIL import ImageChops
+    if b is None or a.size != b.size:
+        return 1.0
+    histogram = ImageChops.difference(a, b).point(CHANGED_LUT).histogram()
+    return histogram[255] / (a.width * a.height)
+
+
+def to_qimage(frame):
+    data = frame.tobytes()
+    return QImage(data, frame.width, frame.height, 3 * frame.width, QImage.Format_RGB888).copy()
+
+
+class ScreenWatcher(QThread):
+    # Captures a fixed screen region on an interval and emits it when it differs
+    # enough from the last frame sent and has stopped moving. Capture, diffing
+    # and encoding all happen on this thread.
+    changed = pyqtSignal(object, object, float)  # QImage of the region, PreparedImage, share of changed pixels
+    stats_updated = pyqtSignal(object)  # dict: cpu_percent, interval, captures, sent, change
+    failed = pyqtSignal(str)
+
+    def __init__(self, region, interval = WATCH_INTERVAL, threshold = CHANGE_THRESHOLD,
+                 min_query_interval = MIN_QUERY_INTERVAL, cpu_budget = CPU_BUDGET, grab = grab_region, parent = None):
+        super().__init__(parent)
+        self.region = region  # x, y, width, height in device pixels
+        self.interval = interval
+        self.threshold = threshold
+        self.min_query_interval = min_query_interval
+        self.cpu_budget = cpu_budget
+        self.grab = grab
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+        self.wait()
+
+    def run(self):
+        interval = self.interval
+        last_sent = None  # Signature of the last frame emitted
+        previous = None  # Signature of the previous capture
+        unsettled_ticks = 0
+        last_query = None
+        captures = sent = 0
+        while not self.stopping.is_set():
+            cpu_start = time.thread_time()
+            try:
+                frame = self.grab(self.region)
+            except Exception as e:
+                self.failed.emit(f"Could not capture the watched region: {e.__class__.__name__} {e}")
+                return
+            captures += 1
+            current = signature(frame)
+            change = changed_share(current, last_sent)
+            # A region still being redrawn (a log scrolling) is sent once it stops,
+            # or after a few captures if it never does
+            moving = changed_share(current, previous) > self.threshold
+            previous = current
+            now = time.monotonic()
+            if change > self.threshold:
+                unsettled_ticks = unsettled_ticks + 1 if moving else MAX_SETTLE_TICKS
+                if (unsettled_ticks >= MAX_SETTLE_TICKS
+                        and (last_query is None or now - last_query >= self.min_query_interval)):
+                    image = to_qimage(frame)
+                    self.changed.emit(image, prepare_image(image), change)
+                    last_sent = current
+                    last_query = now
+                    unsettled_ticks = 0
+                    sent += 1
+            else:
+                unsettled_ticks = 0
+
+            cpu = time.thread_time() - cpu_start
+            # Bounded CPU: a capture never costs more than cpu_budget of the time between two
+            interval = max(self.interval, cpu / self.cpu_budget)
+            self.stats_updated.emit({"cpu_percent": round(100 * cpu / interval, 1), "interval": round(interval, 2),
+                                     "captures": captures, "sent": sent, "change": round(change, 3)})
+            self.stopping.wait(interval)
@@ -0,0 +1,35 @@
+import logging
+import statistics
+import time
+from collections import deque
+
+# Imported first by app.py, so this is as close to the process start as the app can measure
+STARTED = time.perf_counter()
+MAX_SAMPLES = 100  # Latest hotkey latencies kept for the summary
+
+logger = logging.getLogger("screengpt.timings")
+
+
+def since_start_ms():
+    return (time.perf_counter() - STARTED) * 1000
+
+
+def record(name, ms):
+    logger.info("%s: %.0f ms", name, ms)
+
+
+class LatencyTracker:
+    # Latest samples of one latency, e.g. hotkey to overlay on screen
+    def __init__(self, name, max_samples = MAX_SAMPLES):
+        self.name = name
+        self.samples = deque(maxlen = max_samples)
+
+    def add(self, ms):
+        self.samples.append(ms)
+        record(self.name, ms)
+
+    def summary(self):
+        if not self.samples:
+            return f"{self.name}: no sample yet"
+        return (f"{self.name}: last {self.samples[-1]:.0f} ms, median {statistics.median(self.samples):.0f} ms, "
+                f"max {max(self.samples):.0f} ms over {len(self.samples)}")
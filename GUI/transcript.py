@@ -0,0 +1,252 @@
+from collections import OrderedDict
+import itertools
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QRect, QSize, QByteArray, QBuffer, pyqtSignal
+from PyQt5.QtGui import QPixmap, QTextDocument, QFont, QFontMetrics, QKeySequence
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate, QAbstractItemView, QApplication, QStyle
+
+THUMBNAIL_WIDTH = 200
+THUMBNAIL_HEIGHT = 150
+THUMBNAIL_CACHE_SIZE = 48  # Decoded thumbnails kept in memory
+DOCUMENT_CACHE_SIZE = 64  # Laid out message documents kept in memory
+PADDING = 6
+SPACING = 4
+
+_message_ids = itertools.count()
+
+
+def encode_thumbnail(pixmap):
+    # Offscreen messages only keep their thumbnails as compressed bytes
+    scaled = pixmap.scaled(THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    byte_array = QByteArray()
+    buffer = QBuffer(byte_array)
+    buffer.open(QBuffer.WriteOnly)
+    scaled.save(buffer, "PNG")
+    return byte_array
+
+
+class ChatMessage:
+    def __init__(self, sender, html = "", images = None):
+        self.id = next(_message_ids)
+        self.sender = sender
+        self.html = html
+        self.version = 0  # Bumped on every change so cached layouts are dropped
+        # (image key, compressed thumbnail) pairs
+        self.images = [(pixmap.cacheKey(), encode_thumbnail(pixmap)) for pixmap in images or []]
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+
+class TranscriptModel(QAbstractListModel):
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.messages = []
+
+    def rowCount(self, parent = QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role = Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        return self.messages[index.row()]
+
+    def appendMessage(self, sender, html = "", images = None):
+        row = len(self.messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append(ChatMessage(sender, html, images))
+        self.endInsertRows()
+        return self.messages[row]
+
+    def prependMessages(self, entries):
+        # entries are (sender, html, images) tuples, oldest first
+        if not entries:
+            return []
+        messages = [ChatMessage(sender, html, images) for sender, html, images in entries]
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.messages[:0] = messages
+        self.endInsertRows()
+        return messages
+
+    def clear(self):
+        self.beginResetModel()
+        self.messages = []
+        self.endResetModel()
+
+    def updateMessage(self, message, html):
+        message.html = html
+        message.version += 1
+        row = self.messages.index(message)
+        self.dataChanged.emit(self.index(row), self.index(row))
+
+    def removeMessage(self, message):
+        row = self.messages.index(message)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.messages[row]
+        self.endRemoveRows()
+
+
+class MessageDelegate(QStyledItemDelegate):
+    # Paints one message: the sender, its thumbnails and the rendered html.
+    # Only visible rows are painted, layouts and thumbnails are rebuilt on demand.
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self.thumbnails = LRUCache(THUMBNAIL_CACHE_SIZE)
+        self.documents = LRUCache(DOCUMENT_CACHE_SIZE)
+
+    def senderFont(self, option):
+        font = QFont(option.font)
+        font.setBold(True)
+        return font
+
+    def contentWidth(self):
+        return max(1, self.view.viewport().width() - 2 * PADDING)
+
+    def thumbnail(self, key, data):
+        pixmap = self.thumbnails.get(key)
+        if pixmap is None:
+            pixmap = QPixmap()
+            pixmap.loadFromData(data, "PNG")
+            self.thumbnails.put(key, pixmap)
+        return pixmap
+
+    def document(self, message, width):
+        key = (message.id, message.version, width)
+        document = self.documents.get(key)
+        if document is None:
+            document = QTextDocument()
+            document.setDocumentMargin(0)
+            document.setHtml(message.html)
+            document.setTextWidth(width)
+            self.documents.put(key, document)
+        return document
+
+    def imagesPerRow(self, width):
+        return max(1, (width + SPACING) // (THUMBNAIL_WIDTH + SPACING))
+
+    def imagesHeight(self, message, width):
+        if not message.images:
+            return 0
+        rows = -(-len(message.images) // self.imagesPerRow(width))
+        return rows * (THUMBNAIL_HEIGHT + SPACING)
+
+    def sizeHint(self, option, index):
+        message = index.data()
+        width = self.contentWidth()
+        height = QFontMetrics(self.senderFont(option)).height() + SPACING
+        height += self.imagesHeight(message, width)
+        if message.html:
+            height += int(self.document(message, width).size().height())
+        return QSize(width + 2 * PADDING, height + 2 * PADDING)
+
+    def paint(self, painter, option, index):
+        message = index.data()
+        width = self.contentWidth()
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.alternateBase())
+
+        x = option.rect.x() + PADDING
+        y = option.rect.y() + PADDING
+        painter.setFont(self.senderFont(option))
+        metrics = painter.fontMetrics()
+        painter.drawText(QRect(x, y, width, metrics.height()), Qt.AlignLeft | Qt.AlignVCenter, message.sender)
+        y += metrics.height() + SPACING
+
+        per_row = self.imagesPerRow(width)
+        for i, (key, data) in enumerate(message.images):
+            row, column = divmod(i, per_row)
+            painter.drawPixmap(x + column * (THUMBNAIL_WIDTH + SPACING), y + row * (THUMBNAIL_HEIGHT + SPACING),
+                               self.thumbnail(key, data))
+        y += self.imagesHeight(message, width)
+
+        if message.html:
+            painter.translate(x, y)
+            self.document(message, width).drawContents(painter)
+        painter.restore()
+
+
+class TranscriptView(QListView):
+    reachedTop = pyqtSignal()  # Scrolled up to the oldest loaded message
+
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.transcript = TranscriptModel(self)
+        self.setModel(self.transcript)
+        self.setItemDelegate(MessageDelegate(self))
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setResizeMode(QListView.Adjust)  # Re-layout when the width changes
+        self.setUniformItemSizes(False)
+        self.setStyleSheet("QListView { border: none; padding: 5px; background-color: #FFFFFF; }")
+        self.verticalScrollBar().valueChanged.connect(self.onScrolled)
+
+    def onScrolled(self, value):
+        if value == self.verticalScrollBar().minimum():
+            self.reachedTop.emit()
+
+    def isAtBottom(self):
+        bar = self.verticalScrollBar()
+        return bar.value() >= bar.maximum() - 4
+
+    def appendMessage(self, sender, html = "", images = None):
+        follow = self.isAtBottom()
+        message = self.transcript.appendMessage(sender, html, images)
+        if follow:
+            self.scrollToBottom()
+        return message
+
+    def prependMessages(self, entries):
+        # Older messages go above the current ones without moving what is on screen
+        bar = self.verticalScrollBar()
+        follow = self.isAtBottom()
+        from_bottom = bar.maximum() - bar.value()
+        messages = self.transcript.prependMessages(entries)
+        self.doItemsLayout()
+        if follow:
+            self.scrollToBottom()
+        else:
+            bar.setValue(bar.maximum() - from_bottom)
+        return messages
+
+    def clear(self):
+        self.transcript.clear()
+
+    def updateMessage(self, message, html):
+        follow = self.isAtBottom()
+        self.transcript.updateMessage(message, html)
+        if follow:
+            self.scrollToBottom()
+
+    def removeMessage(self, message):
+        self.transcript.removeMessage(message)
+
+    def keyPressEvent(self, event):
+        # Copy the plain text of the selected messages
+        if event.matches(QKeySequence.Copy):
+            rows = sorted(index.row() for index in self.selectedIndexes())
+            texts = []
+            for row in rows:
+                message = self.transcript.messages[row]
+                document = QTextDocument()
+                document.setHtml(message.html)
+                texts.append(f"{message.sender} {document.toPlainText()}".strip())
+            QApplication.clipboard().setText("\n\n".join(texts))
+        else:
+            super().keyPressEvent(event)
@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+
+# Conversations survive restarts in this SQLite file, persistence is off when empty
+DATABASE_PATH = config("DATABASE_PATH", default = "data/screengpt.db")
+DB_BATCH_SIZE = config("DB_BATCH_SIZE", default = 256, cast = int)
+DB_FLUSH_INTERVAL = config("DB_FLUSH_INTERVAL", default = 0.05, cast = float)  # Seconds a batch waits for more writes
+HISTORY_PAGE_SIZE = config("HISTORY_PAGE_SIZE", default = 50, cast = int)
+# Most recent messages loaded back into memory when a stored session is resumed
+RESTORE_MESSAGES = config("RESTORE_MESSAGES", default = 20, cast = int)
+MAX_HISTORY_PAGE_SIZE = 200
+KNOWN_IMAGES_CACHE = 65536  # Digests remembered as already written
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_session ON messages (session_id, id);
+CREATE TABLE IF NOT EXISTS images (
+    digest TEXT PRIMARY KEY,
+    mime TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+-- Images each message references, so deleting a session finds the blobs it
+-- leaves unreferenced through the digest index instead of scanning every message
+CREATE TABLE IF NOT EXISTS message_images (
+    message_id INTEGER NOT NULL,
+    session_id TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_images_by_digest ON message_images (digest);
+CREATE INDEX IF NOT EXISTS message_images_by_session ON message_images (session_id);
+"""
+
+
+def content_images(content):
+    # Digests of the image references in the content of a message
+    if not isinstance(content, list):
+        return []
+    return list(dict.fromkeys(item["digest"] for item in content
+                              if isinstance(item, dict) and item.get("type") == "image_ref"))
+
+
+class ConversationStore:
+    # Append-only message log plus image blobs stored once by digest. Writes are
+    # queued and committed in batches by a single writer thread, so requests never
+    # wait on the disk. Reads use one connection per thread, WAL lets them run
+    # alongside the writer.
+    def __init__(self, path = DATABASE_PATH, batch_size = DB_BATCH_SIZE, flush_interval = DB_FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok = True)
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode = WAL")
+        indexed = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_images'").fetchone() is not None
+        connection.executescript(SCHEMA)
+        if not indexed:
+            self._index_images(connection)
+        connection.close()
+
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        # Writes queued but not committed yet, flush waits for it to reach 0
+        self.pending = 0
+        self.pending_lock = threading.Condition()
+        self.known_images = OrderedDict()
+        self.known_lock = threading.Lock()
+        self.writer = threading.Thread(target = self._run_writer, name = "conversation-store-writer", daemon = True)
+        self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout = 30)
+        connection.execute("PRAGMA synchronous = NORMAL")
+        return connection
+
+    def _index_images(self, connection):
+        # Databases written before message_images existed, their references are
+        # read from the stored messages once
+        rows = connection.execute(
+            "SELECT id, session_id, content FROM messages WHERE instr(content, '\"image_ref\"') > 0").fetchall()
+        with connection:
+            connection.executemany(
+                "INSERT INTO message_images (message_id, session_id, digest) VALUES (?, ?, ?)",
+                [(id, session_id, digest) for id, session_id, content in rows
+                 for digest in content_images(json.loads(content))])
+
+    def _reader(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self._connect()
+        return connection
+
+    # Writes, queued
+
+    def _enqueue(self, operation):
+        with self.pending_lock:
+            self.pending += 1
+        self.queue.put(operation)
+
+    def append_messages(self, session_id, messages):
+        now = time.time()
+        for message in messages:
+            content = json.dumps(message.get("content"), ensure_ascii = False)
+            images = content_images(message.get("content"))
+            self._enqueue(("message", (session_id, message["role"], content, now, images)))
+
+    def save_image(self, digest, mime, width, height, data):
+        # Skipped when the image is known to be written already, the insert
+        # ignores duplicates anyway
+        with self.known_lock:
+            if digest in self.known_images:
+                self.known_images.move_to_end(digest)
+                return
+            self.known_images[digest] = None
+            while len(self.known_images) > KNOWN_IMAGES_CACHE:
+                self.known_images.popitem(last = False)
+        self._enqueue(("image", (digest, mime, width, height, bytes(data))))
+
+    def delete_session(self, session_id, images = ()):
+        # images are digests of the session, their blobs are deleted with it unless
+        # messages of another session still reference them
+        images = tuple(images)
+        with self.known_lock:
+            for digest in images:
+                self.known_images.pop(digest, None)  # Written again if it is saved later
+        self._enqueue(("delete", (session_id, images)))
+
+    def flush(self, timeout = None):
+        # Wait until everything queued so far is committed, False on timeout
+        with self.pending_lock:
+            return self.pending_lock.wait_for(lambda: self.pending == 0, timeout)
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+
+    def _run_writer(self):
+        connection = self._connect()
+        stopping = False
+        while not stopping:
+            operation = self.queue.get()
+            if operation is None:
+                break
+            batch = [operation]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    operation = self.queue.get(timeout = max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if operation is None:
+                    stopping = True
+                    break
+                batch.append(operation)
+            self._write(connection, batch)
+        connection.close()
+
+    def _write(self, connection, batch):
+        try:
+            with connection:
+                for kind, values in batch:
+                    if kind == "message":
+                        session_id, role, content, created, images = values
+                        message_id = connection.execute(
+                            "INSERT INTO messages (session_id, role, content, created) VALUES (?, ?, ?, ?)",
+                            (session_id, role, content, created)).lastrowid
+                        connection.executemany(
+                            "INSERT INTO message_images (message_id, session_id, digest) VALUES (?, ?, ?)",
+                            [(message_id, session_id, digest) for digest in images])
+                    elif kind == "image":
+                        connection.execute(
+                            "INSERT OR IGNORE INTO images (digest, mime, width, height, data) VALUES (?, ?, ?, ?, ?)",
+                            values)
+                    elif kind == "delete":
+                        session_id, images = values
+                        connection.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                        connection.execute("DELETE FROM message_images WHERE session_id = ?", (session_id,))
+                        connection.executemany(
+                            "DELETE FROM images WHERE digest = ? "
+                            "AND NOT EXISTS (SELECT 1 FROM message_images WHERE digest = ?)",
+                            [(digest, digest) for digest in images])
+        except sqlite3.Error:
+            logging.exception("Could not write %d operations to the conversation store", len(batch))
+        finally:
+            with self.pending_lock:
+                self.pending -= len(batch)
+                self.pending_lock.notify_all()
+
+    # Reads
+
+    def has_session(self, session_id):
+        return self._reader().execute(
+            "SELECT 1 FROM messages WHERE session_id = ? LIMIT 1", (session_id,)).fetchone() is not None
+
+    def session_images(self, session_id):
+        # Digests referenced by the stored messages of a session
+        rows = self._reader().execute(
+            "SELECT DISTINCT digest FROM message_images WHERE session_id = ?", (session_id,)).fetchall()
+        return {digest for (digest,) in rows}
+
+    def recent_messages(self, session_id, limit):
+        # The last limit messages of a session, oldest first, as history messages
+        rows = self._reader().execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (session_id, limit)).fetchall()
+        return [{"role": role, "content": json.loads(content)} for role, content in reversed(rows)]
+
+    def page(self, session_id, before = None, limit = HISTORY_PAGE_SIZE):
+        # Messages older than the id before (the latest ones without it), newest
+        # first. Returns (rows, id to pass as before for the next page or None).
+        limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+        if before is None:
+            rows = self._reader().execute(
+                "SELECT id, role, content, created FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit + 1)).fetchall()
+        else:
+            rows = self._reader().execute(
+                "SELECT id, role, content, created FROM messages WHERE session_id = ? AND id < ? "
+                "ORDER BY id DESC LIMIT ?", (session_id, before, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = [{"id": id, "role": role, "content": json.loads(content), "created": created}
+                for id, role, content, created in rows[:limit]]
+        return rows, rows[-1]["id"] if more else None
+
+    def load_image(self, digest):
+        # (data, mime, width, height) or None
+        return self._reader().execute(
+            "SELECT data, mime, width, height FROM images WHERE digest = ?", (digest,)).fetchone()
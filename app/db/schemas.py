@@ -1,6 +1,29 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+
+# order in which the upstream budget is given out, see UpstreamScheduler
+Priority = Literal["interactive", "watch", "batch"]
 
 class ChatInput(BaseModel):
+    session_id: Optional[str] = None
     text: Optional[str] = None
-    images: Optional[List[str]] = None
\ No newline at end of file
+    # base64 data URLs, or "sha256:<digest>" references to images already uploaded
+    images: Optional[List[str]] = None
+    # skip the response cache lookup, the fresh answer still refreshes the cache
+    bypass_cache: bool = False
+    priority: Priority = "interactive"
+
+class ImageUpload(BaseModel):
+    images: List[str]
+
+class BatchItem(BaseModel):
+    text: Optional[str] = None
+    images: Optional[List[str]] = None
+
+class BatchInput(BaseModel):
+    session_id: Optional[str] = None
+    items: List[BatchItem] = Field(min_length = 1)
+    # stream each result as a server-sent event as soon as it is ready
+    stream: bool = False
+    bypass_cache: bool = False
+    priority: Priority = "batch"
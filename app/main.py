@@ -1,20 +1,477 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import logging
+import math
+import time
+from fastapi import FastAPI, HTTPException, Request, Form, File, UploadFile
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional
-from app.services.LLM.gpt4_vision import chatgpt
-from app.db.schemas import ChatInput
+from decouple import config
+from app.services.LLM.gpt4_vision import chatgpt, http_client, UPSTREAM_TIMEOUT
+from app.services.LLM.limiter import ConcurrencyLimiter, Saturated
+from app.services.LLM.scheduler import QueueStatus, RateLimited
+from app.services.images.image_store import IMAGE_REF_PREFIX, InvalidImage, UnknownImage, make_thumbnail
+from app.services.images.uploads import read_image_upload
+from app.services.metrics import metrics
+from app.db.schemas import ChatInput, ImageUpload, BatchInput, Priority
+from app.db.conversation_store import HISTORY_PAGE_SIZE
+
+# How often a waiting request checks whether its client is still connected
+DISCONNECT_POLL_INTERVAL = config("DISCONNECT_POLL_INTERVAL", default = 0.5, cast = float)
+BATCH_PARALLELISM = config("BATCH_PARALLELISM", default = 4, cast = int)
+MAX_BATCH_ITEMS = config("MAX_BATCH_ITEMS", default = 20, cast = int)
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
+limiter = ConcurrencyLimiter()
+
+class ClientDisconnected(Exception):
+    pass
+
+@app.on_event("shutdown")
+async def close_upstream_pool():
+    await http_client.aclose()
+
+@app.on_event("shutdown")
+async def close_conversation_store():
+    # commits the turns still queued and stops the image workers
+    await run_in_threadpool(chatgpt.close)
+
+async def get_session(session_id):
+    # a session that left memory is restored from the database, off the event loop.
+    # It stays pinned in memory until release_session, so an eviction while the
+    # request waits for the upstream does not lose its turn.
+    loading = asyncio.ensure_future(run_in_threadpool(chatgpt.session_manager.get, session_id, True))
+    try:
+        return await asyncio.shield(loading)
+    except asyncio.CancelledError:
+        # the load still finishes in its thread, its pin is dropped then
+        loading.add_done_callback(lambda done: done.cancelled() or done.exception() or release_session(done.result()))
+        raise
+
+def release_session(session):
+    chatgpt.session_manager.unpin(session)
+
+def run_once(cleanup):
+    # streamed responses release what they hold both when their body ends and in the
+    # response background, which also runs when the client left before the body started
+    done = False
+    def run():
+        nonlocal done
+        if not done:
+            done = True
+            cleanup()
+    return run
+
+async def run_until_disconnected(request, coro, timeout = UPSTREAM_TIMEOUT):
+    # Run coro but cancel it if the client goes away or the deadline passes, no deadline when timeout is None
+    task = asyncio.ensure_future(coro)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    try:
+        while True:
+            remaining = deadline - time.monotonic() if deadline is not None else DISCONNECT_POLL_INTERVAL
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            done, _ = await asyncio.wait({task}, timeout = min(DISCONNECT_POLL_INTERVAL, remaining))
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+async def ingest_images(images):
+    # images are normalized in the process pool, a 503 when too many are waiting for it
+    try:
+        with metrics.span("images"):
+            digests = await chatgpt.aingest_images(images)
+        metrics.request_images.observe(len(digests))
+        return digests
+    except UnknownImage as e:
+        raise HTTPException(status_code = 404, detail = f"Unknown image {e.args[0]}")
+    except InvalidImage as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    except Saturated as e:
+        raise HTTPException(status_code = 503, detail = str(e), headers = {"Retry-After": "1"})
+
+async def ingest_uploads(uploads):
+    # multipart parts are read chunk by chunk and their buffers stored as is
+    digests = []
+    try:
+        with metrics.span("images"):
+            for upload in uploads or []:
+                data, mime = await read_image_upload(upload)
+                await upload.close()
+                digests.append(await chatgpt.aingest_image_bytes(data, mime))
+    except InvalidImage as e:
+        chatgpt.release_images(digests)
+        raise HTTPException(status_code = 400, detail = str(e))
+    except Saturated as e:
+        chatgpt.release_images(digests)
+        raise HTTPException(status_code = 503, detail = str(e), headers = {"Retry-After": "1"})
+    metrics.request_images.observe(len(digests))
+    return digests
+
+async def lookup_cache(session, text, digests, bypass_cache = False):
+    # returns (cache key, cached answer or None), image hashing runs off the event loop
+    with metrics.span("cache"):
+        if bypass_cache:
+            return await run_in_threadpool(chatgpt.cache_key, session, text, digests), None
+        return await run_in_threadpool(chatgpt.cached_response, session, text, digests)
+
+async def acquire_slot():
+    try:
+        with metrics.span("queue"):
+            return await limiter.acquire()
+    except Saturated as e:
+        raise HTTPException(status_code = 503, detail = str(e), headers = {"Retry-After": "1"})
+
+def rate_limited(e):
+    # a busy upstream is a 429 telling when to come back, not a failure
+    detail = f"{e} (about {math.ceil(e.retry_after)} s" + (f", position {e.position})" if e.position else ")")
+    return HTTPException(status_code = 429, detail = detail, headers = {"Retry-After": str(math.ceil(e.retry_after))})
+
+def check_upstream_budget(priority):
+    # turns the request away before any work when its wait would be too long
+    wait = chatgpt.scheduler.estimate_wait(priority = priority)
+    if wait > chatgpt.scheduler.max_wait:
+        raise rate_limited(RateLimited("The upstream is busy, try again later", wait))
+
+async def generate_reply(session, input_data, cache_key, priority):
+    # upstream call bounded by the upstream budget then the in-flight limit, returns
+    # (answer, trimmed tokens). identical requests in flight share one call, and its errors
+    async def reply():
+        messages, trimmed_tokens, prompt_tokens = await chatgpt.abuild_messages(session, input_data)
+        # the slot is only taken once the scheduler lets the call go
+        served = {}
+        response_text = await chatgpt.achat_with_gpt(messages, priority, prompt_tokens, admit = acquire_slot,
+                                                     served = served)
+        chatgpt.cache_response(cache_key, response_text, served.get("model"))
+        return response_text, trimmed_tokens
+
+    return await chatgpt.inflight.run(chatgpt.request_key(session, input_data), reply)
 
 @app.post("/chatGPT")
-def chatGPT(user_input: ChatInput):
+async def chatGPT(user_input: ChatInput, request: Request):
+    metrics.record_since_start("parse")
+    # store the images once, the request holds a reference on them until it is answered
+    digests = await ingest_images(user_input.images)
+    return await answer_turn(request, user_input, digests)
+
+@app.post("/chatGPT/upload")
+async def chatGPT_upload(request: Request, text: Optional[str] = Form(None), session_id: Optional[str] = Form(None),
+                         bypass_cache: bool = Form(False), priority: Priority = Form("interactive"),
+                         images: List[UploadFile] = File(None)):
+    # same as /chatGPT with the screenshots sent as binary multipart parts
+    metrics.record_since_start("parse")
+    user_input = ChatInput(session_id = session_id, text = text, bypass_cache = bypass_cache, priority = priority)
+    digests = await ingest_uploads(images)
+    return await answer_turn(request, user_input, digests)
+
+async def answer_turn(request, user_input, digests):
+    # takes over the references held on digests
+    # each client carries its own session id, unknown ids start a new conversation
+    session = None
+    try:
+        session = await get_session(user_input.session_id)
+
+        # put input received from the front to the right format
+        input_data = chatgpt.format_input(user_input.text, digests)
+
+        # the same question on a near identical screenshot is answered from the cache
+        cache_key, cached = await lookup_cache(session, user_input.text, digests, user_input.bypass_cache)
+        if cached is not None:
+            chatgpt.construct_history(session, input = input_data, previous_output = cached)
+            return {"response": cached, "session_id": session.session_id, "trimmed_tokens": 0, "cached": True}
+
+        # get gpt response
+        check_upstream_budget(user_input.priority)
+        try:
+            response_text, trimmed_tokens = await run_until_disconnected(
+                request, generate_reply(session, input_data, cache_key, user_input.priority))
+        except RateLimited as e:
+            raise rate_limited(e)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code = 504, detail = "Upstream timed out")
+        except ClientDisconnected:
+            # nobody is listening anymore, the upstream call has been cancelled
+            return Response(status_code = 499)
+
+        # add the turn to the session history
+        chatgpt.construct_history(session, input = input_data, previous_output = response_text)
+    finally:
+        chatgpt.release_images(digests)
+        if session is not None:
+            release_session(session)
+    return {"response":response_text, "session_id": session.session_id, "trimmed_tokens": trimmed_tokens, "cached": False}
+
+def sse_event(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+def stage_timings(timing):
+    # stage durations in ms for the final stream event, streamed responses send
+    # their Server-Timing header before most stages have run
+    return timing.as_dict() if timing is not None else {}
+
+@app.post("/chatGPT/stream")
+async def chatGPT_stream(user_input: ChatInput):
+    metrics.record_since_start("parse")
+    digests = await ingest_images(user_input.images)
+    return await stream_turn(user_input, digests)
+
+@app.post("/chatGPT/upload/stream")
+async def chatGPT_upload_stream(text: Optional[str] = Form(None), session_id: Optional[str] = Form(None),
+                                bypass_cache: bool = Form(False), priority: Priority = Form("interactive"),
+                                images: List[UploadFile] = File(None)):
+    metrics.record_since_start("parse")
+    user_input = ChatInput(session_id = session_id, text = text, bypass_cache = bypass_cache, priority = priority)
+    digests = await ingest_uploads(images)
+    return await stream_turn(user_input, digests)
+
+async def stream_turn(user_input, digests):
+    # takes over the references held on digests, they are released once the stream ends
+
+    input_data = chatgpt.format_input(user_input.text, digests)
+    timing = metrics.current_timing()
+
+    async def upstream(info):
+        # one upstream call shared by the identical streams in flight, with the
+        # queue statuses while it waits for the upstream budget
+        messages, info["trimmed_tokens"], prompt_tokens = await chatgpt.abuild_messages(session, input_data)
+        async for delta in chatgpt.astream_chat_with_gpt(messages, user_input.priority, prompt_tokens,
+                                                         admit = acquire_slot, served = info):
+            yield delta
+
+    session = subscription = None
+
+    @run_once
+    def cleanup():
+        chatgpt.release_images(digests)
+        if session is not None:
+            release_session(session)
+        if subscription is not None:
+            subscription.close()
+
+    async def finish():
+        cleanup()
+
+    try:
+        session = await get_session(user_input.session_id)
+        cache_key, cached = await lookup_cache(session, user_input.text, digests, user_input.bypass_cache)
+        if cached is None:
+            key = chatgpt.request_key(session, input_data)
+            if not chatgpt.inflight.active(key):
+                # checked before answering so a saturated server still returns a real 503,
+                # the slot itself is taken once the scheduler lets the call go. joining an
+                # identical stream in flight takes none.
+                check_upstream_budget(user_input.priority)
+                if limiter.saturated():
+                    raise HTTPException(status_code = 503, detail = "Too many requests in flight",
+                                        headers = {"Retry-After": "1"})
+            subscription = chatgpt.inflight.stream(key, upstream)
+    except BaseException:
+        cleanup()
+        raise
+
+    def cached_stream():
+        try:
+            chatgpt.construct_history(session, input = input_data, previous_output = cached)
+            yield sse_event({"delta": cached})
+            yield sse_event({"done": True, "session_id": session.session_id, "trimmed_tokens": 0, "cached": True,
+                             "timings": stage_timings(timing)})
+        finally:
+            cleanup()
+
+    async def event_stream():
+        # forward each upstream delta as a server-sent event as soon as it arrives,
+        # starlette cancels this generator when the client disconnects
+        chunks = []
+        deadline = time.monotonic() + UPSTREAM_TIMEOUT
+        try:
+            try:
+                async for delta in subscription:
+                    if isinstance(delta, QueueStatus):
+                        # the upstream deadline starts once the call is admitted
+                        deadline = time.monotonic() + UPSTREAM_TIMEOUT
+                        yield sse_event({"queued": delta.as_dict()})
+                        continue
+                    chunks.append(delta)
+                    yield sse_event({"delta": delta})
+                    if time.monotonic() > deadline:
+                        raise asyncio.TimeoutError()
+            except asyncio.TimeoutError:
+                yield sse_event({"error": "Upstream timed out"})
+                return
+            except RateLimited as e:
+                yield sse_event({"error": str(e), "retry_after": math.ceil(e.retry_after)})
+                return
+            except HTTPException as e:
+                # no in-flight slot once the scheduler let the call go
+                yield sse_event({"error": e.detail, "retry_after": int((e.headers or {}).get("Retry-After", 1))})
+                return
+            except Exception as e:
+                logging.exception("Streaming from upstream failed")
+                yield sse_event({"error": str(e)})
+                return
+            trimmed_tokens = subscription.info.get("trimmed_tokens", 0)
+
+            # the turn is only recorded once the whole answer has been received
+            response_text = "".join(chunks)
+            chatgpt.cache_response(cache_key, response_text, subscription.info.get("model"))
+            chatgpt.construct_history(session, input = input_data, previous_output = response_text)
+            yield sse_event({"done": True, "session_id": session.session_id, "trimmed_tokens": trimmed_tokens, "cached": False,
+                             "timings": stage_timings(timing)})
+        finally:
+            # the history holds its own references once the turn is recorded
+            cleanup()
+
+    return StreamingResponse(event_stream() if cached is None else cached_stream(), media_type = "text/event-stream",
+                             headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background = BackgroundTask(finish))
+
+async def answer_batch_item(session, item, bypass_cache, priority, parallelism, held):
+    # one independent question of a batch, returns (result, input to record or None),
+    # failures are reported in the result. The images stay held until the batch is recorded.
+    try:
+        digests = await ingest_images(item.images)
+    except HTTPException as e:
+        return {"error": e.detail, "status": e.status_code}, None
+    held.extend(digests)
+    try:
+        input_data = chatgpt.format_input(item.text, digests)
+        cache_key, cached = await lookup_cache(session, item.text, digests, bypass_cache)
+        if cached is not None:
+            return {"response": cached, "trimmed_tokens": 0, "cached": True}, input_data
+        async with parallelism:
+            response_text, trimmed_tokens = await asyncio.wait_for(
+                generate_reply(session, input_data, cache_key, priority), UPSTREAM_TIMEOUT + chatgpt.scheduler.max_wait)
+        return {"response": response_text, "trimmed_tokens": trimmed_tokens, "cached": False}, input_data
+    except HTTPException as e:
+        return {"error": e.detail, "status": e.status_code}, None
+    except RateLimited as e:
+        return {"error": str(e), "status": 429, "retry_after": math.ceil(e.retry_after)}, None
+    except asyncio.TimeoutError:
+        return {"error": "Upstream timed out", "status": 504}, None
+    except Exception as e:
+        logging.exception("Batch item failed")
+        return {"error": str(e), "status": 502}, None
+
+def record_batch(session, answers):
+    # items are answered independently, they enter the history in item order once all are done
+    for index in sorted(answers):
+        result, input_data = answers[index]
+        if input_data is not None:
+            chatgpt.construct_history(session, input = input_data, previous_output = result["response"])
+
+@app.post("/chatGPT/batch")
+async def chatGPT_batch(batch: BatchInput, request: Request):
+    # answers every item concurrently against the same session context, at most
+    # BATCH_PARALLELISM upstream calls at a time for this batch. Each item has its
+    # own deadline and reports its timeout, the batch as a whole has none.
+    metrics.record_since_start("parse")
+    if len(batch.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code = 413, detail = f"At most {MAX_BATCH_ITEMS} items per batch")
+
+    session = await get_session(batch.session_id)
+    parallelism = asyncio.Semaphore(BATCH_PARALLELISM)
+    held = []
+    timing = metrics.current_timing()
+
+    async def answer(index, item):
+        return index, await answer_batch_item(session, item, batch.bypass_cache, batch.priority, parallelism, held)
+
+    if not batch.stream:
+        try:
+            answers = dict(await run_until_disconnected(
+                request, asyncio.gather(*[answer(index, item) for index, item in enumerate(batch.items)]),
+                timeout = None))
+            record_batch(session, answers)
+        except ClientDisconnected:
+            return Response(status_code = 499)
+        finally:
+            chatgpt.release_images(held)
+            release_session(session)
+        return {"session_id": session.session_id,
+                "results": [{"index": index, **answers[index][0]} for index in sorted(answers)]}
+
+    @run_once
+    def cleanup():
+        chatgpt.release_images(held)
+        release_session(session)
+
+    async def finish():
+        cleanup()
+
+    async def event_stream():
+        # one event per item as soon as it is answered, then a final done event
+        tasks = [asyncio.ensure_future(answer(index, item)) for index, item in enumerate(batch.items)]
+        answers = {}
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, answer_data = await next_done
+                answers[index] = answer_data
+                yield sse_event({"index": index, **answer_data[0]})
+            record_batch(session, answers)
+            yield sse_event({"done": True, "session_id": session.session_id, "timings": stage_timings(timing)})
+        finally:
+            for task in tasks:
+                task.cancel()
+            cleanup()
+
+    return StreamingResponse(event_stream(), media_type = "text/event-stream",
+                             headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background = BackgroundTask(finish))
+
+@app.post("/images")
+async def upload_images(upload: ImageUpload):
+    # store images ahead of time, chat requests can then reference them as "sha256:<digest>"
+    digests = await ingest_images(upload.images)
+    chatgpt.release_images(digests)
+    return {"images": [IMAGE_REF_PREFIX + digest for digest in digests]}
+
+@app.get("/health")
+async def health():
+    return {"limiter": limiter.stats(), "sessions": chatgpt.session_manager.stats(),
+            "images": chatgpt.image_store.stats(), "cache": chatgpt.response_cache.stats(),
+            "backends": chatgpt.router.stats(), "scheduler": chatgpt.scheduler.stats()}
 
-    # put input received from the front to the right format
-    input_data = chatgpt.format_input(user_input.text, user_input.images)
+@app.get("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape endpoint, the component figures are read at scrape time
+    components = [("limiter", limiter.stats()), ("sessions", chatgpt.session_manager.stats()),
+                  ("images", chatgpt.image_store.stats()), ("cache", chatgpt.response_cache.stats()),
+                  ("inflight", chatgpt.inflight.stats()), ("scheduler", chatgpt.scheduler.stats())]
+    if chatgpt.normalizer is not None:
+        components.append(("normalizer", chatgpt.normalizer.stats()))
+    components.extend((f"backend:{name}", stats) for name, stats in chatgpt.router.stats().items())
+    for component, stats in components:
+        for stat, value in stats.items():
+            metrics.state.set(value, component = component, stat = stat)
+    return PlainTextResponse(metrics.registry.render(), media_type = "text/plain; version=0.0.4")
 
-    # get gpt response
-    response_text = chatgpt.chat_with_gpt(input_data)
+@app.get("/sessions/{session_id}/messages")
+def session_messages(session_id: str, before: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE):
+    # stored conversation newest first, one page at a time: pass next_before as
+    # before to get the older page, it is null on the oldest one
+    messages, next_before = chatgpt.history_page(session_id, before, limit)
+    return {"session_id": session_id, "messages": messages, "next_before": next_before}
 
-    # add message to the chat history
-    chatgpt.construct_history(previous_output = response_text)
-    return {"response":response_text}
+@app.get("/images/{digest}")
+def get_image(digest: str, max_size: Optional[int] = None):
+    # raw image, or a JPEG preview fit in max_size x max_size
+    image = chatgpt.find_image(digest)
+    if image is None:
+        raise HTTPException(status_code = 404, detail = "Unknown image")
+    data, mime = image
+    if max_size:
+        data, mime = make_thumbnail(data, max(16, min(max_size, 1024))), "image/jpeg"
+    return Response(content = bytes(data), media_type = mime, headers = {"Cache-Control": "max-age=31536000, immutable"})
 
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    if not chatgpt.session_manager.drop(session_id):
+        raise HTTPException(status_code = 404, detail = "Unknown session")
+    return {"deleted": session_id}
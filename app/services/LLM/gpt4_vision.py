@@ -1,14 +1,47 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
+import asyncio
+import httpx
 import os 
 from decouple import config 
 import logging 
+import time
+import hashlib
+import json
+from app.services.session.session_manager import SessionManager
+from app.services.images.image_store import (ImageStore, UnknownImage, IMAGE_REF_PREFIX, image_refs, is_image_ref,
+                                             parse_data_url)
+from app.services.images.normalize import ImageNormalizer, NORMALIZE_IMAGES
+from app.services.LLM.history import HistoryManager, text_tokens, image_tokens
+from app.services.LLM.singleflight import SingleFlight
+from app.services.LLM.router import BackendRouter, Backend, build_backends, LLM_BACKENDS
+from app.services.LLM.scheduler import UpstreamScheduler, QueueStatus, INTERACTIVE
+from app.services.cache.response_cache import ResponseCache, make_bucket, PERCEPTUAL_CACHE, SHARE_RESPONSE_CACHE
+from app.services.metrics import metrics
+from app.db.conversation_store import ConversationStore, DATABASE_PATH, HISTORY_PAGE_SIZE, RESTORE_MESSAGES
 
 api_key = config("OPEN_API_KEY")
-client = OpenAI(api_key = api_key)
+UPSTREAM_TIMEOUT = config("UPSTREAM_TIMEOUT", default = 120, cast = float)
+UPSTREAM_MAX_CONNECTIONS = config("UPSTREAM_MAX_CONNECTIONS", default = 256, cast = int)
+UPSTREAM_MAX_KEEPALIVE = config("UPSTREAM_MAX_KEEPALIVE", default = 64, cast = int)
+# Another OpenAI compatible endpoint, e.g. the mock server of the benchmarks
+OPENAI_BASE_URL = config("OPENAI_BASE_URL", default = "") or None
+
+# One keep-alive connection pool shared by every async request
+http_client = httpx.AsyncClient(
+    limits = httpx.Limits(max_connections = UPSTREAM_MAX_CONNECTIONS, max_keepalive_connections = UPSTREAM_MAX_KEEPALIVE),
+    timeout = httpx.Timeout(UPSTREAM_TIMEOUT, connect = 10.0)
+)
+async_client = AsyncOpenAI(api_key = api_key, base_url = OPENAI_BASE_URL, http_client = http_client,
+                           timeout = UPSTREAM_TIMEOUT)
+DEFAULT_MODEL = 'gpt-4-vision-preview'
+# Every async upstream call goes through the router, see LLM_BACKENDS
+router = BackendRouter(build_backends(LLM_BACKENDS, http_client, api_key, OPENAI_BASE_URL, DEFAULT_MODEL,
+                                      UPSTREAM_TIMEOUT, default_client = async_client))
 
 class ChatGPT:
-    def __init__(self, client, base_context = None, model = 'gpt-4-vision-preview'):
-        self.client = client if client is not None else OpenAI(api_key = api_key)
+    def __init__(self, base_context = None, model = DEFAULT_MODEL, async_client = None,
+                 database_path = DATABASE_PATH, router = None):
+        self.async_client = async_client if async_client is not None else AsyncOpenAI(api_key = api_key, base_url = OPENAI_BASE_URL)
 
         if base_context is None:
             self.base_context = """You are a helpful assistant. 
@@ -21,46 +54,369 @@ class ChatGPT:
         else:
             self.base_context = base_context 
 
-        self.chat_history = [{"role": "system", "content": self.base_context}]
-        self.model = model
+        # Calls are routed across the backends, the first one names the model in the
+        # cache and request keys. Answers another backend gave are not cached under it.
+        self.router = router if router is not None else BackendRouter([Backend(model, self.async_client, model)])
+        self.model = self.router.model
+        self.temperature = 0
+        self.max_tokens = 600
+        # Once persisted, the images of live sessions can leave memory, they are read back on use
+        self.image_store = ImageStore(load = self.load_image_bytes if database_path else None)
+        # Uploads are decoded, resized and re-encoded compactly before being stored
+        self.normalizer = ImageNormalizer() if NORMALIZE_IMAGES else None
+        self.history_manager = HistoryManager(self.image_store)
+        # temperature is 0 so identical questions get answers worth reusing
+        self.response_cache = ResponseCache()
+        # Identical requests arriving together share one upstream call
+        self.inflight = SingleFlight()
+        # Upstream calls wait for the requests and tokens per minute of the account, by priority
+        self.scheduler = UpstreamScheduler()
+        # Turns are written to SQLite in the background, sessions that left memory
+        # (idle, evicted, restarted server) are resumed from it
+        self.conversation_store = ConversationStore(database_path) if database_path else None
+        self.session_manager = SessionManager(self.base_context,
+                                              on_append = self.image_store.retain_messages,
+                                              on_discard = self.image_store.release_messages,
+                                              on_record = self.persist_turn,
+                                              on_drop = self.forget_session,
+                                              load_history = self.load_history)
 
     
+    async def aingest_images(self, images = None):
+        # Store the images once and return their digests, the caller holds a
+        # reference on each of them until release_images
+        digests = []
+        try:
+            for image in images or []:
+                if is_image_ref(image):
+                    digests.append(self.image_store.put(image, retain = True))
+                else:
+                    mime, data = parse_data_url(image)
+                    digests.append(await self.aingest_image_bytes(data, mime))
+        except BaseException:
+            self.release_images(digests)
+            raise
+        return digests
+
+    async def aingest_image_bytes(self, data, mime):
+        # Same as aingest_images for raw bytes. The image is normalized in the
+        # process pool, unless this exact input was normalized before.
+        if self.normalizer is None:
+            return self.image_store.put_bytes(data, mime, retain = True)
+        source_digest = hashlib.sha256(data).hexdigest()
+        digest = self.normalizer.known(source_digest)
+        if digest is not None:
+            try:
+                return self.image_store.put(IMAGE_REF_PREFIX + digest, retain = True)
+            except UnknownImage:
+                pass  # Evicted from the store since, normalized again
+        with metrics.span("normalize"):
+            data, mime, _, _ = await self.normalizer.normalize(source_digest, data)
+        digest = self.image_store.put_bytes(data, mime, retain = True)
+        self.normalizer.remember(source_digest, digest)
+        return digest
+
+    def release_images(self, digests):
+        self.image_store.release(digests)
+
+    def persist_turn(self, session_id, messages):
+        # Called under the session lock, it only queues the writes
+        store = self.conversation_store
+        if store is None:
+            return
+        saved = []
+        for message in messages:
+            for digest in image_refs(message):
+                try:
+                    image = self.image_store.get(digest, load = False)
+                except UnknownImage:
+                    continue
+                if not image.persisted:
+                    store.save_image(digest, image.mime, image.width, image.height, image.data)
+                    saved.append(digest)
+        store.append_messages(session_id, messages)
+        self.image_store.mark_persisted(saved)
+
+    def load_image_bytes(self, digest):
+        # Bytes of a persisted image for the image store, the write may still be queued
+        store = self.conversation_store
+        row = store.load_image(digest)
+        if row is None and store.flush(timeout = 1.0):
+            row = store.load_image(digest)
+        return row[0] if row is not None else None
+
+    def load_history(self, session_id):
+        # The latest turns of a stored session, their images are loaded back
+        # into the image store. Older turns stay on disk.
+        store = self.conversation_store
+        if store is None:
+            return None
+        store.flush(timeout = 1.0)  # Turns of this session may still be queued
+        messages = store.recent_messages(session_id, RESTORE_MESSAGES)
+        while messages and messages[0]["role"] != "user":
+            messages.pop(0)
+        for digest in {digest for message in messages for digest in image_refs(message)}:
+            self.find_image(digest)
+        return messages
+
+    def find_image(self, digest):
+        # (data, mime) of an image in memory or in storage, stored images are
+        # cached back in memory. None when it is unknown.
+        try:
+            image = self.image_store.get(digest)
+            return image.data, image.mime
+        except UnknownImage:
+            pass
+        row = self.conversation_store.load_image(digest) if self.conversation_store is not None else None
+        if row is None:
+            return None
+        data, mime, _, _ = row
+        self.image_store.put_bytes(data, mime)
+        return data, mime
+
+    def forget_session(self, session_id):
+        # True when the session had stored turns. Its images go too, unless a
+        # request or another session still uses them.
+        store = self.conversation_store
+        if store is None:
+            return False
+        store.flush(timeout = 1.0)
+        existed = store.has_session(session_id)
+        store.delete_session(session_id, self.image_store.discard(store.session_images(session_id)))
+        return existed
+
+    def history_page(self, session_id, before = None, limit = HISTORY_PAGE_SIZE):
+        # One page of a stored conversation for display, newest first. Returns
+        # (messages, cursor of the next older page or None).
+        store = self.conversation_store
+        if store is None:
+            return [], None
+        store.flush(timeout = 1.0)
+        rows, next_before = store.page(session_id, before, limit)
+        messages = []
+        for row in rows:
+            content = row["content"]
+            if isinstance(content, list):
+                text = "\n".join(item["text"] for item in content if item.get("type") == "text")
+            else:
+                text = content or ""
+            messages.append({"id": row["id"], "role": "user" if row["role"] == "user" else "assistant",
+                             "text": text, "images": image_refs(row), "created": row["created"]})
+        return messages, next_before
+
+    def close(self):
+        # the queued turns are committed even if stopping the image workers fails
+        try:
+            if self.normalizer is not None:
+                self.normalizer.shutdown()
+        finally:
+            if self.conversation_store is not None:
+                self.conversation_store.close()
+
     def format_input(self, text, images = None):
         input_content = {"role":"user", "content":[]}
 
         # Add text to the input content
         if text:
             input_content["content"].append({"type":"text", "text":text})
-        # Add images to the input content, if any
+        # Add images to the input content as digests, they are resolved to
+        # their payload only when the upstream request is built
         if images:
             input_content["content"].extend(
-                [{"type": "image_url", "image_url": {"url": img}} for img in images]
+                [{"type": "image_ref", "digest": digest} for digest in images]
             )
 
         return input_content
-    def construct_history(self, input = None, previous_output = None):
-        if input: 
-            self.chat_history.append(input)
 
-        if previous_output:
-            self.chat_history.append({"role":"system", "content": previous_output})
+    async def abuild_messages(self, session, input = None):
+        # Fit the session history plus the new input in the token budget, older turns
+        # can be summarized by the model, and resolve the images. Returns (upstream
+        # messages, trimmed tokens, estimated prompt tokens).
+        with metrics.span("history"):
+            messages, trimmed_tokens = await self.history_manager.acompact(session.snapshot(input), summarizer = self.asummarize)
+            prompt_tokens = self.observe_history(messages, trimmed_tokens)
+            if not self.image_store.loaded([digest for message in messages for digest in image_refs(message)]):
+                # Some images are only in storage, read off the event loop
+                resolved = await asyncio.get_running_loop().run_in_executor(None, self.image_store.resolve_messages, messages)
+                return resolved, trimmed_tokens, prompt_tokens
+            return self.image_store.resolve_messages(messages), trimmed_tokens, prompt_tokens
+
+    def observe_history(self, messages, trimmed_tokens):
+        # Returns the estimated prompt tokens, images included
+        prompt_tokens = sum(self.history_manager.message_tokens(message) for message in messages)
+        metrics.history_messages.observe(len(messages))
+        metrics.history_tokens.observe(prompt_tokens)
+        metrics.history_trimmed_tokens.inc(trimmed_tokens)
+        return prompt_tokens
 
+    def request_tokens(self, messages, prompt_tokens = None, max_tokens = None):
+        # What a call counts against the tokens per minute: its prompt plus max_tokens.
+        # Without the estimate of abuild_messages, images are counted at their largest.
+        if prompt_tokens is None:
+            prompt_tokens = 0
+            for message in messages:
+                content = message.get("content")
+                items = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+                prompt_tokens += sum(text_tokens(item["text"]) if item.get("type") == "text" else image_tokens(2048, 2048)
+                                     for item in items)
+        return prompt_tokens + (max_tokens if max_tokens is not None else self.max_tokens)
 
-    def chat_with_gpt(self, input):
-        logging.info("here")
-        self.construct_history(input = input)
-        logging.info("there")
-        response = self.client.chat.completions.create(
-            model = self.model,
-            messages = self.chat_history,
-            temperature = 0,
-            max_tokens = 600
-        )
+    async def asummarize(self, transcript):
+        messages = [
+            {"role": "system", "content": "Summarize the following conversation in a few sentences, keeping every fact the user may refer to later."},
+            {"role": "user", "content": transcript}
+        ]
+        with metrics.span("summary"):
+            # Part of answering a question, it waits with the interactive calls
+            response = await self.scheduler.run(self.request_tokens(messages, max_tokens = 300), INTERACTIVE,
+                                                lambda extra_attempts: self.router.complete(
+                                                    extra_attempts, messages = messages, temperature = 0,
+                                                    max_tokens = 300))
+        self.record_usage(response)
 
         return response.choices[0].message.content
 
+    def cache_key(self, session, text, digests):
+        # Exact part (prompt, history so far, model params) and the new images: their
+        # digests, or their perceptual hashes with PERCEPTUAL_CACHE. None when an image
+        # cannot be hashed. Like in-flight requests, exact matches are shared between
+        # sessions, their senders have the very same inputs. A perceptual match may be
+        # someone else's screen, it stays within the session.
+        images = list(digests)
+        scope = None
+        if PERCEPTUAL_CACHE:
+            try:
+                images = [self.image_store.phash(digest) for digest in digests]
+            except Exception:
+                logging.warning("Could not hash images, skipping the response cache")
+                return None
+            scope = None if SHARE_RESPONSE_CACHE else session.session_id
+        return make_bucket(text, session.snapshot(), self.upstream_params(), scope), images
+
+    def upstream_params(self):
+        return {"model": self.model, "temperature": self.temperature, "max_tokens": self.max_tokens}
+
+    def request_key(self, session, input = None):
+        # Identical upstream requests have the same history, input (images by
+        # digest) and model params, whichever session they come from
+        payload = json.dumps({"messages": session.snapshot(input), "params": self.upstream_params()},
+                             sort_keys = True, ensure_ascii = False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def cached_response(self, session, text, digests):
+        # Returns (cache key, cached answer or None)
+        key = self.cache_key(session, text, digests)
+        if key is None:
+            return None, None
+        return key, self.response_cache.get(*key)
+
+    def cache_response(self, key, response_text, model = None):
+        # model answered, the key holds the primary one: a fallback's answer is not cached
+        if key is not None and (model is None or model == self.model):
+            self.response_cache.put(*key, response_text)
+
+    def construct_history(self, session, input = None, previous_output = None):
+        # Each session owns its history, the manager keeps the memory budgets
+        self.session_manager.record_turn(session, input = input, previous_output = previous_output)
+
+
+    async def achat_with_gpt(self, messages, priority = INTERACTIVE, prompt_tokens = None, admit = None, served = None):
+        # messages come from abuild_messages, the turn is only recorded in the session
+        # once the upstream call succeeded. It does not hold a threadpool worker while
+        # waiting for the scheduler or the upstream. await admit(), when given, returns
+        # an in-flight slot taken once the scheduler lets the call go and released
+        # after it, a call queued on the rate limit holds none. served, when given,
+        # gets the "model" that answered, for cache_response.
+        start = None
+
+        async def complete(extra_attempts):
+            nonlocal start
+            slot = await admit() if admit is not None else None
+            try:
+                start = time.perf_counter()  # The time spent queued is not upstream latency
+                return await self.router.complete(
+                    extra_attempts,
+                    served,
+                    messages = messages,
+                    temperature = self.temperature,
+                    max_tokens = self.max_tokens
+                )
+            finally:
+                if slot is not None:
+                    slot.release()
+
+        try:
+            response = await self.scheduler.run(self.request_tokens(messages, prompt_tokens), priority, complete)
+        except Exception as e:
+            metrics.upstream_errors.inc(error = e.__class__.__name__)
+            raise
+        finally:
+            if start is not None:
+                self.record_upstream("complete", time.perf_counter() - start)
+        self.record_usage(response)
+
+        return response.choices[0].message.content
+
+    async def astream_chat_with_gpt(self, messages, priority = INTERACTIVE, prompt_tokens = None, admit = None,
+                                    served = None):
+        # Yields the text deltas, and a QueueStatus now and then while the call
+        # waits for the upstream budget. admit and served as in achat_with_gpt, the
+        # slot is held until the stream ends.
+        start = None
+        first_token = True
+
+        async def open_stream(extra_attempts):
+            nonlocal start
+            slot = await admit() if admit is not None else None
+            try:
+                start = time.perf_counter()
+                chunks = self.router.stream(
+                    extra_attempts,
+                    served,
+                    messages = messages,
+                    temperature = self.temperature,
+                    max_tokens = self.max_tokens
+                )
+                try:
+                    async for chunk in chunks:
+                        yield chunk
+                finally:
+                    await chunks.aclose()
+            finally:
+                if slot is not None:
+                    slot.release()
+
+        try:
+            stream = self.scheduler.stream(self.request_tokens(messages, prompt_tokens), priority, open_stream)
+
+            # Closing the stream when the consumer goes away releases the upstream connection
+            try:
+                async for chunk in stream:
+                    if isinstance(chunk, QueueStatus):
+                        yield chunk
+                    elif chunk.choices and chunk.choices[0].delta.content:
+                        if first_token:
+                            metrics.upstream_first_token_seconds.observe(time.perf_counter() - start)
+                            first_token = False
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.aclose()
+        except Exception as e:
+            metrics.upstream_errors.inc(error = e.__class__.__name__)
+            raise
+        finally:
+            if start is not None:
+                self.record_upstream("stream", time.perf_counter() - start)
+
+    def record_upstream(self, mode, seconds):
+        metrics.upstream_seconds.observe(seconds, mode = mode)
+        metrics.record_stage("upstream", seconds)
+
+    def record_usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            metrics.upstream_tokens.inc(usage.prompt_tokens or 0, kind = "prompt")
+            metrics.upstream_tokens.inc(usage.completion_tokens or 0, kind = "completion")
 
-chatgpt = ChatGPT(client)
-            
 
-        
+chatgpt = ChatGPT(async_client = async_client, router = router)
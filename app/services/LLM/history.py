@@ -0,0 +1,150 @@
+import hashlib
+import json
+import math
+from collections import OrderedDict
+
+from decouple import config
+
+from app.services.images.image_store import UnknownImage
+
+HISTORY_TOKEN_BUDGET = config("HISTORY_TOKEN_BUDGET", default = 16000, cast = int)
+# Images of the last KEEP_IMAGE_TURNS user messages are always sent in full detail
+KEEP_IMAGE_TURNS = config("KEEP_IMAGE_TURNS", default = 2, cast = int)
+SUMMARIZE_HISTORY = config("SUMMARIZE_HISTORY", default = False, cast = bool)
+# When the sliding window moves it goes down to this fraction of the budget, so the
+# dropped prefix (and its summary) stays the same for several turns
+WINDOW_SLACK = config("WINDOW_SLACK", default = 0.75, cast = float)
+MAX_CACHED_SUMMARIES = 256
+
+MESSAGE_OVERHEAD_TOKENS = 4
+LOW_DETAIL_IMAGE_TOKENS = 85
+OMITTED_IMAGE_TEXT = "[earlier screenshot omitted]"
+
+
+def text_tokens(text):
+    # About 4 characters per token for English text, good enough for budgeting
+    return math.ceil(len(text) / 4)
+
+
+def image_tokens(width, height, detail = "auto"):
+    # Vision pricing: the image is fit in 2048x2048, its short side scaled down to
+    # 768, then it costs 170 tokens per 512px tile plus a fixed 85
+    if detail == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 170 * tiles + LOW_DETAIL_IMAGE_TOKENS
+
+
+class HistoryManager:
+    def __init__(self, image_store, budget = HISTORY_TOKEN_BUDGET, keep_image_turns = KEEP_IMAGE_TURNS,
+                 summarize = SUMMARIZE_HISTORY):
+        self.image_store = image_store
+        self.budget = budget
+        self.keep_image_turns = keep_image_turns
+        self.summarize = summarize
+        self.summaries = OrderedDict()
+
+    def item_tokens(self, item):
+        if item.get("type") == "text":
+            return text_tokens(item["text"])
+        if item.get("type") == "image_ref":
+            try:
+                image = self.image_store.get(item["digest"], load = False)
+            except UnknownImage:
+                return 0
+            return image_tokens(image.width, image.height, item.get("detail", "auto"))
+        return 0
+
+    def message_tokens(self, message):
+        content = message.get("content")
+        if isinstance(content, list):
+            return MESSAGE_OVERHEAD_TOKENS + sum(self.item_tokens(item) for item in content)
+        return MESSAGE_OVERHEAD_TOKENS + text_tokens(content or "")
+
+    def compact(self, messages):
+        # Fit messages in the budget, returns (kept messages, dropped messages, trimmed tokens).
+        # messages[0] is the base context and messages[-1] the new input, both are always kept.
+        costs = [self.message_tokens(message) for message in messages]
+        total = sum(costs)
+        original = total
+        if total <= self.budget:
+            return messages, [], 0
+
+        messages = list(messages)
+
+        # 1. Old images first: send them in low detail, then drop them altogether
+        old = self._old_image_messages(messages)
+        for detail in ("low", None):
+            for index in old:
+                if total <= self.budget:
+                    break
+                messages[index] = self._degrade_images(messages[index], detail)
+                new_cost = self.message_tokens(messages[index])
+                total -= costs[index] - new_cost
+                costs[index] = new_cost
+
+        # 2. Then slide the window, dropping the oldest turns
+        dropped = []
+        if total > self.budget:
+            target = self.budget * WINDOW_SLACK
+            while total > target and len(messages) > 2:
+                dropped.append(messages.pop(1))
+                total -= costs.pop(1)
+
+        return messages, dropped, original - total
+
+    async def acompact(self, messages, summarizer = None):
+        # Same as compact, and when enabled the dropped turns are replaced by a summary
+        kept, dropped, trimmed = self.compact(messages)
+        if not dropped or not self.summarize or summarizer is None:
+            return kept, trimmed
+
+        key = hashlib.sha256(json.dumps(dropped, sort_keys = True).encode("utf-8")).hexdigest()
+        summary = self.summaries.get(key)
+        if summary is None:
+            summary = await summarizer(self.transcript(dropped))
+            self.summaries[key] = summary
+            while len(self.summaries) > MAX_CACHED_SUMMARIES:
+                self.summaries.popitem(last = False)
+        else:
+            self.summaries.move_to_end(key)
+
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+        trimmed -= self.message_tokens(summary_message)
+        return [kept[0], summary_message] + kept[1:], max(trimmed, 0)
+
+    def transcript(self, messages):
+        # Text-only rendering of messages, used as input for the summary
+        lines = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list):
+                parts = [item["text"] if item.get("type") == "text" else "[screenshot]" for item in content]
+                content = " ".join(parts)
+            lines.append(f"{message['role']}: {content}")
+        return "\n".join(lines)
+
+    def _old_image_messages(self, messages):
+        # Indexes of messages holding images, oldest first, excluding the recent turns
+        with_images = [index for index, message in enumerate(messages)
+                       if isinstance(message.get("content"), list)
+                       and any(item.get("type") == "image_ref" for item in message["content"])]
+        user_turns = [index for index, message in enumerate(messages) if message["role"] == "user"]
+        recent = user_turns[-self.keep_image_turns:] if self.keep_image_turns > 0 else []
+        first_recent = recent[0] if recent else len(messages)
+        return [index for index in with_images if index < first_recent]
+
+    def _degrade_images(self, message, detail):
+        content = []
+        for item in message["content"]:
+            if item.get("type") != "image_ref":
+                content.append(item)
+            elif detail:
+                content.append({**item, "detail": detail})
+            else:
+                content.append({"type": "text", "text": OMITTED_IMAGE_TEXT})
+        return {**message, "content": content}
@@ -0,0 +1,78 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from decouple import config
+
+MAX_IN_FLIGHT = config("MAX_IN_FLIGHT", default = 256, cast = int)
+MAX_QUEUED = config("MAX_QUEUED", default = 512, cast = int)
+QUEUE_TIMEOUT = config("QUEUE_TIMEOUT", default = 10, cast = float)
+
+
+class Saturated(Exception):
+    pass
+
+
+class Slot:
+    # Handle on an acquired slot, release is idempotent so it can be called
+    # from every exit path of a streaming response
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter._release()
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_in_flight = MAX_IN_FLIGHT, max_queued = MAX_QUEUED, queue_timeout = QUEUE_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created lazily so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    def saturated(self):
+        # acquire would fail right away
+        return self.in_flight >= self.max_in_flight and self.queued >= self.max_queued
+
+    async def acquire(self):
+        # Fail fast when the queue is already full instead of piling up requests
+        if self.saturated():
+            raise Saturated("Too many requests in flight")
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout = self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Saturated("Timed out waiting for a free slot")
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        return Slot(self)
+
+    def _release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        slot = await self.acquire()
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "queued": self.queued,
+                "max_in_flight": self.max_in_flight, "max_queued": self.max_queued}
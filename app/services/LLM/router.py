@@ -0,0 +1,296 @@
+import asyncio
+import json
+import math
+import time
+from collections import deque
+
+import openai
+from decouple import config
+from openai import AsyncOpenAI
+
+from app.services.metrics import metrics
+
+# Ordered upstreams, the first healthy one is preferred, e.g.
+# [{"model": "gpt-4-vision-preview"}, {"name": "backup", "model": "gpt-4o", "base_url": "http://...", "api_key": "..."}]
+# Empty: a single backend, OPENAI_BASE_URL with the default model
+LLM_BACKENDS = config("LLM_BACKENDS", default = "[]", cast = json.loads)
+# With several backends, a second request goes to the next one when the first is
+# slower than this percentile of its backend's recent latencies, 0 disables hedging
+HEDGE_PERCENTILE = config("HEDGE_PERCENTILE", default = 95, cast = float)
+# Hedge on the same backend when it is the only one, a second billed call to it
+HEDGE_SAME_BACKEND = config("HEDGE_SAME_BACKEND", default = False, cast = bool)
+HEDGE_DEFAULT_DELAY = config("HEDGE_DEFAULT_DELAY", default = 10, cast = float)  # Until enough latencies are known
+HEDGE_BUDGET = config("HEDGE_BUDGET", default = 0.1, cast = float)  # Hedged requests per request at most
+BACKEND_FAILURE_THRESHOLD = config("BACKEND_FAILURE_THRESHOLD", default = 3, cast = int)
+BACKEND_COOLDOWN = config("BACKEND_COOLDOWN", default = 5, cast = float)  # Doubled while the failures go on
+MAX_BACKEND_COOLDOWN = 120
+HEDGE_MIN_DELAY = 0.25
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BURST = 10  # Hedges that can be saved up while the upstream is fast
+LATENCY_WINDOW = 200  # Latest latencies kept per backend and mode
+SLOW_FACTOR = 2.0  # A backend this many times slower than the fastest one loses its rank
+
+backend_requests = metrics.registry.counter("backend_requests_total", "Upstream attempts by backend and outcome",
+                                            ("backend", "outcome"))
+backend_seconds = metrics.registry.histogram("backend_seconds",
+                                             "Latency of the successful attempts, to the first token for streams",
+                                             ("backend", "mode"))
+hedged_requests = metrics.registry.counter("hedged_requests_total", "Second requests sent because the first was slow",
+                                           ("backend",))
+fallback_requests = metrics.registry.counter("fallback_requests_total", "Requests retried on the next backend after an error",
+                                             ("backend",))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def retryable(error):
+    # Errors another backend may not have: connection, timeout, rate limit, 5xx.
+    # A bad request would fail everywhere.
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class Backend:
+    def __init__(self, name, client, model):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.latencies = {"complete": deque(maxlen = LATENCY_WINDOW), "stream": deque(maxlen = LATENCY_WINDOW)}
+        self.failures = 0  # Consecutive
+        self.unavailable_until = 0.0
+
+    def healthy(self):
+        return time.monotonic() >= self.unavailable_until
+
+    def typical_latency(self, mode):
+        latencies = self.latencies[mode]
+        return percentile(latencies, 50) if latencies else None
+
+    def record_success(self, mode, seconds):
+        self.latencies[mode].append(seconds)
+        self.failures = 0
+        self.unavailable_until = 0.0
+        backend_requests.inc(backend = self.name, outcome = "ok")
+        backend_seconds.observe(seconds, backend = self.name, mode = mode)
+
+    def record_failure(self, error):
+        backend_requests.inc(backend = self.name, outcome = "error")
+        if not retryable(error):
+            return  # The request was at fault, not the backend
+        self.failures += 1
+        if self.failures >= BACKEND_FAILURE_THRESHOLD:
+            # Left alone for a while, then tried again by the next request
+            cooldown = min(MAX_BACKEND_COOLDOWN, BACKEND_COOLDOWN * 2 ** (self.failures - BACKEND_FAILURE_THRESHOLD))
+            self.unavailable_until = time.monotonic() + cooldown
+
+    def stats(self):
+        stats = {"healthy": int(self.healthy()), "failures": self.failures}
+        for mode, latencies in self.latencies.items():
+            if latencies:
+                stats[f"{mode}_p50_seconds"] = percentile(latencies, 50)
+                stats[f"{mode}_p95_seconds"] = percentile(latencies, 95)
+        return stats
+
+
+class OpenedStream:
+    # A streamed completion whose first content chunk has arrived
+    def __init__(self, stream, chunks, received):
+        self.stream = stream
+        self.chunks = chunks
+        self.received = received
+
+    async def close(self):
+        await self.stream.close()
+
+
+class BackendRouter:
+    # Sends each upstream call to the best backend: healthy ones in the configured
+    # order, much slower ones last. When the answer (or its first token) takes
+    # longer than usual a hedged request goes to the next backend and the first
+    # good answer wins, the other one is cancelled. Errors a backend may not share
+    # fall back to the next one.
+    def __init__(self, backends, hedge_percentile = HEDGE_PERCENTILE, hedge_budget = HEDGE_BUDGET,
+                 hedge_same_backend = HEDGE_SAME_BACKEND):
+        if not backends:
+            raise ValueError("At least one backend is needed")
+        self.backends = backends
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_same_backend = hedge_same_backend
+        self.hedge_tokens = 1.0
+
+    @property
+    def model(self):
+        return self.backends[0].model
+
+    def candidates(self, mode):
+        # Best first. Unhealthy backends stay as a last resort rather than failing outright.
+        healthy = [backend for backend in self.backends if backend.healthy()]
+        known = [backend.typical_latency(mode) for backend in healthy]
+        fastest = min((latency for latency in known if latency is not None), default = None)
+        if fastest is not None:
+            slow = lambda latency: latency is not None and latency > SLOW_FACTOR * fastest
+            healthy = ([backend for backend, latency in zip(healthy, known) if not slow(latency)]
+                       + [backend for backend, latency in zip(healthy, known) if slow(latency)])
+        resting = sorted((backend for backend in self.backends if not backend.healthy()),
+                         key = lambda backend: backend.unavailable_until)
+        return healthy + resting
+
+    def hedge_delay(self, backend, mode):
+        if not self.hedge_percentile or (len(self.backends) < 2 and not self.hedge_same_backend):
+            return None
+        latencies = backend.latencies[mode]
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY or None
+        return max(HEDGE_MIN_DELAY, percentile(latencies, self.hedge_percentile))
+
+    def take_hedge(self):
+        # Hedges are limited to a share of the traffic, a slow upstream is not
+        # sent twice the load
+        if self.hedge_tokens >= 1.0:
+            self.hedge_tokens -= 1.0
+            return True
+        return False
+
+    async def _race(self, mode, attempt, discard = None, extra_attempts = None, served = None):
+        # Result of the first successful attempt. extra_attempts, when given, charges
+        # the hedges and fallbacks against the upstream budgets (UpstreamScheduler).
+        # served, when given, gets the "model" that answered.
+        candidates = self.candidates(mode)
+        primary, fallbacks = candidates[0], candidates[1:]
+        self.hedge_tokens = min(HEDGE_BURST, self.hedge_tokens + self.hedge_budget)
+        hedge_delay = self.hedge_delay(primary, mode)
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay is not None else None
+        attempts = []
+        backends = {}
+        errors = []
+
+        def launch(backend):
+            task = asyncio.ensure_future(attempt(backend))
+            # Failures of cancelled losers are not worth a warning
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            attempts.append(task)
+            backends[task] = backend
+
+        launch(primary)
+        winner = None
+        try:
+            while True:
+                pending = [task for task in attempts if not task.done()]
+                if not pending:
+                    if not fallbacks:
+                        raise errors[-1]
+                    if extra_attempts is not None:
+                        await extra_attempts.fallback()
+                    backend = fallbacks.pop(0)
+                    fallback_requests.inc(backend = backend.name)
+                    launch(backend)
+                    continue
+                timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+                done, _ = await asyncio.wait(pending, timeout = timeout, return_when = asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    if ((fallbacks or self.hedge_same_backend) and self.take_hedge()
+                            and (extra_attempts is None or extra_attempts.hedge())):
+                        # Another backend if there is one left, the same one only when allowed
+                        backend = fallbacks.pop(0) if fallbacks else primary
+                        hedged_requests.inc(backend = backend.name)
+                        launch(backend)
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if served is not None:
+                            served["model"] = backends[task].model
+                        return task.result()
+                for task in done:
+                    errors.append(task.exception())
+                    if not retryable(task.exception()):
+                        raise task.exception()
+        finally:
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and discard is not None and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())  # Answered too, but later
+
+    async def _complete(self, backend, params):
+        start = time.perf_counter()
+        try:
+            response = await backend.client.chat.completions.create(model = backend.model, **params)
+        except asyncio.CancelledError:
+            backend_requests.inc(backend = backend.name, outcome = "cancelled")
+            raise
+        except Exception as e:
+            backend.record_failure(e)
+            raise
+        backend.record_success("complete", time.perf_counter() - start)
+        return response
+
+    async def _open_stream(self, backend, params):
+        # Waits for the first content chunk, which is what the hedging races on
+        start = time.perf_counter()
+        stream = None
+        received = []
+        try:
+            stream = await backend.client.chat.completions.create(model = backend.model, stream = True, **params)
+            chunks = stream.__aiter__()
+            async for chunk in chunks:
+                received.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+        except BaseException as e:
+            if stream is not None:
+                await stream.close()
+            if isinstance(e, asyncio.CancelledError):
+                backend_requests.inc(backend = backend.name, outcome = "cancelled")
+            elif isinstance(e, Exception):
+                backend.record_failure(e)
+            raise
+        backend.record_success("stream", time.perf_counter() - start)
+        return OpenedStream(stream, chunks, received)
+
+    async def complete(self, extra_attempts = None, served = None, **params):
+        # chat.completions.create without the model, which each backend sets
+        return await self._race("complete", lambda backend: self._complete(backend, params),
+                                extra_attempts = extra_attempts, served = served)
+
+    async def stream(self, extra_attempts = None, served = None, **params):
+        # Chunks of a streamed completion. Once the first token has arrived the
+        # answer stays on that backend.
+        opened = await self._race("stream", lambda backend: self._open_stream(backend, params),
+                                  discard = OpenedStream.close, extra_attempts = extra_attempts, served = served)
+        try:
+            for chunk in opened.received:
+                yield chunk
+            async for chunk in opened.chunks:
+                yield chunk
+        finally:
+            await opened.close()
+
+    def stats(self):
+        return {backend.name: backend.stats() for backend in self.backends}
+
+
+def build_backends(specs, http_client, api_key, base_url, default_model, timeout, default_client = None):
+    # Backends from LLM_BACKENDS. They share the keep-alive pool, and only keep
+    # the client's own retries when there is nothing to fall back on.
+    if not specs:
+        client = default_client or AsyncOpenAI(api_key = api_key, base_url = base_url, http_client = http_client,
+                                                timeout = timeout)
+        return [Backend(default_model, client, default_model)]
+    backends = []
+    for index, spec in enumerate(specs):
+        model = spec.get("model", default_model)
+        name = spec.get("name") or model
+        if any(backend.name == name for backend in backends):
+            name = f"{name}-{index}"
+        client = AsyncOpenAI(api_key = spec.get("api_key", api_key), base_url = spec.get("base_url") or base_url,
+                             http_client = http_client, timeout = timeout,
+                             max_retries = 0 if len(specs) > 1 else openai.DEFAULT_MAX_RETRIES)
+        backends.append(Backend(name, client, model))
+    return backends
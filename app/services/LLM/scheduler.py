@@ -0,0 +1,286 @@
+import asyncio
+import email.utils
+import heapq
+import itertools
+import time
+
+import openai
+from decouple import config
+
+from app.services.metrics import metrics
+
+# Budgets of the upstream account, every backend call counts against them. 0 for no limit.
+UPSTREAM_RPM = config("UPSTREAM_RPM", default = 0, cast = int)
+UPSTREAM_TPM = config("UPSTREAM_TPM", default = 0, cast = int)
+# Requests that would wait longer than this are turned away, with a Retry-After
+MAX_SCHEDULE_WAIT = config("MAX_SCHEDULE_WAIT", default = 60, cast = float)
+RATE_LIMIT_RETRIES = config("RATE_LIMIT_RETRIES", default = 2, cast = int)  # Upstream 429s retried after their Retry-After
+RATE_LIMIT_BACKOFF = 1.0  # Seconds to pause on a 429 without Retry-After
+MAX_RETRY_AFTER = 120
+STATUS_INTERVAL = 1.0  # Seconds between two queue statuses sent to a waiting stream
+
+# Lower goes first: someone waiting for the answer, then a watched region, then batches
+PRIORITIES = {"interactive": 0, "watch": 1, "batch": 2}
+INTERACTIVE = "interactive"
+
+scheduled_requests = metrics.registry.counter("scheduled_requests_total",
+                                              "Upstream calls by priority and outcome: immediate, queued, rejected, rate_limited, extra",
+                                              ("priority", "outcome"))
+schedule_wait_seconds = metrics.registry.histogram("schedule_wait_seconds", "Time waiting for the upstream budget",
+                                                   ("priority",))
+
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after, position = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.position = position
+
+
+def retry_after(error):
+    # Seconds asked by a 429, from retry-after-ms or Retry-After (seconds or an HTTP date)
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    try:
+        if headers.get("retry-after-ms"):
+            return min(MAX_RETRY_AFTER, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if value:
+            try:
+                seconds = float(value)
+            except ValueError:
+                seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            return min(MAX_RETRY_AFTER, max(0.0, seconds))
+    except (TypeError, ValueError):
+        pass
+    return RATE_LIMIT_BACKOFF
+
+
+class TokenBucket:
+    # Refills limit units per minute, up to a minute's worth
+    def __init__(self, limit):
+        self.capacity = float(limit)
+        self.rate = limit / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount):
+        # Seconds until amount is available, given what is already there
+        return max(0.0, amount - self.level) / self.rate
+
+
+class Ticket:
+    def __init__(self, priority, order, tokens):
+        self.priority = priority
+        self.order = order  # Kept across retries, a rate limited call does not lose its place
+        self.tokens = tokens
+        self.granted = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (PRIORITIES[self.priority], self.order) < (PRIORITIES[other.priority], other.order)
+
+
+class ExtraAttempts:
+    # Passed to the router so the requests it adds to an admitted call count against
+    # the budgets too: a hedge only goes when the budget allows it right away, a
+    # fallback after an error waits its turn like a new call
+    def __init__(self, scheduler, tokens, priority):
+        self.scheduler = scheduler
+        self.tokens = tokens
+        self.priority = priority
+
+    def hedge(self):
+        return self.scheduler._try_take(self.tokens, self.priority)
+
+    async def fallback(self):
+        ticket = Ticket(self.priority, next(self.scheduler.orders), self.tokens)
+        async for _ in self.scheduler._turn(ticket, True):
+            pass
+
+
+class QueueStatus:
+    # Where a stream waits, sent to its client instead of a failure
+    def __init__(self, position, eta):
+        self.position = position
+        self.eta = eta
+
+    def as_dict(self):
+        return {"position": self.position, "eta": round(self.eta, 1)}
+
+
+class UpstreamScheduler:
+    # Admits the upstream calls within the requests and tokens per minute of the
+    # account, by priority then arrival. A call costs its estimated prompt plus
+    # max_tokens, which is what the upstream counts. A 429 pauses every call for
+    # its Retry-After and the call is queued again at its place.
+    def __init__(self, rpm = UPSTREAM_RPM, tpm = UPSTREAM_TPM, max_wait = MAX_SCHEDULE_WAIT,
+                 rate_limit_retries = RATE_LIMIT_RETRIES):
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.max_wait = max_wait
+        self.rate_limit_retries = rate_limit_retries
+        self.queue = []  # Heap of tickets, cancelled ones are skipped when they come up
+        self.waiting = 0
+        self.paused_until = 0.0
+        self.orders = itertools.count()
+        self.timer = None
+
+    def _refill(self):
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill()
+
+    def _cost(self, tokens):
+        # A call larger than a minute of budget would never fit, it waits for a full bucket
+        return min(tokens, self.tokens.capacity) if self.tokens is not None else tokens
+
+    def _eta(self, requests, tokens):
+        # Seconds until requests calls costing tokens in total can all go
+        self._refill()
+        eta = max(0.0, self.paused_until - time.monotonic())
+        if self.requests is not None:
+            eta = max(eta, self.requests.wait(requests))
+        if self.tokens is not None:
+            eta = max(eta, self.tokens.wait(tokens))
+        return eta
+
+    def _ahead(self, ticket):
+        return [other for other in self.queue if not other.granted.done() and other < ticket]
+
+    def status(self, ticket):
+        ahead = self._ahead(ticket)
+        return QueueStatus(len(ahead) + 1, self._eta(len(ahead) + 1, sum(other.tokens for other in ahead) + ticket.tokens))
+
+    def estimate_wait(self, tokens = 0, priority = INTERACTIVE):
+        # Seconds a new call of this priority would wait, for admission checks
+        ahead = [ticket for ticket in self.queue if not ticket.granted.done()
+                 and PRIORITIES[ticket.priority] <= PRIORITIES[priority]]
+        return self._eta(len(ahead) + 1, sum(ticket.tokens for ticket in ahead) + self._cost(tokens))
+
+    def _grant(self):
+        # Lets the head of the queue go while the budgets allow it. The head is
+        # never overtaken by a cheaper call, large screenshots are not starved.
+        self.timer = None
+        while self.queue:
+            ticket = self.queue[0]
+            if ticket.granted.done():
+                heapq.heappop(self.queue)
+                continue
+            eta = self._eta(1, ticket.tokens)
+            if eta > 0:
+                self.timer = asyncio.get_running_loop().call_later(eta, self._grant)
+                return
+            heapq.heappop(self.queue)
+            self._take(ticket.tokens)
+            ticket.granted.set_result(None)
+
+    def _take(self, tokens):
+        if self.requests is not None:
+            self.requests.level -= 1
+        if self.tokens is not None:
+            self.tokens.level -= tokens
+
+    def _try_take(self, tokens, priority):
+        # Charges an extra request if nothing waits and the budgets have room for it now
+        if self.waiting or self._eta(1, tokens) > 0:
+            return False
+        self._take(tokens)
+        scheduled_requests.inc(priority = priority, outcome = "extra")
+        return True
+
+    def _reschedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self._grant()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self._reschedule()
+
+    async def _turn(self, ticket, first):
+        # Yields the queue status every STATUS_INTERVAL until the ticket is granted
+        if first and not self.waiting and self._eta(1, ticket.tokens) == 0:
+            self._take(ticket.tokens)
+            scheduled_requests.inc(priority = ticket.priority, outcome = "immediate")
+            return
+        if first:
+            eta = self.status(ticket).eta
+            if eta > self.max_wait:
+                scheduled_requests.inc(priority = ticket.priority, outcome = "rejected")
+                raise RateLimited("The upstream is busy, try again later", eta, len(self._ahead(ticket)) + 1)
+            scheduled_requests.inc(priority = ticket.priority, outcome = "queued")
+        heapq.heappush(self.queue, ticket)
+        self.waiting += 1
+        try:
+            self._reschedule()
+            while not ticket.granted.done():
+                yield self.status(ticket)
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.granted), STATUS_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiting -= 1
+            if not ticket.granted.done():
+                ticket.granted.cancel()  # Left the queue, skipped when it comes up
+                self._reschedule()
+            schedule_wait_seconds.observe(time.monotonic() - ticket.queued_at, priority = ticket.priority)
+
+    def _rate_limited(self, ticket, error, attempt):
+        # Pauses everything for the Retry-After of a 429, raises when the call is not retried
+        seconds = retry_after(error)
+        self.pause(seconds)
+        scheduled_requests.inc(priority = ticket.priority, outcome = "rate_limited")
+        if attempt >= self.rate_limit_retries or seconds > self.max_wait:
+            raise RateLimited("The upstream is rate limited, try again later", seconds) from error
+        ticket.granted = asyncio.get_running_loop().create_future()
+        ticket.queued_at = time.monotonic()
+
+    async def run(self, tokens, priority, factory):
+        # await factory(extra_attempts) once the budgets allow it
+        ticket = Ticket(priority, next(self.orders), self._cost(tokens))
+        extra_attempts = ExtraAttempts(self, ticket.tokens, priority)
+        for attempt in itertools.count():
+            async for _ in self._turn(ticket, attempt == 0):
+                pass
+            try:
+                return await factory(extra_attempts)
+            except openai.RateLimitError as e:
+                self._rate_limited(ticket, e, attempt)
+
+    async def stream(self, tokens, priority, factory):
+        # Items of the async generator factory(extra_attempts) once the budgets allow
+        # it, and a QueueStatus every STATUS_INTERVAL while waiting
+        ticket = Ticket(priority, next(self.orders), self._cost(tokens))
+        extra_attempts = ExtraAttempts(self, ticket.tokens, priority)
+        for attempt in itertools.count():
+            async for status in self._turn(ticket, attempt == 0):
+                yield status
+            received = False
+            stream = factory(extra_attempts)
+            try:
+                async for item in stream:
+                    received = True
+                    yield item
+                return
+            except openai.RateLimitError as e:
+                if received:
+                    raise
+                self._rate_limited(ticket, e, attempt)
+            finally:
+                await stream.aclose()
+
+    def stats(self):
+        stats = {"waiting": self.waiting, "paused_seconds": max(0.0, self.paused_until - time.monotonic())}
+        self._refill()
+        if self.requests is not None:
+            stats["requests_available"] = self.requests.level
+        if self.tokens is not None:
+            stats["tokens_available"] = self.tokens.level
+        return stats
@@ -0,0 +1,131 @@
+import asyncio
+
+from app.services.metrics import metrics
+
+coalesced_requests = metrics.registry.counter("coalesced_requests_total",
+                                              "Requests that joined an identical upstream call already in flight",
+                                              ("mode",))
+
+
+class Flight:
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        # Streams only: items produced so far, replayed to late subscribers, and
+        # details the producer shares with them
+        self.items = []
+        self.info = {}
+        self.finished = False
+        self.error = None
+        self.updated = asyncio.Event()
+
+    def publish(self):
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+
+class Subscription:
+    # Iterates over the items of a shared stream from the first one, then raises
+    # the producer's exception if it failed
+    def __init__(self, singleflight, key, flight, leader):
+        self.singleflight = singleflight
+        self.key = key
+        self.flight = flight
+        self.leader = leader  # False when it joined a stream already in flight
+        self.closed = False
+
+    @property
+    def info(self):
+        return self.flight.info
+
+    def add_done_callback(self, callback):
+        # Called once the producer is done, even when it was cancelled before it started
+        self.flight.task.add_done_callback(lambda _: callback())
+
+    def close(self):
+        # Leaves the stream, also when it was never iterated, the producer is
+        # cancelled once every subscriber has left
+        if not self.closed:
+            self.closed = True
+            self.singleflight._leave(self.key, self.flight)
+
+    async def __aiter__(self):
+        flight = self.flight
+        try:
+            index = 0
+            while True:
+                updated = flight.updated
+                while index < len(flight.items):
+                    yield flight.items[index]
+                    index += 1
+                if flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await updated.wait()
+        finally:
+            self.close()
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution. It runs in its own
+    # task, goes on while at least one caller waits and is cancelled when the last
+    # one leaves. Its result or exception goes to every caller.
+    def __init__(self):
+        self.flights = {}
+
+    def active(self, key):
+        return key in self.flights
+
+    def _join(self, key, mode, start):
+        flight = self.flights.get(key)
+        if flight is not None:
+            coalesced_requests.inc(mode = mode)
+            return flight, False
+        flight = self.flights[key] = Flight()
+        flight.task = asyncio.ensure_future(start(flight))
+        flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        return flight, True
+
+    def _forget(self, key, flight):
+        # Later calls start a new flight
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def _leave(self, key, flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Nobody wants the result anymore
+            self._forget(key, flight)
+            flight.task.cancel()
+
+    async def run(self, key, factory):
+        # Result of await factory(), shared with the identical calls in flight
+        flight, _ = self._join(key, "complete", lambda flight: factory())
+        flight.waiters += 1
+        try:
+            # A caller going away does not cancel the call the others wait for
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(key, flight)
+
+    def stream(self, key, factory):
+        # Subscription to the items of the async generator factory(info), shared
+        # with the identical streams in flight
+        flight, leader = self._join(key, "stream", lambda flight: self._pump(flight, factory))
+        flight.waiters += 1  # Until the subscription is closed
+        return Subscription(self, key, flight, leader)
+
+    async def _pump(self, flight, factory):
+        try:
+            async for item in factory(flight.info):
+                flight.items.append(item)
+                flight.publish()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.finished = True
+            flight.publish()
+
+    def stats(self):
+        return {"in_flight": len(self.flights), "waiters": sum(flight.waiters for flight in self.flights.values())}
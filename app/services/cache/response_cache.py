@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+
+from app.services.images.phash import hamming
+
+RESPONSE_CACHE_SIZE = config("RESPONSE_CACHE_SIZE", default = 2048, cast = int)
+RESPONSE_CACHE_TTL = config("RESPONSE_CACHE_TTL", default = 24 * 3600, cast = int)
+# Screenshots are matched by their exact digest. With PERCEPTUAL_CACHE, by a perceptual
+# hash instead, two hashes differing by at most PHASH_TOLERANCE bits being the same screenshot.
+PERCEPTUAL_CACHE = config("PERCEPTUAL_CACHE", default = False, cast = bool)
+PHASH_TOLERANCE = config("PHASH_TOLERANCE", default = 0, cast = int)
+# Perceptual matches are reused within their session only, unless they may go to any
+# user. Exact matches are always shared: same screenshot bytes, history and question.
+SHARE_RESPONSE_CACHE = config("SHARE_RESPONSE_CACHE", default = False, cast = bool)
+# Optional on-disk tier, disabled when empty
+RESPONSE_CACHE_DIR = config("RESPONSE_CACHE_DIR", default = "")
+
+
+def normalize_prompt(text):
+    return re.sub(r"\s+", " ", (text or "").strip().lower())
+
+
+def make_bucket(text, history, params, scope = None):
+    # Everything in the key that has to match exactly: prompt, conversation so far,
+    # model parameters and the session, None when answers are shared
+    payload = json.dumps({"prompt": normalize_prompt(text), "history": history, "params": params, "scope": scope},
+                         sort_keys = True, ensure_ascii = False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheEntry:
+    __slots__ = ("bucket", "images", "response", "expires")
+
+    def __init__(self, bucket, images, response, expires):
+        self.bucket = bucket
+        self.images = tuple(images)  # Digests, or perceptual hashes (ints)
+        self.response = response
+        self.expires = expires
+
+
+class ResponseCache:
+    def __init__(self, max_entries = RESPONSE_CACHE_SIZE, ttl = RESPONSE_CACHE_TTL,
+                 tolerance = PHASH_TOLERANCE, directory = RESPONSE_CACHE_DIR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.tolerance = tolerance
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        self.lock = threading.Lock()
+        # Entries from least to most recently used, plus an index by bucket
+        self.entries = OrderedDict()
+        self.buckets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def same_image(self, a, b):
+        if isinstance(a, int) and isinstance(b, int):
+            return hamming(a, b) <= self.tolerance
+        return a == b
+
+    def matches(self, entry, images):
+        return len(entry.images) == len(images) and all(self.same_image(a, b) for a, b in zip(entry.images, images))
+
+    def get(self, bucket, images):
+        now = time.time()
+        with self.lock:
+            for entry in list(self.buckets.get(bucket, ())):
+                if entry.expires <= now:
+                    self._remove(entry)
+                elif self.matches(entry, images):
+                    self.entries.move_to_end(id(entry))
+                    self.hits += 1
+                    return entry.response
+
+        entry = self._disk_get(bucket, images, now)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._insert(entry)
+            return entry.response
+
+    def put(self, bucket, images, response):
+        entry = CacheEntry(bucket, images, response, time.time() + self.ttl)
+        with self.lock:
+            # A fresh answer replaces any entry it would have matched
+            for old in list(self.buckets.get(bucket, ())):
+                if self.matches(old, entry.images):
+                    self._remove(old)
+            self._insert(entry)
+        self._disk_put(entry)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def _insert(self, entry):
+        self.entries[id(entry)] = entry
+        self.buckets.setdefault(entry.bucket, []).append(entry)
+        while len(self.entries) > self.max_entries:
+            _, oldest = self.entries.popitem(last = False)
+            self._unindex(oldest)
+
+    def _remove(self, entry):
+        self.entries.pop(id(entry), None)
+        self._unindex(entry)
+
+    def _unindex(self, entry):
+        bucket = self.buckets.get(entry.bucket)
+        if bucket is None:
+            return
+        bucket.remove(entry)
+        if not bucket:
+            del self.buckets[entry.bucket]
+
+    # On-disk tier: one JSON file per bucket holding its entries
+
+    def _bucket_path(self, bucket):
+        return os.path.join(self.directory, bucket[:2], bucket + ".json")
+
+    def _disk_load(self, bucket, now):
+        try:
+            with open(self._bucket_path(bucket), encoding = "utf-8") as f:
+                rows = json.load(f)
+        except (OSError, ValueError):
+            return []
+        return [row for row in rows if row["expires"] > now and "images" in row]
+
+    def _disk_get(self, bucket, images, now):
+        if not self.directory:
+            return None
+        for row in self._disk_load(bucket, now):
+            entry = CacheEntry(bucket, row["images"], row["response"], row["expires"])
+            if self.matches(entry, images):
+                return entry
+        return None
+
+    def _disk_put(self, entry):
+        if not self.directory:
+            return
+        rows = [row for row in self._disk_load(entry.bucket, time.time())
+                if not self.matches(CacheEntry(entry.bucket, row["images"], None, 0), entry.images)]
+        rows.append({"images": list(entry.images), "response": entry.response, "expires": entry.expires})
+        path = self._bucket_path(entry.bucket)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        # Write then rename so readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding = "utf-8") as f:
+            json.dump(rows, f)
+        os.replace(tmp_path, path)
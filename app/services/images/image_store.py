@@ -0,0 +1,297 @@
+import base64
+import binascii
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from decouple import config
+from PIL import Image
+
+from app.services.images.phash import dhash
+
+MAX_IMAGE_STORE_BYTES = config("MAX_IMAGE_STORE_BYTES", default = 256 * 1024 * 1024, cast = int)
+
+# Images already known by the server can be referenced as "sha256:<hex digest>"
+IMAGE_REF_PREFIX = "sha256:"
+
+
+class UnknownImage(KeyError):
+    pass
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def is_image_ref(image):
+    return image.startswith(IMAGE_REF_PREFIX)
+
+
+def parse_data_url(data_url):
+    # "data:image/jpeg;base64, <payload>" -> (mime, raw bytes)
+    header, sep, payload = data_url.partition(",")
+    if not sep or not header.startswith("data:") or ";base64" not in header:
+        raise InvalidImage("Images must be base64 data URLs or sha256 references")
+    mime = header[len("data:"):].split(";")[0] or "image/jpeg"
+    try:
+        return mime, base64.b64decode(payload.strip(), validate = True)
+    except (binascii.Error, ValueError):
+        raise InvalidImage("Invalid base64 image payload")
+
+
+def make_thumbnail(data, max_size):
+    # JPEG bytes of the image fit in max_size x max_size, for transcript previews
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", (max_size, max_size))
+        img = img.convert("RGB")
+        img.thumbnail((max_size, max_size))
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality = 80)
+    return buffer.getvalue()
+
+
+def image_refs(message):
+    # Digests referenced by a history message
+    content = message.get("content")
+    if not isinstance(content, list):
+        return []
+    return [item["digest"] for item in content if item.get("type") == "image_ref"]
+
+
+class StoredImage:
+    __slots__ = ("data", "mime", "width", "height", "refcount", "phash", "persisted")
+
+    def __init__(self, data, mime, width, height):
+        self.data = data  # None while only the persisted copy exists
+        self.mime = mime
+        self.width = width
+        self.height = height
+        self.refcount = 0
+        self.phash = None
+        self.persisted = False
+
+    def data_url(self):
+        return f"data:{self.mime};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+    def with_data(self, data):
+        # Same image with its bytes in memory or not, entries are replaced rather
+        # than changed so callers holding one keep its bytes
+        image = StoredImage(data, self.mime, self.width, self.height)
+        image.refcount = self.refcount
+        image.phash = self.phash
+        image.persisted = self.persisted
+        return image
+
+
+class ImageStore:
+    # Raw image bytes keyed by their sha256. Sessions hold references, images
+    # nobody references stay around until the byte budget needs the room. With
+    # load, referenced images that are persisted can leave memory too, their
+    # bytes are loaded back from storage on use, so the store stays within
+    # max_bytes whatever the live sessions reference.
+    def __init__(self, max_bytes = MAX_IMAGE_STORE_BYTES, load = None):
+        self.max_bytes = max_bytes
+        self.load = load  # load(digest) -> bytes of a persisted image, or None
+        self.lock = threading.Lock()
+        self.images = {}
+        # Unreferenced images, least recently used first
+        self.unreferenced = OrderedDict()
+        # Referenced images with a persisted copy and their bytes in memory, least recently used first
+        self.spillable = OrderedDict()
+        self.nbytes = 0
+
+    def put_bytes(self, data, mime, retain = False):
+        # With retain the caller holds a reference and must release it later
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if self._lookup(digest, retain):
+                self._reload(digest, data)
+                return digest
+
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                width, height = img.size  # only reads the header
+        except Exception:
+            raise InvalidImage("Could not decode image")
+
+        with self.lock:
+            if self._lookup(digest, retain):
+                self._reload(digest, data)
+            else:
+                self.images[digest] = StoredImage(data, mime, width, height)
+                self.nbytes += len(data)
+                if retain:
+                    self.images[digest].refcount = 1
+                else:
+                    self.unreferenced[digest] = None
+                self._evict()
+        return digest
+
+    def put(self, image, retain = False):
+        # Accepts a data URL or a reference to an image already stored
+        if is_image_ref(image):
+            digest = image[len(IMAGE_REF_PREFIX):]
+            with self.lock:
+                if not self._lookup(digest, retain):
+                    raise UnknownImage(digest)
+            return digest
+        mime, data = parse_data_url(image)
+        return self.put_bytes(data, mime, retain = retain)
+
+    def _lookup(self, digest, retain):
+        image = self.images.get(digest)
+        if image is None:
+            return False
+        if retain:
+            image.refcount += 1
+            if image.refcount == 1:
+                self.unreferenced.pop(digest, None)
+                if self._can_spill(image):
+                    self.spillable[digest] = None
+        for recent in (self.unreferenced, self.spillable):
+            if digest in recent:
+                recent.move_to_end(digest)
+        return True
+
+    def _can_spill(self, image):
+        return self.load is not None and image.persisted and image.data is not None
+
+    def _reload(self, digest, data):
+        # Puts back the bytes of an image that only had its persisted copy
+        image = self.images.get(digest)
+        if image is None or image.data is not None:
+            return image
+        image = self.images[digest] = image.with_data(data)
+        self.nbytes += len(data)
+        self.spillable[digest] = None
+        self._evict()
+        return image
+
+    def get(self, digest, load = True):
+        # Without load the bytes may be missing (data is None), enough for the
+        # dimensions. Loading reads the storage, keep it off the event loop.
+        with self.lock:
+            image = self.images.get(digest)
+        if image is None:
+            raise UnknownImage(digest)
+        if image.data is not None or not load:
+            return image
+        data = self.load(digest)
+        if data is None:
+            raise UnknownImage(digest)
+        with self.lock:
+            self._reload(digest, data)
+        return image.with_data(data)
+
+    def loaded(self, digests):
+        # True when none of these images has to be read from storage
+        with self.lock:
+            return all(self.images[digest].data is not None for digest in digests if digest in self.images)
+
+    def phash(self, digest):
+        # Perceptual hash, computed on first use only
+        image = self.get(digest)
+        if image.phash is None:
+            image.phash = dhash(image.data)
+            with self.lock:
+                current = self.images.get(digest)
+                if current is not None:
+                    current.phash = image.phash
+        return image.phash
+
+    def mark_persisted(self, digests):
+        # These images are in storage now, a live history no longer keeps their bytes in memory
+        with self.lock:
+            for digest in digests:
+                image = self.images.get(digest)
+                if image is None or image.persisted:
+                    continue
+                image.persisted = True
+                if image.refcount and self._can_spill(image):
+                    self.spillable[digest] = None
+            self._evict()
+
+    def retain(self, digests):
+        with self.lock:
+            for digest in digests:
+                self._lookup(digest, True)
+
+    def release(self, digests):
+        with self.lock:
+            for digest in digests:
+                image = self.images.get(digest)
+                if image is None or image.refcount == 0:
+                    continue
+                image.refcount -= 1
+                if image.refcount == 0:
+                    self.spillable.pop(digest, None)
+                    if image.data is None:
+                        del self.images[digest]  # Only in storage now
+                    else:
+                        self.unreferenced[digest] = None
+            self._evict()
+
+    def discard(self, digests):
+        # Forgets the images of a deleted conversation, except the ones still
+        # referenced. Returns the digests nobody references.
+        unused = []
+        with self.lock:
+            for digest in digests:
+                image = self.images.get(digest)
+                if image is not None and image.refcount:
+                    continue
+                unused.append(digest)
+                if image is not None:
+                    del self.images[digest]
+                    self.unreferenced.pop(digest, None)
+                    self.nbytes -= len(image.data)
+        return unused
+
+    def retain_messages(self, messages):
+        self.retain([digest for message in messages for digest in image_refs(message)])
+
+    def release_messages(self, messages):
+        self.release([digest for message in messages for digest in image_refs(message)])
+
+    def resolve_messages(self, messages):
+        # Build the upstream payload, image references become data URLs only here
+        resolved = []
+        for message in messages:
+            if not image_refs(message):
+                resolved.append(message)
+                continue
+            content = []
+            for item in message["content"]:
+                if item.get("type") != "image_ref":
+                    content.append(item)
+                    continue
+                try:
+                    url = self.get(item["digest"]).data_url()
+                except UnknownImage:
+                    content.append({"type": "text", "text": "[image no longer available]"})
+                    continue
+                image_url = {"url": url}
+                if item.get("detail"):
+                    image_url["detail"] = item["detail"]
+                content.append({"type": "image_url", "image_url": image_url})
+            resolved.append({**message, "content": content})
+        return resolved
+
+    def stats(self):
+        with self.lock:
+            return {"images": len(self.images), "unreferenced": len(self.unreferenced),
+                    "in_storage": sum(image.data is None for image in self.images.values()), "bytes": self.nbytes}
+
+    def _evict(self):
+        # Unreferenced images go first, then the bytes of persisted images a live
+        # history references. Referenced images without a persisted copy stay.
+        while self.nbytes > self.max_bytes and self.unreferenced:
+            digest, _ = self.unreferenced.popitem(last = False)
+            image = self.images.pop(digest)
+            self.nbytes -= len(image.data)
+        while self.nbytes > self.max_bytes and self.spillable:
+            digest, _ = self.spillable.popitem(last = False)
+            image = self.images[digest]
+            self.images[digest] = image.with_data(None)
+            self.nbytes -= len(image.data)
@@ -0,0 +1,180 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from decouple import config
+from PIL import Image, ImageOps
+
+from app.services.images.image_store import InvalidImage
+from app.services.LLM.limiter import ConcurrencyLimiter
+from app.services.metrics import metrics
+
+NORMALIZE_IMAGES = config("NORMALIZE_IMAGES", default = True, cast = bool)
+IMAGE_WORKERS = config("IMAGE_WORKERS", default = min(4, os.cpu_count() or 1), cast = int)
+# Images waiting for a worker before new ones are refused with a 503
+IMAGE_QUEUE = config("IMAGE_QUEUE", default = 64, cast = int)
+IMAGE_QUEUE_TIMEOUT = config("IMAGE_QUEUE_TIMEOUT", default = 10, cast = float)
+MAX_IMAGE_PIXELS = config("MAX_IMAGE_PIXELS", default = 50_000_000, cast = int)
+NORMALIZED_MEMO_SIZE = 4096
+
+# Same rules as the GUI preprocessing: the model fits images in 2048x2048 then
+# scales the short side down to 768, anything above that is uploaded for nothing
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+PHOTO_JPEG_QUALITY = 80
+TEXT_JPEG_QUALITY = 90
+SAMPLE_SIZE = 64  # Side of the thumbnail used to classify the content
+
+FORMAT_MIMES = {"PNG": "image/png", "JPEG": "image/jpeg"}
+METADATA_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "comment", "photoshop")
+
+normalize_seconds = metrics.registry.histogram("image_normalize_seconds", "Time to normalize an image, queue included")
+image_bytes = metrics.registry.counter("image_bytes_total", "Image bytes received and kept after normalization",
+                                       ("stage",))
+
+
+def fit_to_tiles(width, height):
+    scale = min(1.0, MAX_LONG_SIDE / max(width, height))
+    scale *= min(1.0, MAX_SHORT_SIDE / max(1, min(width, height) * scale))
+    if scale >= 1.0:
+        return width, height
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def is_text_heavy(img):
+    # Text and UI screenshots have few distinct colours and large flat areas,
+    # photos and gradients have neither
+    sample = img.convert("RGB").resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.NEAREST)
+    colors = Counter(sample.getdata())
+    dominant = colors.most_common(1)[0][1] / (SAMPLE_SIZE * SAMPLE_SIZE)
+    return len(colors) < SAMPLE_SIZE * SAMPLE_SIZE // 4 or dominant > 0.35
+
+
+def has_metadata(img):
+    return any(key in img.info for key in METADATA_KEYS) or bool(getattr(img, "text", None)) or len(img.getexif()) > 0
+
+
+def encode(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def normalize_image(data, max_pixels = MAX_IMAGE_PIXELS):
+    # Runs in a worker process. Decodes and validates the image, applies the EXIF
+    # orientation, caps the dimensions, drops metadata and keeps the smallest
+    # encoding. Returns (data, mime, width, height).
+    try:
+        img = Image.open(io.BytesIO(data))
+        source_format = img.format
+        if img.width * img.height > max_pixels:
+            raise InvalidImage(f"Image larger than {max_pixels} pixels")
+        img.load()  # Full decode, truncated or corrupt files fail here
+    except InvalidImage:
+        raise
+    except Exception:
+        raise InvalidImage("Could not decode image")
+
+    oriented = ImageOps.exif_transpose(img)
+    target = fit_to_tiles(*oriented.size)
+    # Animated images are re-encoded and keep their first frame only
+    unchanged = (source_format in FORMAT_MIMES and target == img.size and oriented.size == img.size
+                 and not getattr(img, "is_animated", False) and not has_metadata(img))
+    if unchanged and source_format == "JPEG":
+        # Already compact, e.g. prepared by the GUI, a second lossy pass would only blur it
+        return bytes(data), "image/jpeg", img.width, img.height
+    img = oriented
+
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    if has_alpha and img.getextrema()[3][0] == 255:
+        img = img.convert("RGB")  # Fully opaque, the alpha channel is dead weight
+        has_alpha = False
+    # Classified before resizing, the smoothing adds colours that look like a photo
+    text_heavy = has_alpha or is_text_heavy(img)
+    if target != img.size:
+        img = img.resize(target, Image.LANCZOS, reducing_gap = 3.0)
+
+    # The original PNG stands in for a re-encoded one, they hold the same pixels
+    candidates = [(bytes(data), "image/png")] if unchanged else []
+    if text_heavy and not unchanged:
+        candidates.append((encode(img, "PNG"), "image/png"))
+    if not has_alpha:
+        # PNG keeps text sharp, unless it is bigger than a high quality JPEG
+        quality = TEXT_JPEG_QUALITY if text_heavy else PHOTO_JPEG_QUALITY
+        candidates.append((encode(img, "JPEG", quality = quality), "image/jpeg"))
+
+    data, mime = min(candidates, key = lambda candidate: len(candidate[0]))
+    return data, mime, img.width, img.height
+
+
+class ImageNormalizer:
+    # normalize_image in a bounded process pool, so decoding and encoding never
+    # block the event loop. Results are remembered by the digest of the input, the
+    # same screenshot sent again is not processed twice, and identical images
+    # arriving together share one job.
+    def __init__(self, workers = IMAGE_WORKERS, max_queued = IMAGE_QUEUE, queue_timeout = IMAGE_QUEUE_TIMEOUT,
+                 memo_size = NORMALIZED_MEMO_SIZE):
+        self.workers = workers
+        # A job per worker at a time, the others wait here
+        self.limiter = ConcurrencyLimiter(workers, max_queued, queue_timeout)
+        self.memo_size = memo_size
+        self.memo = OrderedDict()  # input digest -> digest of the normalized image
+        self.running = {}  # input digest -> task of the job in progress
+        self.executor = None
+
+    def known(self, source_digest):
+        digest = self.memo.get(source_digest)
+        if digest is not None:
+            self.memo.move_to_end(source_digest)
+        return digest
+
+    def remember(self, source_digest, digest):
+        self.memo[source_digest] = digest
+        self.memo.move_to_end(source_digest)
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last = False)
+
+    async def normalize(self, source_digest, data):
+        # Raises InvalidImage, or Saturated when too many images are waiting
+        task = self.running.get(source_digest)
+        if task is None:
+            task = asyncio.ensure_future(self._run(data))
+            self.running[source_digest] = task
+            task.add_done_callback(lambda _: self.running.pop(source_digest, None))
+        # A caller going away does not cancel the job the others wait for
+        return await asyncio.shield(task)
+
+    async def _run(self, data):
+        start = time.perf_counter()
+        async with self.limiter.slot():
+            if self.executor is None:
+                # Created on first use, spawned workers do not inherit the server's threads
+                self.executor = ProcessPoolExecutor(self.workers, mp_context = multiprocessing.get_context("spawn"))
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self.executor, normalize_image, bytes(data))
+            except BrokenProcessPool:
+                # A worker died on this image (out of memory...), start a fresh pool for the next ones
+                self.executor.shutdown(wait = False)
+                self.executor = None
+                raise InvalidImage("Could not decode image")
+        normalize_seconds.observe(time.perf_counter() - start)
+        image_bytes.inc(len(data), stage = "received")
+        image_bytes.inc(len(result[0]), stage = "stored")
+        return result
+
+    def stats(self):
+        return {"workers": self.workers, "in_flight": self.limiter.in_flight, "queued": self.limiter.queued,
+                "memo": len(self.memo)}
+
+    def shutdown(self):
+        if self.executor is not None:
+            # cancel_futures needs Python 3.9, the image runs 3.8: queued work is only a few
+            # decodes and the interpreter waits for them on exit anyway
+            self.executor.shutdown(wait = False)
+            self.executor = None
@@ -0,0 +1,26 @@
+import io
+
+from PIL import Image
+
+HASH_SIZE = 32
+
+
+def dhash(data):
+    # 1024 bit difference hash: compares each pixel of a small grayscale version with
+    # its right neighbour, robust to re-encoding. The grid is fine enough for a
+    # changed line of text in a dialog to flip bits, an 8x8 one was not.
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))  # lets JPEG decode at reduced size
+        small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
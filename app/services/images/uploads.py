@@ -0,0 +1,45 @@
+from decouple import config
+
+from app.services.images.image_store import InvalidImage
+
+MAX_UPLOAD_IMAGE_BYTES = config("MAX_UPLOAD_IMAGE_BYTES", default = 20 * 1024 * 1024, cast = int)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Formats accepted by the vision model, recognised from their first bytes
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def sniff_mime(head):
+    for signature, mime in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+async def read_image_upload(upload, max_bytes = MAX_UPLOAD_IMAGE_BYTES):
+    # Read a multipart part chunk by chunk, rejecting it as soon as the type or
+    # the size is wrong. Returns (bytearray, mime), the buffer is handed over as is.
+    data = bytearray()
+    mime = None
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+        if mime is None and len(data) >= 12:
+            mime = sniff_mime(bytes(data[:12]))
+            if mime is None:
+                raise InvalidImage(f"{upload.filename}: unsupported image type")
+        if len(data) > max_bytes:
+            raise InvalidImage(f"{upload.filename}: image larger than {max_bytes} bytes")
+
+    if mime is None:
+        raise InvalidImage(f"{upload.filename}: not an image")
+    return data, mime
@@ -0,0 +1,253 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from decouple import config
+
+# Adds a Server-Timing header with the duration of each stage to every response
+SERVER_TIMING = config("SERVER_TIMING", default = True, cast = bool)
+METRICS_PREFIX = "screengpt_"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9))  # 1 KiB to 64 MiB
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames = ()):
+        self.name = METRICS_PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values tuple -> value
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in sorted(values):
+            lines.extend(self.samples(key, value))
+        return lines
+
+    def samples(self, key, value):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames = (), buckets = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per bucket counts (not cumulative), then sum and count
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            labels = format_labels(self.labelnames, key, [("le", format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames = ()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames = ()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames = (), buckets = LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "Requests by endpoint and status code", ("endpoint", "status"))
+http_request_seconds = registry.histogram("http_request_seconds", "Time from the first byte received to the last byte sent",
+                                          ("endpoint",))
+http_request_bytes = registry.histogram("http_request_bytes", "Size of the request bodies", ("endpoint",), SIZE_BUCKETS)
+stage_seconds = registry.histogram("stage_seconds", "Time spent in each stage of a request", ("stage",))
+request_images = registry.histogram("request_images", "Images sent with each question", (), COUNT_BUCKETS)
+history_messages = registry.histogram("history_messages", "Messages sent upstream for each question", (), COUNT_BUCKETS)
+history_tokens = registry.histogram("history_tokens", "Estimated prompt tokens sent upstream", (), TOKEN_BUCKETS)
+history_trimmed_tokens = registry.counter("history_trimmed_tokens_total", "Tokens removed from the history to fit the budget")
+upstream_seconds = registry.histogram("upstream_seconds", "Duration of the upstream calls", ("mode",))
+upstream_first_token_seconds = registry.histogram("upstream_first_token_seconds", "Time to the first streamed token")
+upstream_tokens = registry.counter("upstream_tokens_total", "Tokens billed by the upstream", ("kind",))
+upstream_errors = registry.counter("upstream_errors_total", "Failed upstream calls by error type", ("error",))
+state = registry.gauge("state", "Current figures of the in-memory components, set when scraped", ("component", "stat"))
+
+
+class RequestTiming:
+    # Stage durations of one request, in the order they first ran. A stage
+    # running several times (batch items, retries) adds up.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def record(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def as_dict(self):
+        # Milliseconds, for JSON bodies and stream events
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()}
+
+    def header(self):
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current_timing = contextvars.ContextVar("request_timing", default = None)
+
+
+def current_timing():
+    return _current_timing.get()
+
+
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage = stage)
+    timing = _current_timing.get()
+    if timing is not None:
+        timing.record(stage, seconds)
+
+
+def record_since_start(stage):
+    # Time between the request arriving and now, e.g. the body parsing done
+    # before the endpoint runs
+    timing = _current_timing.get()
+    if timing is not None:
+        record_stage(stage, time.perf_counter() - timing.start)
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def endpoint_name(scope):
+    # The route's function name keeps the label set small, unlike raw paths
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", "unmatched")
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: counts request bytes, status codes and durations,
+    # and exposes the stage timings of the request being served to the code below
+    def __init__(self, app, server_timing = SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = _current_timing.set(timing)
+        received = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def timed_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    # Streamed responses only get the stages done before their first byte
+                    headers = list(message.get("headers", [])) + [(b"server-timing", timing.header().encode("latin-1"))]
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, timed_send)
+        finally:
+            _current_timing.reset(token)
+            endpoint = endpoint_name(scope)
+            http_requests.inc(endpoint = endpoint, status = status)
+            http_request_seconds.observe(time.perf_counter() - timing.start, endpoint = endpoint)
+            http_request_bytes.observe(received, endpoint = endpoint)
@@ -0,0 +1,249 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from decouple import config
+
+# Budgets are expressed in bytes of serialized history so memory stays flat
+# no matter how many desktops point at the same backend.
+MAX_SESSION_BYTES = config("MAX_SESSION_BYTES", default = 8 * 1024 * 1024, cast = int)
+MAX_TOTAL_BYTES = config("MAX_TOTAL_BYTES", default = 512 * 1024 * 1024, cast = int)
+MAX_SESSIONS = config("MAX_SESSIONS", default = 1000, cast = int)
+SESSION_IDLE_TIMEOUT = config("SESSION_IDLE_TIMEOUT", default = 3600, cast = int)
+
+
+def message_size(message):
+    # Approximate the memory held by a message with its JSON size
+    return len(json.dumps(message, ensure_ascii = False))
+
+
+def _noop(*args):
+    pass
+
+
+def _no_history(session_id):
+    return None
+
+
+class Session:
+    def __init__(self, session_id, base_context, max_bytes = MAX_SESSION_BYTES, on_append = _noop, on_discard = _noop,
+                 on_record = _noop):
+        self.session_id = session_id
+        self.max_bytes = max_bytes
+        # Hooks called with the messages entering / leaving the history, used to
+        # keep image references counted
+        self.on_append = on_append
+        self.on_discard = on_discard
+        # Called with (session id, messages) for each new turn, used to persist it
+        self.on_record = on_record
+        self.lock = threading.Lock()
+        self.closed = False
+        self.evicted = False  # Closed to free memory, not deleted: its turns are still persisted
+        self.pins = 0  # Requests in flight on this session, it is not evicted meanwhile
+        self.chat_history = [{"role": "system", "content": base_context}]
+        self.sizes = [message_size(self.chat_history[0])]
+        self.nbytes = self.sizes[0]
+        self.last_access = time.monotonic()
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    def snapshot(self, input = None):
+        # Copy of the history to send upstream, without mutating the session
+        with self.lock:
+            history = list(self.chat_history)
+        if input:
+            history.append(input)
+        return history
+
+    def append_turn(self, input = None, previous_output = None):
+        # Returns the change in bytes held by the session
+        with self.lock:
+            added = []
+            if input:
+                added.append(input)
+            if previous_output:
+                added.append({"role": "system", "content": previous_output})
+            if self.closed:
+                if self.evicted:
+                    self.on_record(self.session_id, added)  # Resumed from storage next time
+                return 0
+            before = self.nbytes
+            for message in added:
+                self._append(message)
+            self.on_append(added)
+            self.on_record(self.session_id, added)
+            dropped = self._trim(self.max_bytes)
+            delta = self.nbytes - before
+        self.on_discard(dropped)
+        return delta
+
+    def restore(self, messages):
+        # Earlier turns loaded back from storage, they are not recorded again
+        with self.lock:
+            for message in messages:
+                self._append(message)
+            self.on_append(messages)
+            dropped = self._trim(self.max_bytes)
+        self.on_discard(dropped)
+
+    def _append(self, message):
+        size = message_size(message)
+        self.chat_history.append(message)
+        self.sizes.append(size)
+        self.nbytes += size
+
+    def _trim(self, target_bytes):
+        # Drop the oldest turns but always keep the base context at index 0
+        # and the latest message
+        dropped = []
+        while self.nbytes > target_bytes and len(self.chat_history) > 2:
+            dropped.append(self.chat_history.pop(1))
+            self.nbytes -= self.sizes.pop(1)
+        return dropped
+
+    def shrink(self, target_bytes):
+        # Called by the manager when the global budget is exceeded
+        with self.lock:
+            freed = self.nbytes
+            dropped = self._trim(target_bytes)
+            freed -= self.nbytes
+        self.on_discard(dropped)
+        return freed
+
+    def close(self, evicted = False):
+        # Release the whole history, later turns on this session are only persisted
+        # when it was evicted, ignored when it was deleted
+        with self.lock:
+            self.closed = True
+            self.evicted = evicted
+            dropped = self.chat_history
+            self.chat_history = []
+            self.sizes = []
+        self.on_discard(dropped)
+
+
+class SessionManager:
+    def __init__(self, base_context, max_session_bytes = MAX_SESSION_BYTES, max_total_bytes = MAX_TOTAL_BYTES,
+                 max_sessions = MAX_SESSIONS, idle_timeout = SESSION_IDLE_TIMEOUT, on_append = _noop, on_discard = _noop,
+                 on_record = _noop, on_drop = _noop, load_history = _no_history):
+        self.base_context = base_context
+        self.on_append = on_append
+        self.on_discard = on_discard
+        # Persistence hooks: new turns, deleted sessions, and the earlier turns of
+        # a session that is not in memory (None when there are none)
+        self.on_record = on_record
+        self.on_drop = on_drop
+        self.load_history = load_history
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # Ordered from least to most recently used
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, session_id = None, pin = False):
+        # Returns the session for this id, restoring it from storage or creating
+        # a fresh one if it is not in memory. Loading may hit the disk, call it off
+        # the event loop. A pinned session stays in memory until unpin, so the
+        # turn of a request in flight is not lost to an eviction.
+        with self.lock:
+            self._expire_idle()
+            session = self._lookup(session_id)
+            if session is not None:
+                session.pins += pin
+                return session
+
+        # Loaded without holding the lock, other sessions stay available meanwhile
+        history = self.load_history(session_id) if session_id else None
+
+        with self.lock:
+            session = self._lookup(session_id)
+            if session is not None:
+                session.pins += pin
+                return session
+            session_id = session_id or uuid.uuid4().hex
+            session = Session(session_id, self.base_context, self.max_session_bytes,
+                              on_append = self.on_append, on_discard = self.on_discard, on_record = self.on_record)
+            if history:
+                session.restore(history)
+            self.sessions[session_id] = session
+            session.pins += pin
+            self.nbytes += session.nbytes
+            self._evict()
+            session.touch()
+            return session
+
+    def unpin(self, session):
+        # The request is done, the session counts as just used
+        with self.lock:
+            session.pins -= 1
+            if self.sessions.get(session.session_id) is session:
+                self.sessions.move_to_end(session.session_id)
+            session.touch()
+            self._evict()
+
+    def _lookup(self, session_id):
+        session = self.sessions.get(session_id) if session_id else None
+        if session is not None:
+            self.sessions.move_to_end(session_id)
+            session.touch()
+        return session
+
+    def record_turn(self, session, input = None, previous_output = None):
+        delta = session.append_turn(input = input, previous_output = previous_output)
+        with self.lock:
+            if self.sessions.get(session.session_id) is session:
+                self.nbytes += delta
+            self._evict()
+
+    def drop(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                self.nbytes -= session.nbytes
+        if session is not None:
+            session.close()
+        # Also forgets the stored turns of a session that is not in memory
+        return self.on_drop(session_id) or session is not None
+
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "bytes": self.nbytes}
+
+    def _expire_idle(self):
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_access < self.idle_timeout:
+                break
+            if session.pins:
+                continue
+            del self.sessions[session_id]
+            self.nbytes -= session.nbytes
+            session.close(evicted = True)
+
+    def _evictable(self):
+        # Least recently used session without a request in flight, the one just used is kept
+        newest = next(reversed(self.sessions), None)
+        for session_id, session in self.sessions.items():
+            if session_id != newest and not session.pins:
+                return session_id
+        return None
+
+    def _evict(self):
+        while len(self.sessions) > self.max_sessions or self.nbytes > self.max_total_bytes:
+            session_id = self._evictable()
+            if session_id is None:
+                break
+            session = self.sessions.pop(session_id)
+            self.nbytes -= session.nbytes
+            session.close(evicted = True)
+
+        # A single session larger than the global budget is shrunk instead
+        if self.nbytes > self.max_total_bytes and self.sessions:
+            session = next(reversed(self.sessions.values()))
+            self.nbytes -= session.shrink(self.max_total_bytes)
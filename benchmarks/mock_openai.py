@@ -0,0 +1,190 @@
+import asyncio
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+# Stand-in for the chat completions API. It answers with canned text after a
+# configurable delay, streamed or not, and counts what it receives.
+
+ANSWER_WORDS = ("The screenshot shows a settings page with a sidebar on the left. The Parameters icon is the gear "
+                "in the top right corner, next to your profile picture. Click it, then open the Advanced tab and "
+                "check that every field of the table matches the types you expect for your use case.").split()
+
+
+class MockSettings:
+    def __init__(self, latency = 0.5, tokens_per_second = 50.0, completion_tokens = 150, jitter = 0.1,
+                 slow_rate = 0.0, slow_latency = 5.0, error_rate = 0.0):
+        self.latency = latency  # Seconds before the first token
+        self.tokens_per_second = tokens_per_second  # 0 answers at once
+        self.completion_tokens = completion_tokens
+        self.jitter = jitter  # Relative random variation of the latency
+        self.slow_rate = slow_rate  # Share of the requests waiting slow_latency instead, a latency tail
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate  # Share of the requests answered with a 500
+
+    def update(self, **values):
+        for name, value in values.items():
+            if not hasattr(self, name):
+                raise AttributeError(f"Unknown mock setting {name}")
+            setattr(self, name, value)
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.request_bytes = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+    def started(self, size):
+        with self.lock:
+            self.requests += 1
+            self.request_bytes += size
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests,
+                    "request_bytes_mean": self.request_bytes / self.requests if self.requests else 0,
+                    "max_in_flight": self.max_in_flight}
+
+
+_completion_ids = itertools.count(1)
+
+
+def chunk(completion_id, model, delta, finish_reason = None):
+    return "data: " + json.dumps({
+        "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }) + "\n\n"
+
+
+def create_app(settings, stats):
+    app = FastAPI()
+
+    def first_token_delay():
+        latency = settings.slow_latency if random.random() < settings.slow_rate else settings.latency
+        return max(0.0, latency * (1 + random.uniform(-settings.jitter, settings.jitter)))
+
+    def answer_tokens(max_tokens):
+        count = settings.completion_tokens if max_tokens is None else min(settings.completion_tokens, max_tokens)
+        return [word + " " for word in itertools.islice(itertools.cycle(ANSWER_WORDS), count)]
+
+    async def emit_tokens(tokens):
+        # Paced at tokens_per_second
+        for token in tokens:
+            if settings.tokens_per_second > 0:
+                await asyncio.sleep(1 / settings.tokens_per_second)
+            yield token
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        try:
+            body = await request.body()
+        except ClientDisconnect:
+            return Response(status_code = 499)  # e.g. the losing request of a hedge, cancelled
+        stats.started(len(body))
+        payload = json.loads(body)
+        model = payload.get("model", "mock")
+        completion_id = f"chatcmpl-mock-{next(_completion_ids)}"
+        tokens = answer_tokens(payload.get("max_tokens"))
+
+        if random.random() < settings.error_rate:
+            stats.finished()
+            return JSONResponse({"error": {"message": "Mock failure", "type": "server_error"}}, status_code = 500)
+
+        if payload.get("stream"):
+            async def event_stream():
+                try:
+                    await asyncio.sleep(first_token_delay())
+                    yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+                    async for token in emit_tokens(tokens):
+                        yield chunk(completion_id, model, {"content": token})
+                    yield chunk(completion_id, model, {}, "stop")
+                    yield "data: [DONE]\n\n"
+                finally:
+                    stats.finished()
+
+            return StreamingResponse(event_stream(), media_type = "text/event-stream")
+
+        try:
+            await asyncio.sleep(first_token_delay())
+            async for _ in emit_tokens(tokens):
+                pass
+        finally:
+            stats.finished()
+        return {
+            "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": len(tokens),
+                      "total_tokens": len(body) // 4 + len(tokens)},
+        }
+
+    return app
+
+
+def free_port(host = "127.0.0.1"):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+class ThreadedServer(uvicorn.Server):
+    # Runs in a background thread of the benchmark process, signals stay with the main thread
+    def install_signal_handlers(self):
+        pass
+
+
+class MockOpenAI:
+    # The mock server running in a daemon thread, base_url is what OPENAI_BASE_URL should be.
+    # Each instance has its own settings, e.g. a slow primary and a fast fallback backend.
+    def __init__(self, host = "127.0.0.1", port = None, **settings):
+        self.host = host
+        self.port = port or free_port(host)
+        self.settings = MockSettings(**settings)
+        self.stats = MockStats()
+        self.app = create_app(self.settings, self.stats)
+        self.server = ThreadedServer(uvicorn.Config(self.app, host = host, port = self.port, log_level = "warning"))
+        self.thread = threading.Thread(target = self.server.run, daemon = True)
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self, timeout = 10):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("Mock OpenAI server did not start")
+            time.sleep(0.05)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout = 10)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
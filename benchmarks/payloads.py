@@ -0,0 +1,56 @@
+import base64
+import io
+import random
+from functools import lru_cache
+
+from PIL import Image, ImageDraw
+
+# Synthetic screenshots: flat UI colors, panels and lines of text, so they
+# compress like real screen captures rather than like noise
+
+PALETTE = [(245, 246, 248), (255, 255, 255), (33, 37, 41), (13, 110, 253), (222, 226, 230), (108, 117, 125)]
+WORDS = "settings file edit view parameters database table column value error warning save cancel open".split()
+
+
+@lru_cache(maxsize = 64)
+def screenshot(seed, width = 1920, height = 1080):
+    # PNG bytes, the same seed always gives the same image
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), PALETTE[0])
+    draw = ImageDraw.Draw(image)
+
+    draw.rectangle((0, 0, width, 40), fill = PALETTE[2])  # Title bar
+    sidebar = rng.randint(200, 320)
+    draw.rectangle((0, 40, sidebar, height), fill = PALETTE[4])
+    for y in range(60, height - 20, 28):
+        draw.text((16, y), " ".join(rng.choices(WORDS, k = 2)), fill = PALETTE[2])
+
+    # Content panels filled with text lines and a few buttons
+    x = sidebar + 24
+    while x < width - 200:
+        panel_width = rng.randint(300, 600)
+        y = 64
+        while y < height - 120:
+            panel_height = rng.randint(120, 360)
+            draw.rectangle((x, y, x + panel_width, y + panel_height), fill = PALETTE[1], outline = PALETTE[4])
+            for line_y in range(y + 12, y + panel_height - 16, 18):
+                line = " ".join(rng.choices(WORDS, k = rng.randint(3, panel_width // 50)))
+                draw.text((x + 12, line_y), line, fill = PALETTE[rng.choice((2, 5))])
+            if rng.random() < 0.5:
+                draw.rectangle((x + panel_width - 110, y + panel_height - 40, x + panel_width - 12, y + panel_height - 12),
+                               fill = PALETTE[3])
+            y += panel_height + 24
+        x += panel_width + 24
+
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def data_url(png):
+    return "data:image/png;base64," + base64.b64encode(png).decode("ascii")
+
+
+@lru_cache(maxsize = 64)
+def screenshot_data_url(seed):
+    return data_url(screenshot(seed))
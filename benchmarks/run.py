@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from benchmarks.mock_openai import MockOpenAI, free_port
+from benchmarks.payloads import screenshot, screenshot_data_url
+
+# Load test of app.main:app against the mock OpenAI server. Every scenario
+# starts a fresh backend process so its peak RSS and caches are its own.
+#
+#   python -m benchmarks.run                       all scenarios
+#   python -m benchmarks.run -s stream,upload      some of them
+#   python -m benchmarks.run --scale 0.25          fewer requests, quick check
+#   python -m benchmarks.run --compare old.json    deltas against an earlier run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+IMAGE_POOL = 8  # Distinct screenshots the requests pick from
+QUESTION = "Where is the Parameters icon on this screen?"
+# Mock upstream used unless a scenario overrides it, about 0.8s per answer
+MOCK_DEFAULTS = {"latency": 0.3, "tokens_per_second": 200.0, "completion_tokens": 100, "jitter": 0.1,
+                 "slow_rate": 0.0, "slow_latency": 5.0, "error_rate": 0.0}
+STARTUP_TIMEOUT = 30
+
+
+class Scenario:
+    def __init__(self, name, endpoint, requests = 200, concurrency = 16, images = 1, turns = 1, batch_items = 0,
+                 bypass_cache = True, mock = None, env = None, fallback = None):
+        self.name = name
+        self.endpoint = endpoint
+        self.requests = requests
+        self.concurrency = concurrency
+        self.images = images  # Screenshots per request, or per batch item
+        self.turns = turns  # Requests sent one after the other in the same session
+        self.batch_items = batch_items
+        self.bypass_cache = bypass_cache
+        self.mock = dict(MOCK_DEFAULTS, **(mock or {}))
+        self.env = env or {}  # Extra backend configuration
+        # Settings of a second mock upstream, listed after the first one in LLM_BACKENDS
+        self.fallback = dict(MOCK_DEFAULTS, **fallback) if fallback is not None else None
+
+    @property
+    def streaming(self):
+        return self.endpoint.endswith("/stream")
+
+    @property
+    def multipart(self):
+        return self.endpoint.startswith("/chatGPT/upload")
+
+    def scaled(self, scale):
+        return Scenario(self.name, self.endpoint, max(self.turns, int(self.requests * scale)), self.concurrency,
+                        self.images, self.turns, self.batch_items, self.bypass_cache, self.mock, self.env,
+                        self.fallback)
+
+    def describe(self):
+        return {"endpoint": self.endpoint, "requests": self.requests, "concurrency": self.concurrency,
+                "images": self.images, "turns": self.turns, "batch_items": self.batch_items,
+                "bypass_cache": self.bypass_cache, "mock": self.mock, "env": self.env, "fallback": self.fallback}
+
+
+SCENARIOS = [
+    Scenario("text", "/chatGPT", images = 0),
+    Scenario("json", "/chatGPT"),
+    Scenario("json_two_images", "/chatGPT", images = 2),
+    Scenario("upload", "/chatGPT/upload"),
+    Scenario("stream", "/chatGPT/stream"),
+    Scenario("upload_stream", "/chatGPT/upload/stream"),
+    Scenario("conversation", "/chatGPT", requests = 128, concurrency = 8, turns = 8),
+    Scenario("cached", "/chatGPT", bypass_cache = False),
+    Scenario("batch", "/chatGPT/batch", requests = 32, concurrency = 4, batch_items = 4),
+    Scenario("saturation", "/chatGPT", requests = 512, concurrency = 128, mock = {"latency": 1.0}),
+    # 4% of the primary's answers are 5s late, the hedged requests go to the second backend
+    Scenario("hedged", "/chatGPT", mock = {"slow_rate": 0.04, "slow_latency": 5.0}, fallback = {},
+             env = {"HEDGE_DEFAULT_DELAY": "1.5"}),
+    Scenario("hedged_stream", "/chatGPT/stream", mock = {"slow_rate": 0.04, "slow_latency": 5.0}, fallback = {},
+             env = {"HEDGE_DEFAULT_DELAY": "1.0"}),
+    # A third of the primary's answers fail, they are retried on the second backend
+    Scenario("failover", "/chatGPT", mock = {"error_rate": 0.3}, fallback = {}),
+]
+
+
+class AppServer:
+    # app.main:app in its own uvicorn process, pointed at the mock server
+    def __init__(self, upstream_url, env = None):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        # Conversations are persisted as usual, in a database thrown away afterwards
+        self.data_dir = tempfile.mkdtemp(prefix = "screengpt-bench-")
+        self.env = dict(os.environ, OPENAI_BASE_URL = upstream_url, OPEN_API_KEY = "benchmark",
+                        RESPONSE_CACHE_DIR = "", DATABASE_PATH = os.path.join(self.data_dir, "screengpt.db"))
+        self.env.update(env or {})
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--log-level", "warning"], cwd = ROOT, env = self.env)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Backend exited with code {self.process.returncode}")
+            try:
+                if httpx.get(f"{self.url}/health", timeout = 1).status_code == 200:
+                    return self
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("Backend did not start")
+
+    def health(self):
+        try:
+            return httpx.get(f"{self.url}/health", timeout = 5).json()
+        except (httpx.HTTPError, ValueError):
+            return None
+
+    def peak_rss_mb(self):
+        # High water mark of the resident set, Linux only
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout = 10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        shutil.rmtree(self.data_dir, ignore_errors = True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def build_request(client, url, scenario, session_id, number):
+    seeds = [(number * max(1, scenario.images) + k) % IMAGE_POOL for k in range(scenario.images)]
+    if scenario.batch_items:
+        items = [{"text": QUESTION, "images": [screenshot_data_url((seed + i) % IMAGE_POOL) for seed in seeds]}
+                 for i in range(scenario.batch_items)]
+        payload = {"session_id": session_id, "items": items, "bypass_cache": scenario.bypass_cache}
+        return client.build_request("POST", url + scenario.endpoint, json = payload)
+    if scenario.multipart:
+        form = {"session_id": session_id, "text": QUESTION, "bypass_cache": str(scenario.bypass_cache).lower()}
+        files = [("images", (f"screenshot_{seed}.png", screenshot(seed), "image/png")) for seed in seeds]
+        return client.build_request("POST", url + scenario.endpoint, data = form, files = files or None)
+    payload = {"session_id": session_id, "text": QUESTION, "images": [screenshot_data_url(seed) for seed in seeds],
+               "bypass_cache": scenario.bypass_cache}
+    return client.build_request("POST", url + scenario.endpoint, json = payload)
+
+
+async def send(client, request, streaming):
+    # One request, returns its sample: latency, time to first token, outcome and size
+    size = len(request.read())
+    start = time.perf_counter()
+    first_token = None
+    status = None
+    try:
+        response = await client.send(request, stream = True)
+        try:
+            status = response.status_code
+            if status == 200 and streaming:
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[len("data:"):])
+                    if "delta" in event:
+                        if first_token is None:
+                            first_token = time.perf_counter() - start
+                    elif "error" in event:
+                        status = event.get("status", "stream error")
+                        break
+                    elif event.get("done"):
+                        break
+            else:
+                await response.aread()
+        finally:
+            await response.aclose()
+    except httpx.HTTPError as e:
+        status = e.__class__.__name__
+    return {"latency": time.perf_counter() - start, "first_token": first_token, "status": status, "bytes": size}
+
+
+async def drive(url, scenario, warmup = 0):
+    # Sessions run concurrently, the turns of a session one after the other
+    limits = httpx.Limits(max_connections = scenario.concurrency, max_keepalive_connections = scenario.concurrency)
+    async with httpx.AsyncClient(limits = limits, timeout = httpx.Timeout(300.0)) as client:
+        semaphore = asyncio.Semaphore(scenario.concurrency)
+        samples = []
+
+        async def conversation(index, prefix):
+            async with semaphore:
+                session_id = f"{prefix}-{scenario.name}-{index}"
+                for turn in range(scenario.turns):
+                    request = build_request(client, url, scenario, session_id, index * scenario.turns + turn)
+                    samples.append(await send(client, request, scenario.streaming))
+
+        if warmup:
+            await asyncio.gather(*(conversation(i, "warmup") for i in range(warmup)))
+            samples.clear()
+
+        sessions = max(1, scenario.requests // scenario.turns)
+        start = time.perf_counter()
+        await asyncio.gather(*(conversation(i, "bench") for i in range(sessions)))
+        return samples, time.perf_counter() - start
+
+
+def percentile(values, q):
+    # Linear interpolation between the closest ranks
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def distribution(values, scale = 1000.0):
+    if not values:
+        return None
+    values = [value * scale for value in values]
+    return {"p50": round(percentile(values, 50), 1), "p95": round(percentile(values, 95), 1),
+            "p99": round(percentile(values, 99), 1), "mean": round(sum(values) / len(values), 1),
+            "max": round(max(values), 1)}
+
+
+def run_scenario(mock, scenario):
+    mock.settings.update(**scenario.mock)
+    with contextlib.ExitStack() as stack:
+        env = dict(scenario.env)
+        fallback = None
+        if scenario.fallback is not None:
+            fallback = stack.enter_context(MockOpenAI(**scenario.fallback))
+            env["LLM_BACKENDS"] = json.dumps([{"name": "primary", "model": "mock-primary", "base_url": mock.base_url},
+                                              {"name": "fallback", "model": "mock-fallback",
+                                               "base_url": fallback.base_url}])
+        server = stack.enter_context(AppServer(mock.base_url, env))
+        asyncio.run(drive(server.url, scenario, warmup = min(scenario.concurrency, 4) // scenario.turns or 1))
+        mock.stats.reset()
+        if fallback is not None:
+            fallback.stats.reset()
+        samples, wall = asyncio.run(drive(server.url, scenario))
+        peak_rss = server.peak_rss_mb()
+        health = server.health()
+        fallback_stats = fallback.stats.snapshot() if fallback is not None else None
+
+    ok = [sample for sample in samples if sample["status"] == 200]
+    errors = Counter(str(sample["status"]) for sample in samples if sample["status"] != 200)
+    sizes = [sample["bytes"] for sample in samples]
+    return {
+        "name": scenario.name,
+        "config": scenario.describe(),
+        "requests": len(samples),
+        "errors": sum(errors.values()),
+        "error_statuses": dict(errors),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 2) if wall else None,
+        "latency_ms": distribution([sample["latency"] for sample in ok]),
+        "first_token_ms": distribution([sample["first_token"] for sample in ok if sample["first_token"] is not None]),
+        "request_bytes": {"mean": round(sum(sizes) / len(sizes)) if sizes else 0, "max": max(sizes, default = 0),
+                          "total": sum(sizes)},
+        "upstream": mock.stats.snapshot(),
+        "fallback_upstream": fallback_stats,
+        "peak_rss_mb": peak_rss,
+        "server_stats": health,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = ROOT, capture_output = True,
+                              text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(old, new):
+    if old is None or new is None:
+        return "n/a"
+    if not old:
+        return f"{old} -> {new}"
+    return f"{old} -> {new} ({(new - old) / old * 100:+.1f}%)"
+
+
+def compare(baseline, report):
+    # Prints the main figures of both runs side by side
+    previous = {scenario["name"]: scenario for scenario in baseline["scenarios"]}
+    print(f"\nCompared with {baseline.get('commit')} ({baseline.get('timestamp')})")
+    for scenario in report["scenarios"]:
+        old = previous.get(scenario["name"])
+        if old is None:
+            continue
+        old_latency = old["latency_ms"] or {}
+        new_latency = scenario["latency_ms"] or {}
+        print(f"  {scenario['name']}")
+        for q in ("p50", "p95", "p99"):
+            print(f"    {q} ms:       {change(old_latency.get(q), new_latency.get(q))}")
+        print(f"    throughput:   {change(old['throughput_rps'], scenario['throughput_rps'])}")
+        print(f"    errors:       {change(old['errors'], scenario['errors'])}")
+        print(f"    peak RSS MB:  {change(old['peak_rss_mb'], scenario['peak_rss_mb'])}")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Load test the backend against a mock OpenAI server")
+    parser.add_argument("-s", "--scenarios", help = "Comma separated scenario names, all by default")
+    parser.add_argument("--scale", type = float, default = 1.0, help = "Multiplier of the number of requests")
+    parser.add_argument("-o", "--output", help = "Result file, benchmarks/results/<timestamp>.json by default")
+    parser.add_argument("--compare", help = "Earlier result file to print the differences with")
+    parser.add_argument("--list", action = "store_true", help = "List the scenarios and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for scenario in SCENARIOS:
+            print(f"{scenario.name:16} {json.dumps(scenario.describe())}")
+        return
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        names = args.scenarios.split(",")
+        unknown = set(names) - {scenario.name for scenario in SCENARIOS}
+        if unknown:
+            parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        scenarios = [scenario for scenario in SCENARIOS if scenario.name in names]
+    scenarios = [scenario.scaled(args.scale) for scenario in scenarios]
+
+    timestamp = datetime.datetime.now()
+    report = {"timestamp": timestamp.isoformat(timespec = "seconds"), "commit": git_commit(),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "cpus": os.cpu_count(), "scenarios": []}
+    with MockOpenAI() as mock:
+        for scenario in scenarios:
+            result = run_scenario(mock, scenario)
+            report["scenarios"].append(result)
+            latency = result["latency_ms"] or {}
+            print(f"{scenario.name:16} {result['requests']:5d} req  {result['errors']:4d} err  "
+                  f"{result['throughput_rps'] or 0:8.2f} req/s  p50 {latency.get('p50')} p95 {latency.get('p95')} "
+                  f"p99 {latency.get('p99')} ms  peak RSS {result['peak_rss_mb']} MB", flush = True)
+
+    output = args.output or os.path.join(RESULTS_DIR, timestamp.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent = 2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
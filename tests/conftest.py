@@ -0,0 +1,111 @@
+import asyncio
+import base64
+import io
+import os
+import random
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from PIL import Image
+
+# The app reads its settings when imported: a fake key, and the module-level
+# instance keeps nothing on disk. Tests that persist use their own database.
+os.environ.setdefault("OPEN_API_KEY", "test")
+os.environ.setdefault("DATABASE_PATH", "")
+
+
+def png(seed, size = 64):
+    # Noise does not compress, each image weighs about size * size * 3 bytes
+    rng = random.Random(seed)
+    image = Image.frombytes("RGB", (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3)))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def data_url(data, mime = "image/png"):
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+@pytest.fixture
+def screenshot():
+    # screenshot(seed) -> PNG bytes, screenshot(seed, url = True) -> data URL
+    def make(seed, size = 64, url = False):
+        data = png(seed, size)
+        return data_url(data) if url else data
+    return make
+
+
+def completion(text):
+    return SimpleNamespace(choices = [SimpleNamespace(message = SimpleNamespace(content = text))], usage = None)
+
+
+def completion_chunk(text):
+    return SimpleNamespace(choices = [SimpleNamespace(delta = SimpleNamespace(content = text))])
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+def prompt(params):
+    # Text of the last message of an upstream call
+    content = params["messages"][-1]["content"]
+    if isinstance(content, list):
+        return " ".join(item["text"] for item in content if item.get("type") == "text")
+    return content
+
+
+class FakeUpstream:
+    # Stands for AsyncOpenAI: client.chat.completions.create answers "answer <n>"
+    # for the n-th call, after delay (or delays[prompt]), or raises error
+    def __init__(self):
+        self.chat = self.completions = self
+        self.calls = []
+        self.delay = 0.0
+        self.delays = {}
+        self.error = None
+
+    async def create(self, model, stream = False, **params):
+        self.calls.append(params)
+        await asyncio.sleep(self.delays.get(prompt(params), self.delay))
+        if self.error is not None:
+            raise self.error
+        text = f"answer {len(self.calls)}"
+        if stream:
+            return FakeStream([completion_chunk(word + " ") for word in text.split()])
+        return completion(text)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # The app's upstream replaced by a FakeUpstream, with an empty response cache
+    from app.main import chatgpt
+    from app.services.LLM.router import Backend, BackendRouter
+    from app.services.cache.response_cache import ResponseCache
+
+    fake = FakeUpstream()
+    monkeypatch.setattr(chatgpt, "router", BackendRouter([Backend("fake", fake, chatgpt.model)]))
+    monkeypatch.setattr(chatgpt, "response_cache", ResponseCache(directory = ""))
+    monkeypatch.setattr(chatgpt, "normalizer", None)
+    return fake
+
+
+@pytest.fixture
+def api(upstream):
+    # Returns a function opening an httpx client on the app, use it inside asyncio.run
+    from app.main import app
+
+    def client():
+        return httpx.AsyncClient(transport = httpx.ASGITransport(app = app), base_url = "http://screengpt.test")
+    return client
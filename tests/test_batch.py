@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+from app import main
+from app.main import MAX_BATCH_ITEMS, chatgpt
+
+
+def post_batch(api, payload):
+    async def run():
+        async with api() as client:
+            return await client.post("/chatGPT/batch", json = payload)
+    return asyncio.run(run())
+
+
+def test_results_in_item_order_and_recorded_in_the_session(api, upstream, screenshot):
+    upstream.delays = {"first": 0.1}  # Answered last, still first in the results and history
+    items = [{"text": "first", "images": [screenshot(1, url = True)]}, {"text": "second"}, {"text": "third"}]
+    response = post_batch(api, {"items": items})
+    assert response.status_code == 200
+    body = response.json()
+    assert [result["index"] for result in body["results"]] == [0, 1, 2]
+    assert all(not result["cached"] and result["response"].startswith("answer") for result in body["results"])
+
+    history = chatgpt.session_manager.get(body["session_id"]).snapshot()
+    assert [message["content"][0]["text"] for message in history if message["role"] == "user"] == \
+        ["first", "second", "third"]
+
+
+def test_failures_are_reported_per_item(api, upstream):
+    response = post_batch(api, {"items": [{"text": "fine"}, {"text": "broken", "images": ["data:image/png;base64,AAAA"]}]})
+    results = response.json()["results"]
+    assert response.status_code == 200
+    assert "response" in results[0]
+    assert results[1]["status"] == 400
+
+
+def test_slow_item_times_out_alone(api, upstream, monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_TIMEOUT", 0.2)
+    monkeypatch.setattr(chatgpt.scheduler, "max_wait", 0.0)
+    upstream.delays = {"slow": 1.0}
+    response = post_batch(api, {"items": [{"text": "fast"}, {"text": "slow"}]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert "response" in results[0]
+    assert results[1] == {"index": 1, "error": "Upstream timed out", "status": 504}
+
+
+def test_slow_single_item_is_a_504_result_not_a_server_error(api, upstream, monkeypatch):
+    monkeypatch.setattr(main, "UPSTREAM_TIMEOUT", 0.2)
+    monkeypatch.setattr(chatgpt.scheduler, "max_wait", 0.0)
+    upstream.delay = 1.0
+    response = post_batch(api, {"items": [{"text": "slow"}]})
+    assert response.status_code == 200
+    assert response.json()["results"][0]["status"] == 504
+
+
+def test_empty_and_oversized_batches_are_rejected(api, upstream):
+    assert post_batch(api, {"items": []}).status_code == 422
+    assert post_batch(api, {"items": [{"text": "q"}] * (MAX_BATCH_ITEMS + 1)}).status_code == 413
+    assert upstream.calls == []
+
+
+def test_streamed_batch_sends_each_item_then_done(api, upstream):
+    upstream.delays = {"first": 0.1}
+    response = post_batch(api, {"items": [{"text": "first"}, {"text": "second"}], "stream": True})
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert [event.get("index") for event in events[:2]] == [1, 0]  # As soon as each one is answered
+    assert events[-1]["done"]
@@ -0,0 +1,112 @@
+import json
+import sqlite3
+
+import pytest
+
+from app.db.conversation_store import ConversationStore
+
+
+def message(role, text, *digests):
+    content = [{"type": "text", "text": text}] + [{"type": "image_ref", "digest": digest} for digest in digests]
+    return {"role": role, "content": content}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConversationStore(str(tmp_path / "conversations.db"), flush_interval = 0.01)
+    yield store
+    store.close()
+
+
+def test_writes_are_committed_in_batches(tmp_path):
+    store = ConversationStore(str(tmp_path / "conversations.db"), batch_size = 4, flush_interval = 0.2)
+    batches = []
+    write = store._write
+    store._write = lambda connection, batch: (batches.append(len(batch)), write(connection, batch))
+    store.append_messages("s", [message("user", f"question {i}") for i in range(10)])
+    assert store.flush(timeout = 5)
+    store.close()
+
+    assert sum(batches) == 10
+    assert max(batches) <= 4
+    assert len(batches) <= 4  # Queued together, not one transaction per message
+
+
+def test_flush_makes_writes_visible(store):
+    assert not store.has_session("s")
+    store.append_messages("s", [message("user", "question"), {"role": "assistant", "content": "answer"}])
+    assert store.flush(timeout = 5)
+
+    assert store.has_session("s")
+    assert store.recent_messages("s", 10) == [message("user", "question"), {"role": "assistant", "content": "answer"}]
+    assert store.recent_messages("s", 1) == [{"role": "assistant", "content": "answer"}]
+
+
+def test_pages_go_back_from_the_newest_message(store):
+    store.append_messages("s", [message("user", f"question {i}") for i in range(7)])
+    store.append_messages("other", [message("user", "elsewhere")])
+    store.flush(timeout = 5)
+
+    texts, before = [], None
+    while True:
+        rows, before = store.page("s", before = before, limit = 3)
+        texts.append([row["content"][0]["text"] for row in rows])
+        if before is None:
+            break
+    assert texts == [["question 6", "question 5", "question 4"],
+                     ["question 3", "question 2", "question 1"],
+                     ["question 0"]]
+
+
+def test_delete_keeps_images_other_sessions_reference(store):
+    store.save_image("shared", "image/png", 1, 1, b"shared")
+    store.save_image("own", "image/png", 1, 1, b"own")
+    store.append_messages("a", [message("user", "both", "shared", "own")])
+    store.append_messages("b", [message("user", "one", "shared")])
+    store.flush(timeout = 5)
+    assert store.session_images("a") == {"shared", "own"}
+
+    store.delete_session("a", store.session_images("a"))
+    store.flush(timeout = 5)
+
+    assert not store.has_session("a")
+    assert store.session_images("a") == set()
+    assert store.load_image("own") is None
+    assert store.load_image("shared") == (b"shared", "image/png", 1, 1)
+    assert store.session_images("b") == {"shared"}
+
+
+def test_deleted_images_are_written_again(store):
+    store.save_image("digest", "image/png", 1, 1, b"data")
+    store.append_messages("a", [message("user", "question", "digest")])
+    store.flush(timeout = 5)
+    store.delete_session("a", ["digest"])
+    store.flush(timeout = 5)
+    assert store.load_image("digest") is None
+
+    store.save_image("digest", "image/png", 1, 1, b"data")
+    store.flush(timeout = 5)
+    assert store.load_image("digest") is not None
+
+
+def test_references_of_older_databases_are_indexed(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,
+                               role TEXT NOT NULL, content TEXT NOT NULL, created REAL NOT NULL);
+        CREATE TABLE images (digest TEXT PRIMARY KEY, mime TEXT NOT NULL, width INTEGER NOT NULL,
+                             height INTEGER NOT NULL, data BLOB NOT NULL);
+    """)
+    connection.execute("INSERT INTO messages (session_id, role, content, created) VALUES (?, ?, ?, 0)",
+                       ("old", "user", json.dumps(message("user", "question", "digest")["content"])))
+    connection.execute("INSERT INTO images VALUES ('digest', 'image/png', 1, 1, x'00')")
+    connection.commit()
+    connection.close()
+
+    store = ConversationStore(path, flush_interval = 0.01)
+    assert store.session_images("old") == {"digest"}
+    store.delete_session("old", ["digest"])
+    store.flush(timeout = 5)
+    assert store.load_image("digest") is None
+    store.close()
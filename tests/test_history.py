@@ -0,0 +1,83 @@
+import asyncio
+
+from app.services.images.image_store import ImageStore
+from app.services.LLM.history import (HistoryManager, LOW_DETAIL_IMAGE_TOKENS, OMITTED_IMAGE_TEXT, image_tokens,
+                                      text_tokens)
+
+
+def user(text, *digests):
+    return {"role": "user", "content": [{"type": "text", "text": text}] +
+            [{"type": "image_ref", "digest": digest} for digest in digests]}
+
+
+def conversation(store, screenshot, turns):
+    messages = [{"role": "system", "content": "context"}]
+    for i in range(turns):
+        digest = store.put(screenshot(i, size = 512, url = True))
+        messages.append(user(f"question {i}", digest))
+        messages.append({"role": "system", "content": f"answer {i} " + "x" * 400})
+    return messages
+
+
+def test_image_tokens():
+    assert image_tokens(512, 512) == 170 + 85
+    assert image_tokens(4000, 1000) == image_tokens(2048, 512)  # Fit in 2048x2048 first
+    assert image_tokens(1920, 1080, "low") == LOW_DETAIL_IMAGE_TOKENS
+    assert text_tokens("x" * 9) == 3
+
+
+def test_history_within_budget_is_unchanged(screenshot):
+    history = HistoryManager(ImageStore(), budget = 100000)
+    messages = conversation(history.image_store, screenshot, 3)
+    assert history.compact(messages) == (messages, [], 0)
+
+
+def test_old_images_are_degraded_before_turns_are_dropped(screenshot):
+    store = ImageStore()
+    messages = conversation(store, screenshot, 4) + [user("new question")]
+    full = sum(map(HistoryManager(store).message_tokens, messages))
+    history = HistoryManager(store, budget = full - 400, keep_image_turns = 2)
+
+    kept, dropped, trimmed = history.compact(messages)
+
+    assert dropped == []
+    assert len(kept) == len(messages) and kept[-1] == messages[-1]
+    assert sum(map(history.message_tokens, kept)) <= history.budget
+    assert trimmed == full - sum(map(history.message_tokens, kept))
+    # The last two user turns keep their images in full detail
+    images = [item for message in kept[7:] if isinstance(message["content"], list)
+              for item in message["content"] if item["type"] == "image_ref"]
+    assert images and all("detail" not in item for item in images)
+    first = kept[1]["content"][1]
+    assert first.get("detail") == "low" or first == {"type": "text", "text": OMITTED_IMAGE_TEXT}
+
+
+def test_window_slides_when_degrading_is_not_enough(screenshot):
+    store = ImageStore()
+    messages = conversation(store, screenshot, 10) + [user("new question")]
+    history = HistoryManager(store, budget = 800, keep_image_turns = 1)
+
+    kept, dropped, trimmed = history.compact(messages)
+
+    assert kept[0] == messages[0] and kept[-1] == messages[-1]
+    assert dropped and dropped[0]["content"][0] == {"type": "text", "text": "question 0"}
+    assert sum(map(history.message_tokens, kept)) <= history.budget * 0.75
+    assert trimmed > 0
+
+
+def test_dropped_turns_are_summarized_once(screenshot):
+    store = ImageStore()
+    messages = conversation(store, screenshot, 10) + [user("new question")]
+    history = HistoryManager(store, budget = 800, keep_image_turns = 1, summarize = True)
+    calls = []
+
+    async def summarizer(transcript):
+        calls.append(transcript)
+        return "they asked about screenshots"
+
+    kept, _ = asyncio.run(history.acompact(messages, summarizer))
+    again, _ = asyncio.run(history.acompact(messages, summarizer))
+
+    assert kept == again
+    assert len(calls) == 1 and "user: question 0 [earlier screenshot omitted]" in calls[0]
+    assert kept[1] == {"role": "system", "content": "Summary of the earlier conversation: they asked about screenshots"}
@@ -0,0 +1,126 @@
+import asyncio
+import io
+import random
+
+import pytest
+from PIL import Image
+
+from app.services.LLM.gpt4_vision import ChatGPT
+from app.services.images.image_store import ImageStore, UnknownImage
+
+
+def png(seed, size = 64):
+    # Noise does not compress, each image weighs about size * size * 3 bytes
+    rng = random.Random(seed)
+    image = Image.frombytes("RGB", (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3)))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def ref_message(*digests):
+    return {"role": "user", "content": [{"type": "image_ref", "digest": digest} for digest in digests]}
+
+
+def test_unreferenced_images_are_evicted_first():
+    images = [png(seed) for seed in range(3)]
+    store = ImageStore(max_bytes = len(images[0]) * 2 + 100)
+    kept = store.put_bytes(images[0], "image/png", retain = True)
+    dropped = store.put_bytes(images[1], "image/png")
+    store.put_bytes(images[2], "image/png")
+    assert store.get(kept).data == images[0]
+    with pytest.raises(UnknownImage):
+        store.get(dropped)
+
+
+def test_released_images_become_evictable():
+    images = [png(seed) for seed in range(2)]
+    store = ImageStore(max_bytes = len(images[0]) + 100)
+    first = store.put_bytes(images[0], "image/png", retain = True)
+    store.retain([first])
+    store.release([first])
+    store.put_bytes(images[1], "image/png", retain = True)
+    assert store.stats()["images"] == 2  # Still referenced once, over budget rather than lost
+    store.release([first])
+    assert store.stats()["images"] == 1
+    with pytest.raises(UnknownImage):
+        store.get(first)
+
+
+def test_referenced_images_stay_within_budget_once_persisted():
+    # 60 turns with a screenshot each, all kept by a live history
+    storage = {}
+    images = [png(seed) for seed in range(60)]
+    store = ImageStore(max_bytes = len(images[0]) * 5, load = storage.get)
+    digests = []
+    for data in images:
+        digest = store.put_bytes(data, "image/png", retain = True)
+        storage[digest] = data
+        store.mark_persisted([digest])
+        digests.append(digest)
+        assert store.nbytes <= store.max_bytes
+    assert store.stats()["in_storage"] >= 55
+
+    # Every image is still there, read back from storage
+    for digest, data in zip(digests, images):
+        assert store.get(digest).data == data
+        assert store.nbytes <= store.max_bytes
+    resolved = store.resolve_messages([ref_message(*digests[:3])])
+    assert all(item["type"] == "image_url" for item in resolved[0]["content"])
+
+
+def test_images_not_persisted_are_never_dropped_while_referenced():
+    images = [png(seed) for seed in range(3)]
+    store = ImageStore(max_bytes = len(images[0]), load = {}.get)
+    digests = [store.put_bytes(data, "image/png", retain = True) for data in images]
+    assert [store.get(digest).data for digest in digests] == images
+
+
+def test_last_release_forgets_an_image_left_in_storage():
+    storage = {}
+    images = [png(seed) for seed in range(2)]
+    store = ImageStore(max_bytes = len(images[0]) + 100, load = storage.get)
+    first = store.put_bytes(images[0], "image/png", retain = True)
+    storage[first] = images[0]
+    store.mark_persisted([first])
+    store.put_bytes(images[1], "image/png", retain = True)
+    assert store.get(first, load = False).data is None
+    store.release([first])
+    with pytest.raises(UnknownImage):
+        store.get(first)
+    # Uploaded again, its bytes come back in memory
+    assert store.put_bytes(images[0], "image/png", retain = True) == first
+    assert store.get(first, load = False).data == images[0]
+
+
+def test_unloaded_image_keeps_its_dimensions():
+    storage = {}
+    images = [png(seed, size) for seed, size in ((0, 64), (1, 80))]
+    store = ImageStore(max_bytes = len(images[1]), load = storage.get)
+    first = store.put_bytes(images[0], "image/png", retain = True)
+    storage[first] = images[0]
+    store.mark_persisted([first])
+    store.put_bytes(images[1], "image/png", retain = True)
+    image = store.get(first, load = False)
+    assert (image.data, image.width, image.height) == (None, 64, 64)
+
+
+def test_live_session_images_are_read_back_from_the_database(tmp_path):
+    chatgpt = ChatGPT(database_path = str(tmp_path / "screengpt.db"))
+    images = [png(seed) for seed in range(60)]
+    chatgpt.image_store.max_bytes = len(images[0]) * 5
+    try:
+        session = chatgpt.session_manager.get()
+        for data in images:
+            digest = chatgpt.image_store.put_bytes(data, "image/png", retain = True)
+            chatgpt.construct_history(session, chatgpt.format_input("what is this?", [digest]), "a screenshot")
+            chatgpt.release_images([digest])
+            assert chatgpt.image_store.nbytes <= chatgpt.image_store.max_bytes
+
+        messages, _, _ = asyncio.run(chatgpt.abuild_messages(session, chatgpt.format_input("and now?")))
+        urls = [item for message in messages if isinstance(message["content"], list)
+                for item in message["content"] if item["type"] == "image_url"]
+        assert urls
+        assert chatgpt.image_store.nbytes <= chatgpt.image_store.max_bytes
+    finally:
+        chatgpt.close()
@@ -0,0 +1,84 @@
+import asyncio
+import re
+
+import pytest
+
+from app.services.metrics.metrics import Registry, RequestTiming
+
+
+def test_counter_and_gauge_rendering():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ("endpoint",))
+    state = registry.gauge("state", "State")
+    requests.inc(endpoint = "chat")
+    requests.inc(2, endpoint = "chat")
+    requests.inc(endpoint = 'say "hi"')
+    state.set(1.5)
+
+    assert registry.render().splitlines() == [
+        "# HELP screengpt_requests_total Requests",
+        "# TYPE screengpt_requests_total counter",
+        'screengpt_requests_total{endpoint="chat"} 3',
+        'screengpt_requests_total{endpoint="say \\"hi\\""} 1',
+        "# HELP screengpt_state State",
+        "# TYPE screengpt_state gauge",
+        "screengpt_state 1.5",
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", buckets = (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 5):
+        latency.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'screengpt_latency_seconds_bucket{le="0.1"} 2',
+        'screengpt_latency_seconds_bucket{le="1"} 3',
+        'screengpt_latency_seconds_bucket{le="+Inf"} 4',
+        "screengpt_latency_seconds_sum 5.65",
+        "screengpt_latency_seconds_count 4",
+    ]
+
+
+def test_labels_must_match():
+    counter = Registry().counter("errors_total", "Errors", ("error",))
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.inc(error = "timeout", extra = "label")
+
+
+def test_stages_add_up_in_the_request_timing():
+    timing = RequestTiming()
+    timing.record("upstream", 0.5)
+    timing.record("images", 0.01)
+    timing.record("upstream", 0.25)
+
+    assert timing.as_dict() == {"upstream": 750.0, "images": 10.0}
+    assert re.fullmatch(r"upstream;dur=750\.0, images;dur=10\.0, total;dur=\d+\.\d", timing.header())
+
+
+def sample(text, name):
+    match = re.search(rf"^{re.escape(name)} (\S+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+def test_requests_are_counted_and_timed(api, upstream):
+    async def run():
+        async with api() as client:
+            before = (await client.get("/metrics")).text
+            reply = await client.post("/chatGPT", json = {"text": "what is this?"})
+            after = (await client.get("/metrics")).text
+            return before, reply, after
+
+    before, reply, after = asyncio.run(run())
+
+    assert reply.status_code == 200
+    stages = {part.split(";")[0].strip() for part in reply.headers["server-timing"].split(",")}
+    assert {"parse", "upstream", "total"} <= stages
+    name = 'screengpt_http_requests_total{endpoint="chatGPT",status="200"}'
+    assert sample(after, name) == sample(before, name) + 1
+    assert sample(after, 'screengpt_stage_seconds_count{stage="upstream"}') > \
+        sample(before, 'screengpt_stage_seconds_count{stage="upstream"}')
+    assert 'screengpt_state{component="sessions",stat="sessions"}' in after
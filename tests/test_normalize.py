@@ -0,0 +1,93 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+from app.services.images.image_store import InvalidImage
+from app.services.images.normalize import ImageNormalizer, normalize_image
+
+
+def encode(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def text_screenshot(width, height):
+    # Flat background with a few dark strokes, like text on a window
+    img = Image.new("RGB", (width, height), "white")
+    for y in range(10, height - 10, 20):
+        img.paste((20, 20, 20), (10, y, width // 2, y + 4))
+    return img
+
+
+def decoded(data):
+    return Image.open(io.BytesIO(data))
+
+
+def test_large_images_are_fit_to_the_model_tiles(screenshot):
+    data, mime, width, height = normalize_image(encode(text_screenshot(3840, 2160), "PNG"))
+    assert (width, height) == (1365, 768)
+    assert decoded(data).size == (width, height)
+    assert mime == "image/png"  # Text stays lossless
+
+    photo = decoded(screenshot(1, size = 1600)).resize((3000, 1000))
+    data, mime, width, height = normalize_image(encode(photo, "PNG"))
+    assert (width, height) == (2048, 683)
+    assert mime == "image/jpeg"
+
+
+def test_compact_jpeg_is_kept_as_is():
+    original = encode(text_screenshot(800, 600).convert("RGB"), "JPEG", quality = 85)
+    assert normalize_image(original) == (original, "image/jpeg", 800, 600)
+
+
+def test_metadata_is_dropped_and_orientation_applied():
+    img = text_screenshot(400, 200)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees clockwise
+    data, mime, width, height = normalize_image(encode(img, "JPEG", exif = exif.tobytes()))
+
+    assert (width, height) == (200, 400)
+    assert len(decoded(data).getexif()) == 0
+
+
+def test_transparent_images_stay_png():
+    img = Image.new("RGBA", (300, 200), (255, 255, 255, 0))
+    img.paste((0, 0, 0, 255), (10, 10, 100, 50))
+    data, mime, _, _ = normalize_image(encode(img, "PNG"))
+    assert mime == "image/png" and decoded(data).mode == "RGBA"
+
+
+@pytest.mark.parametrize("data", [b"not an image", encode(text_screenshot(200, 200), "PNG")[:200]])
+def test_undecodable_images_are_rejected(data):
+    with pytest.raises(InvalidImage, match = "Could not decode"):
+        normalize_image(data)
+
+
+def test_too_many_pixels_are_rejected():
+    with pytest.raises(InvalidImage, match = "larger than"):
+        normalize_image(encode(text_screenshot(200, 200), "PNG"), max_pixels = 100 * 100)
+
+
+def test_normalizer_shares_identical_jobs(screenshot):
+    normalizer = ImageNormalizer(workers = 1)
+    runs = []
+    run = normalizer._run
+    normalizer._run = lambda data: runs.append(data) or run(data)
+    data = screenshot(1)
+
+    async def normalize_twice():
+        return await asyncio.gather(normalizer.normalize("digest", data), normalizer.normalize("digest", data))
+
+    try:
+        first, second = asyncio.run(normalize_twice())
+        assert first == second and first[1] in ("image/png", "image/jpeg")
+        assert len(runs) == 1
+        assert normalizer.running == {}
+
+        with pytest.raises(InvalidImage):
+            asyncio.run(normalizer.normalize("broken", b"not an image"))
+    finally:
+        normalizer.shutdown()
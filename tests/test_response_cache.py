@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+from app.services.LLM import gpt4_vision
+from app.services.cache.response_cache import ResponseCache, make_bucket
+from app.services.images.phash import dhash
+
+PARAMS = {"model": "model", "temperature": 0, "max_tokens": 600}
+
+
+def test_exact_match_on_prompt_history_and_images():
+    cache = ResponseCache(directory = "")
+    bucket = make_bucket("Where is the icon?", [], PARAMS)
+    cache.put(bucket, ["a" * 64], "top left")
+    assert cache.get(make_bucket("  where is THE icon? ", [], PARAMS), ["a" * 64]) == "top left"
+    assert cache.get(bucket, ["b" * 64]) is None
+    assert cache.get(make_bucket("Where is the icon?", [{"role": "user", "content": "hi"}], PARAMS), ["a" * 64]) is None
+    assert cache.get(make_bucket("Where is the icon?", [], dict(PARAMS, model = "other")), ["a" * 64]) is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 3}
+
+
+def test_perceptual_match_within_tolerance(screenshot):
+    first, second = dhash(screenshot(1)), dhash(screenshot(2))
+    bucket = make_bucket("What is this?", [], PARAMS)
+    strict, tolerant = ResponseCache(directory = ""), ResponseCache(directory = "", tolerance = 1024)
+    for cache in (strict, tolerant):
+        cache.put(bucket, [first], "noise")
+    assert strict.get(bucket, [first]) == "noise"
+    assert strict.get(bucket, [second]) is None
+    assert tolerant.get(bucket, [second]) == "noise"
+
+
+def test_entries_expire_and_the_oldest_go_first():
+    cache = ResponseCache(max_entries = 2, ttl = 0.05, directory = "")
+    for n in range(3):
+        cache.put(make_bucket(f"question {n}", [], PARAMS), [], f"answer {n}")
+    assert cache.get(make_bucket("question 0", [], PARAMS), []) is None
+    assert cache.get(make_bucket("question 2", [], PARAMS), []) == "answer 2"
+    time.sleep(0.06)
+    assert cache.get(make_bucket("question 2", [], PARAMS), []) is None
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    bucket = make_bucket("What is this?", [], PARAMS)
+    ResponseCache(directory = str(tmp_path)).put(bucket, ["a" * 64], "a chart")
+    assert ResponseCache(directory = str(tmp_path)).get(bucket, ["a" * 64]) == "a chart"
+
+
+def test_same_question_twice_is_answered_from_the_cache(api, upstream, screenshot):
+    # Two new conversations, as the desktop app starts one per question by default
+    question = {"text": "Where is the Parameters icon?", "images": [screenshot(1, url = True)]}
+
+    async def main():
+        async with api() as client:
+            first = (await client.post("/chatGPT", json = question)).json()
+            second = (await client.post("/chatGPT", json = question)).json()
+            return first, second
+
+    first, second = asyncio.run(main())
+    assert (first["cached"], second["cached"]) == (False, True)
+    assert second["response"] == first["response"]
+    assert first["session_id"] != second["session_id"]
+    assert len(upstream.calls) == 1
+
+
+def test_other_screenshot_or_history_is_not_answered_from_the_cache(api, upstream, screenshot):
+    async def main():
+        async with api() as client:
+            first = (await client.post("/chatGPT", json = {"text": "What is this?",
+                                                           "images": [screenshot(1, url = True)]})).json()
+            other = (await client.post("/chatGPT", json = {"text": "What is this?",
+                                                           "images": [screenshot(2, url = True)]})).json()
+            follow_up = (await client.post("/chatGPT", json = {"text": "What is this?", "session_id": first["session_id"],
+                                                               "images": [screenshot(1, url = True)]})).json()
+            return other, follow_up
+
+    other, follow_up = asyncio.run(main())
+    assert not other["cached"] and not follow_up["cached"]
+    assert len(upstream.calls) == 3
+
+
+def test_perceptual_matches_stay_within_their_session(api, upstream, screenshot, monkeypatch):
+    monkeypatch.setattr(gpt4_vision, "PERCEPTUAL_CACHE", True)
+    question = {"text": "What is this?", "images": [screenshot(1, url = True)]}
+
+    async def main():
+        async with api() as client:
+            await client.post("/chatGPT", json = question)
+            return (await client.post("/chatGPT", json = question)).json()
+
+    assert not asyncio.run(main())["cached"]
+    assert len(upstream.calls) == 2
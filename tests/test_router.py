@@ -0,0 +1,186 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from app.services.LLM.router import HEDGE_MIN_SAMPLES, Backend, BackendRouter
+
+REQUEST = httpx.Request("POST", "https://upstream.test/v1/chat/completions")
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def close(self):
+        self.closed = True
+
+
+def chunk(content):
+    return openai.types.chat.ChatCompletionChunk.construct(
+        choices = [openai.types.chat.chat_completion_chunk.Choice.construct(
+            index = 0, delta = openai.types.chat.chat_completion_chunk.ChoiceDelta.construct(content = content))])
+
+
+class FakeClient:
+    # Stands for AsyncOpenAI, client.chat.completions.create answers after delay
+    # or raises error. wait, when given, is awaited before answering.
+    def __init__(self, answer = "answer", delay = 0.0, error = None, wait = None):
+        self.chat = self.completions = self
+        self.answer = answer
+        self.delay = delay
+        self.error = error
+        self.wait = wait
+        self.calls = 0
+        self.cancelled = 0
+        self.streams = []
+
+    async def create(self, model, stream = False, **params):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+            if self.wait is not None:
+                await self.wait.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        if stream:
+            self.streams.append(FakeStream([chunk(self.answer)]))
+            return self.streams[-1]
+        return self.answer
+
+
+def backend(name, client, latency = None, model = "model"):
+    backend = Backend(name, client, model)
+    if latency is not None:
+        # Enough history for the hedge delay to follow the percentile, 0.25 s at least
+        for mode in ("complete", "stream"):
+            backend.latencies[mode].extend([latency] * HEDGE_MIN_SAMPLES)
+    return backend
+
+
+class Budget:
+    # Stands for the scheduler's ExtraAttempts
+    def __init__(self, hedges):
+        self.hedges = hedges
+        self.fallbacks = 0
+
+    def hedge(self):
+        self.hedges -= 1
+        return self.hedges >= 0
+
+    async def fallback(self):
+        self.fallbacks += 1
+
+
+def test_hedge_wins_and_the_slow_attempt_is_cancelled():
+    slow, fast = FakeClient("slow", delay = 5), FakeClient("fast")
+    router = BackendRouter([backend("primary", slow, latency = 0.01), backend("secondary", fast)])
+
+    async def main():
+        answer = await router.complete(messages = [])
+        await asyncio.sleep(0)
+        return answer
+
+    assert asyncio.run(main()) == "fast"
+    assert (slow.calls, slow.cancelled, fast.calls) == (1, 1, 1)
+
+
+def test_no_hedge_to_a_single_backend_unless_allowed():
+    client = FakeClient(delay = 0.4)
+    router = BackendRouter([backend("only", client, latency = 0.01)])
+    assert asyncio.run(router.complete(messages = [])) == "answer"
+    assert client.calls == 1
+
+    client = FakeClient(delay = 0.4)
+    router = BackendRouter([backend("only", client, latency = 0.01)], hedge_same_backend = True)
+    asyncio.run(router.complete(messages = []))
+    assert client.calls == 2
+
+
+def test_no_hedge_without_budget():
+    slow, fast = FakeClient("slow", delay = 0.4), FakeClient("fast")
+    router = BackendRouter([backend("primary", slow, latency = 0.01), backend("secondary", fast)])
+    budget = Budget(hedges = 0)
+    assert asyncio.run(router.complete(budget, messages = [])) == "slow"
+    assert fast.calls == 0
+
+
+def test_fallback_after_a_retryable_error():
+    failing = FakeClient(error = openai.APIConnectionError(request = REQUEST))
+    backup = FakeClient("backup")
+    router = BackendRouter([backend("primary", failing), backend("secondary", backup)])
+    budget = Budget(hedges = 0)
+    assert asyncio.run(router.complete(budget, messages = [])) == "backup"
+    assert budget.fallbacks == 1
+    assert router.backends[0].failures == 1
+
+
+def test_no_fallback_after_a_bad_request():
+    response = httpx.Response(400, request = REQUEST)
+    failing = FakeClient(error = openai.BadRequestError("bad request", response = response, body = None))
+    backup = FakeClient("backup")
+    router = BackendRouter([backend("primary", failing), backend("secondary", backup)])
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(router.complete(messages = []))
+    assert backup.calls == 0
+
+
+def test_stream_loser_is_closed_unread():
+    async def main():
+        # Both attempts get their first token at the same time, one of them wins
+        first_token = asyncio.Event()
+        primary, secondary = FakeClient("primary", wait = first_token), FakeClient("secondary", wait = first_token)
+        router = BackendRouter([backend("primary", primary, latency = 0.01), backend("secondary", secondary)])
+        stream = router.stream(messages = [])
+        reading = asyncio.ensure_future(stream.__anext__())
+        while not secondary.calls:
+            await asyncio.sleep(0.05)
+        first_token.set()
+        first = await reading
+        streams = {client.answer: client.streams for client in (primary, secondary)}
+        # The loser is closed as soon as the race is decided, the winner is still read
+        closed = {answer: [stream.closed for stream in opened] for answer, opened in streams.items()}
+        await stream.aclose()
+        return first.choices[0].delta.content, closed, streams
+
+    winner, closed, streams = asyncio.run(main())
+    loser = "secondary" if winner == "primary" else "primary"
+    assert closed == {winner: [False], loser: [True]}
+    assert streams[winner][0].closed
+
+
+def test_served_names_the_model_that_answered():
+    failing = FakeClient(error = openai.APIConnectionError(request = REQUEST))
+    router = BackendRouter([backend("primary", failing), backend("backup", FakeClient("backup"), model = "other")])
+    served = {}
+    assert asyncio.run(router.complete(served = served, messages = [])) == "backup"
+    assert served == {"model": "other"}
+
+
+def test_answers_of_another_model_are_not_cached(api, upstream, monkeypatch):
+    from app.main import chatgpt
+
+    failing = FakeClient(error = openai.APIConnectionError(request = REQUEST))
+    monkeypatch.setattr(chatgpt, "router", BackendRouter([backend("primary", failing, model = chatgpt.model),
+                                                          backend("backup", upstream, model = "other")]))
+    question = {"text": "Where is the Parameters icon?"}
+
+    async def run():
+        async with api() as client:
+            asked = [(await client.post("/chatGPT", json = question)).json() for _ in range(2)]
+            streamed = [(await client.post("/chatGPT/stream", json = question)).text for _ in range(2)]
+            return asked, streamed
+
+    asked, streamed = asyncio.run(run())
+    assert [answer["cached"] for answer in asked] == [False, False]
+    assert all('"cached": false' in text for text in streamed)
+    assert len(upstream.calls) == 4
@@ -0,0 +1,181 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from app.services.LLM.scheduler import RateLimited, UpstreamScheduler, retry_after
+
+
+def rate_limit_error(headers):
+    request = httpx.Request("POST", "https://upstream.test/v1/chat/completions")
+    response = httpx.Response(429, headers = headers, request = request)
+    return openai.RateLimitError("Rate limit reached", response = response, body = None)
+
+
+def exhausted(scheduler):
+    # The request budget is spent, it comes back at its refill rate
+    scheduler.requests.level = 0.0
+    scheduler.requests.updated = time.monotonic()
+
+
+def test_retry_after_headers():
+    assert retry_after(rate_limit_error({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after(rate_limit_error({"retry-after": "2"})) == 2.0
+    assert retry_after(rate_limit_error({})) == 1.0
+
+
+def test_calls_within_the_budget_go_right_away():
+    async def main():
+        scheduler = UpstreamScheduler(rpm = 600)
+        start = time.monotonic()
+
+        async def factory(extra_attempts):
+            return "answer"
+
+        results = await asyncio.gather(*[scheduler.run(100, "interactive", factory) for _ in range(3)])
+        return results, time.monotonic() - start
+
+    results, elapsed = asyncio.run(main())
+    assert results == ["answer"] * 3
+    assert elapsed < 0.05
+
+
+def test_queued_calls_go_by_priority_then_arrival():
+    async def main():
+        scheduler = UpstreamScheduler(rpm = 600)  # One call every 0.1 s once exhausted
+        exhausted(scheduler)
+        order = []
+
+        def factory(name):
+            async def call(extra_attempts):
+                order.append(name)
+            return call
+
+        calls = []
+        for name, priority in (("batch", "batch"), ("watch", "watch"), ("first", "interactive"),
+                               ("second", "interactive")):
+            calls.append(asyncio.ensure_future(scheduler.run(10, priority, factory(name))))
+            await asyncio.sleep(0)
+        await asyncio.gather(*calls)
+        return order
+
+    assert asyncio.run(main()) == ["first", "second", "watch", "batch"]
+
+
+def test_stream_reports_its_place_while_queued():
+    async def main():
+        scheduler = UpstreamScheduler(rpm = 600)
+        exhausted(scheduler)
+
+        async def factory(extra_attempts):
+            yield "delta"
+
+        items = [item async for item in scheduler.stream(10, "interactive", factory)]
+        return items
+
+    items = asyncio.run(main())
+    assert items[-1] == "delta"
+    assert items[0].position == 1 and items[0].eta > 0
+
+
+def test_rejected_when_the_wait_is_too_long():
+    async def main():
+        scheduler = UpstreamScheduler(rpm = 1, max_wait = 5)
+        exhausted(scheduler)
+
+        async def factory(extra_attempts):
+            return "answer"
+
+        await scheduler.run(10, "interactive", factory)
+
+    with pytest.raises(RateLimited) as error:
+        asyncio.run(main())
+    assert error.value.retry_after > 5
+
+
+def test_rate_limit_pauses_every_call_for_its_retry_after():
+    async def main():
+        scheduler = UpstreamScheduler()
+        start = time.monotonic()
+        started = []
+
+        async def limited(extra_attempts):
+            started.append(("limited", time.monotonic() - start))
+            if len(started) == 1:
+                raise rate_limit_error({"retry-after": "0.2"})
+            return "answer"
+
+        async def other(extra_attempts):
+            started.append(("other", time.monotonic() - start))
+            return "answer"
+
+        first = asyncio.ensure_future(scheduler.run(10, "interactive", limited))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(scheduler.run(10, "interactive", other))
+        return await asyncio.gather(first, second), started
+
+    results, started = asyncio.run(main())
+    assert results == ["answer", "answer"]
+    assert [name for name, _ in started] == ["limited", "limited", "other"]
+    # The retry and the call that came during the pause both waited for it
+    assert all(at >= 0.2 for _, at in started[1:])
+
+
+def test_rate_limited_once_the_retries_are_used_up():
+    async def main():
+        scheduler = UpstreamScheduler(rate_limit_retries = 1)
+        calls = []
+
+        async def factory(extra_attempts):
+            calls.append(1)
+            raise rate_limit_error({"retry-after-ms": "10"})
+
+        with pytest.raises(RateLimited) as error:
+            await scheduler.run(10, "interactive", factory)
+        return len(calls), error.value.retry_after
+
+    calls, seconds = asyncio.run(main())
+    assert calls == 2
+    assert seconds == 0.01
+
+
+def test_hedges_only_go_when_the_budget_has_room():
+    async def main():
+        scheduler = UpstreamScheduler(rpm = 2)
+        granted = []
+
+        async def factory(extra_attempts):
+            granted.append(extra_attempts.hedge())
+            granted.append(extra_attempts.hedge())
+
+        await scheduler.run(10, "interactive", factory)
+        return granted, scheduler.requests.level
+
+    granted, level = asyncio.run(main())
+    assert granted == [True, False]
+    assert level < 1
+
+
+def test_requests_queued_on_the_rate_limit_hold_no_in_flight_slot(api, upstream, monkeypatch):
+    # One slot and no queue: requests waiting for the upstream budget would have
+    # been turned away with a 503 if they held it meanwhile
+    from app import main
+    from app.services.LLM.limiter import ConcurrencyLimiter
+
+    monkeypatch.setattr(main, "limiter", ConcurrencyLimiter(max_in_flight = 1, max_queued = 0))
+    scheduler = UpstreamScheduler(rpm = 600)
+    exhausted(scheduler)
+    monkeypatch.setattr(main.chatgpt, "scheduler", scheduler)
+
+    async def run():
+        async with api() as client:
+            asks = [client.post("/chatGPT", json = {"text": f"question {n}"}) for n in range(3)]
+            streams = [client.post("/chatGPT/stream", json = {"text": f"streamed {n}"}) for n in range(2)]
+            return await asyncio.gather(*asks, *streams)
+
+    responses = asyncio.run(run())
+    assert [response.status_code for response in responses] == [200] * 5
+    assert all('"done": true' in response.text for response in responses[3:])
+    assert main.limiter.in_flight == 0
@@ -0,0 +1,94 @@
+from app.services.session.session_manager import SessionManager, message_size
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+def test_session_history_stays_within_its_budget():
+    manager = SessionManager("context", max_session_bytes = 400)
+    session = manager.get("s")
+    for i in range(50):
+        manager.record_turn(session, input = user(f"question {i} " + "x" * 40), previous_output = f"answer {i}")
+
+    assert session.nbytes <= 400
+    assert session.nbytes == sum(map(message_size, session.chat_history))
+    assert session.chat_history[0] == {"role": "system", "content": "context"}
+    assert session.chat_history[-1] == {"role": "system", "content": "answer 49"}
+    assert manager.stats()["bytes"] == session.nbytes
+
+
+def test_least_recently_used_sessions_are_evicted():
+    manager = SessionManager("context", max_sessions = 2)
+    first = manager.get("first")
+    manager.get("second")
+    manager.get("first")  # Used again, "second" is now the oldest
+    manager.get("third")
+
+    assert list(manager.sessions) == ["first", "third"]
+    assert first.closed is False
+    assert manager.stats()["sessions"] == 2
+
+
+def test_total_budget_evicts_sessions():
+    manager = SessionManager("context", max_total_bytes = 1000)
+    for i in range(10):
+        manager.record_turn(manager.get(f"s{i}"), input = user("x" * 200))
+
+    assert manager.stats()["bytes"] <= 1000
+    assert manager.stats()["bytes"] == sum(session.nbytes for session in manager.sessions.values())
+    assert "s9" in manager.sessions and "s0" not in manager.sessions
+
+
+def test_pinned_sessions_are_not_evicted():
+    manager = SessionManager("context", max_sessions = 1)
+    pinned = manager.get("pinned", pin = True)
+    manager.get("other")
+    manager.get("another")
+
+    assert "pinned" in manager.sessions and not pinned.closed
+
+    manager.unpin(pinned)
+    manager.get("last")
+    assert pinned.closed and pinned.evicted
+    assert list(manager.sessions) == ["last"]
+
+
+def test_turns_of_an_evicted_session_are_still_recorded():
+    recorded = []
+    manager = SessionManager("context", max_sessions = 1, on_record = lambda session_id, messages:
+                             recorded.append((session_id, messages)))
+    session = manager.get("evicted")
+    manager.get("other")
+    assert session.closed and session.evicted
+
+    manager.record_turn(session, input = user("late question"), previous_output = "late answer")
+    assert recorded[-1] == ("evicted", [user("late question"), {"role": "system", "content": "late answer"}])
+
+    # A deleted session records nothing
+    dropped = manager.get("dropped")
+    manager.drop("dropped")
+    manager.record_turn(dropped, input = user("ignored"))
+    assert recorded[-1][0] == "evicted"
+
+
+def test_evicted_sessions_are_restored_from_storage():
+    stored = {"s": [user("earlier question"), {"role": "system", "content": "earlier answer"}]}
+    manager = SessionManager("context", max_sessions = 1, load_history = stored.get)
+    session = manager.get("s")
+
+    assert session.chat_history[1:] == stored["s"]
+    assert manager.get("new").chat_history == [{"role": "system", "content": "context"}]
+
+
+def test_discarded_messages_are_reported():
+    appended, discarded = [], []
+    manager = SessionManager("context", max_session_bytes = 200, on_append = appended.extend,
+                             on_discard = discarded.extend)
+    session = manager.get("s")
+    for i in range(10):
+        manager.record_turn(session, input = user(f"question {i} " + "x" * 40))
+    manager.drop("s")
+
+    # Every message that entered the history left it exactly once
+    assert sorted(map(str, appended)) == sorted(map(str, [m for m in discarded if m["role"] == "user"]))
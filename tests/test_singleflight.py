@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+from app.services.LLM.singleflight import SingleFlight
+
+
+def test_result_shared_by_every_waiter():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def main():
+        inflight = SingleFlight()
+        return await asyncio.gather(*[inflight.run("key", factory) for _ in range(3)])
+
+    assert asyncio.run(main()) == ["answer"] * 3
+    assert len(calls) == 1
+
+
+def test_error_propagated_to_every_waiter():
+    async def factory():
+        await asyncio.sleep(0.05)
+        raise ValueError("upstream failed")
+
+    async def main():
+        inflight = SingleFlight()
+        results = await asyncio.gather(*[inflight.run("key", factory) for _ in range(3)], return_exceptions = True)
+        return results, inflight.active("key")
+
+    results, active = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert not active  # The next call starts over
+
+
+def test_cancelled_only_after_the_last_waiter_leaves():
+
+    async def main():
+        inflight = SingleFlight()
+        stopped = []
+
+        async def factory():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                stopped.append(1)
+                raise
+
+        first = asyncio.ensure_future(inflight.run("key", factory))
+        second = asyncio.ensure_future(inflight.run("key", factory))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        still_running = not stopped and inflight.active("key")
+        second.cancel()
+        await asyncio.sleep(0.01)
+        return still_running, stopped, inflight.active("key")
+
+    still_running, stopped, active = asyncio.run(main())
+    assert still_running
+    assert stopped == [1]
+    assert not active
+
+
+def test_stream_replayed_to_late_subscribers():
+    async def factory(info):
+        info["trimmed_tokens"] = 3
+        for item in ("a", "b", "c"):
+            await asyncio.sleep(0.01)
+            yield item
+
+    async def read(subscription):
+        return [item async for item in subscription]
+
+    async def main():
+        inflight = SingleFlight()
+        first = inflight.stream("key", factory)
+        reading = asyncio.ensure_future(read(first))
+        await asyncio.sleep(0.015)
+        second = inflight.stream("key", factory)
+        return first.leader, second.leader, await reading, await read(second), second.info
+
+    first_leader, second_leader, first_items, second_items, info = asyncio.run(main())
+    assert (first_leader, second_leader) == (True, False)
+    assert first_items == second_items == ["a", "b", "c"]
+    assert info == {"trimmed_tokens": 3}
+
+
+def test_stream_error_propagated_to_every_subscriber():
+    async def factory(info):
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def read(subscription):
+        items = []
+        with pytest.raises(ValueError):
+            async for item in subscription:
+                items.append(item)
+        return items
+
+    async def main():
+        inflight = SingleFlight()
+        subscriptions = [inflight.stream("key", factory) for _ in range(2)]
+        return await asyncio.gather(*[read(subscription) for subscription in subscriptions])
+
+    assert asyncio.run(main()) == [["a"], ["a"]]
+
+
+def test_stream_cancelled_once_every_subscriber_closed():
+    async def main():
+        inflight = SingleFlight()
+        stopped = []
+
+        async def factory(info):
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield "a"
+            except asyncio.CancelledError:
+                stopped.append(1)
+                raise
+
+        reader = inflight.stream("key", factory)
+        unread = inflight.stream("key", factory)  # Its client left before the body started
+        items = reader.__aiter__()
+        await items.__anext__()
+        unread.close()
+        await asyncio.sleep(0.02)
+        running = not stopped
+        await items.aclose()
+        await asyncio.sleep(0.01)
+        return running, stopped, inflight.active("key")
+
+    running, stopped, active = asyncio.run(main())
+    assert running
+    assert stopped == [1]
+    assert not active
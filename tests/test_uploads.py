@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import io
+import json
+
+import pytest
+from starlette.datastructures import UploadFile
+
+from app.main import chatgpt
+from app.services.images.image_store import InvalidImage
+from app.services.images.uploads import read_image_upload, sniff_mime
+
+
+def post_upload(api, path, images, text = "what is this?"):
+    async def run():
+        async with api() as client:
+            files = [("images", (f"screenshot_{i}.png", data, "image/png")) for i, data in enumerate(images)]
+            return await client.post(path, data = {"text": text}, files = files)
+    return asyncio.run(run())
+
+
+def test_sniff_mime():
+    assert sniff_mime(b"\x89PNG\r\n\x1a\n\0\0\0\0") == "image/png"
+    assert sniff_mime(b"\xff\xd8\xff\xe0" + bytes(8)) == "image/jpeg"
+    assert sniff_mime(b"RIFF\0\0\0\0WEBP") == "image/webp"
+    assert sniff_mime(b"<html><body>") is None
+
+
+def test_read_image_upload(screenshot):
+    data = screenshot(1)
+    buffer, mime = asyncio.run(read_image_upload(UploadFile(io.BytesIO(data), filename = "shot.png")))
+    assert bytes(buffer) == data and mime == "image/png"
+
+
+@pytest.mark.parametrize("data, max_bytes, error", [
+    (b"<html><body>not an image</body></html>", 1024, "unsupported image type"),
+    (b"\x89PNG", 1024, "not an image"),
+    (b"\x89PNG\r\n\x1a\n" + bytes(2048), 1024, "larger than 1024 bytes"),
+])
+def test_read_image_upload_rejects(data, max_bytes, error):
+    with pytest.raises(InvalidImage, match = error):
+        asyncio.run(read_image_upload(UploadFile(io.BytesIO(data), filename = "shot.png"), max_bytes = max_bytes))
+
+
+def test_uploaded_images_reach_the_upstream(api, upstream, screenshot):
+    images = [screenshot(1), screenshot(2)]
+    response = post_upload(api, "/chatGPT/upload", images)
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["response"] == "answer 1"
+    urls = [item["image_url"]["url"] for item in upstream.calls[0]["messages"][-1]["content"]
+            if item["type"] == "image_url"]
+    assert len(urls) == 2 and urls[0].startswith("data:image/png;base64,")
+
+    history = chatgpt.session_manager.get(body["session_id"]).snapshot()
+    digests = [item["digest"] for item in history[-2]["content"] if item["type"] == "image_ref"]
+    assert digests == [hashlib.sha256(data).hexdigest() for data in images]
+
+
+def test_upload_stream(api, upstream, screenshot):
+    response = post_upload(api, "/chatGPT/upload/stream", [screenshot(1)])
+
+    assert response.status_code == 200
+    events = [json.loads(line[len("data:"):]) for line in response.text.splitlines() if line.startswith("data:")]
+    assert "".join(event.get("delta", "") for event in events) == "answer 1 "
+    assert events[-1]["done"]
+
+
+def test_invalid_upload_is_rejected_and_releases_the_others(api, upstream, screenshot):
+    good = screenshot(801)  # Not referenced by the sessions of the other tests
+    response = post_upload(api, "/chatGPT/upload", [good, b"<html>not an image at all</html>"])
+
+    assert response.status_code == 400
+    assert "unsupported image type" in response.json()["detail"]
+    assert upstream.calls == []
+    assert chatgpt.image_store.get(hashlib.sha256(good).hexdigest()).refcount == 0